@@ -1,4 +1,11 @@
 import bpy
+import os
+import sys
+
+# Make the helper modules next to this script importable,
+# also when running it from within Blender
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import profiling
 
 
 def add_camera_path(pathname, radius, location):
@@ -78,19 +85,21 @@ def animate_camera(objcamera, objpath, objtrackto, startframe=1, duration=200):
     if objpath.data.animation_data is not None:
         actions.add(objpath.data.animation_data.action)
 
-    for act in actions:
-        for fcu in act.fcurves:
-            if fcu.data_path == 'eval_time':
-                act.fcurves.remove(fcu)
+    with profiling.stage('cleanup'):
+        for act in actions:
+            for fcu in act.fcurves:
+                if fcu.data_path == 'eval_time':
+                    act.fcurves.remove(fcu)
 
     # insert keyframes
-    objpath.data.path_duration = 100
-    objpath.data.eval_time = 0
-    objpath.data.keyframe_insert(data_path="eval_time", frame=startframe)
+    with profiling.stage('keyframes', 2):
+        objpath.data.path_duration = 100
+        objpath.data.eval_time = 0
+        objpath.data.keyframe_insert(data_path="eval_time", frame=startframe)
 
-    endframe = startframe + duration
-    objpath.data.eval_time = 100
-    objpath.data.keyframe_insert(data_path="eval_time", frame=endframe)
+        endframe = startframe + duration
+        objpath.data.eval_time = 100
+        objpath.data.keyframe_insert(data_path="eval_time", frame=endframe)
 
     # set end-frame in Blender at least to the duration time
     # (comment this out, if you do not want this)
@@ -105,8 +114,9 @@ def run():
     tracktoname = "Camera-TrackTo"
 
     # create camera path and trackto-object
-    objpath = add_camera_path(pathname, 5, (0,0,1))
-    objtrack = add_trackto_object(tracktoname, (0,0,0))
+    with profiling.stage('path'):
+        objpath = add_camera_path(pathname, 5, (0,0,1))
+        objtrack = add_trackto_object(tracktoname, (0,0,0))
 
     # alternatively choose your own paths and trackto-objects
     #objpath = bpy.data.objects[pathname]
@@ -124,4 +134,12 @@ def run():
 
 
 if __name__ == '__main__':
+    # Measure the stages (wall time, peak memory) and write
+    # a json-report to profilefile, or None
+    profilefile = None
+    if profilefile is not None:
+        profiling.enable(profilefile, name='animate_camera')
+
     run()
+
+    profiling.finish()
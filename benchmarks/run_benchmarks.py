@@ -0,0 +1,456 @@
+"""
+Headless benchmarks for ravestars_mesh.py, deform_starmesh.py,
+shift_keyframes.py and compact_keyframes.py on synthetic star catalogs,
+using the bpy stand-in in benchmarks/standin instead of Blender.
+Throughput and peak memory of each stage (see profiling.py) are
+compared with a stored baseline; the run fails if a stage got slower
+or needs more memory than allowed by the threshold. Results are
+checked by the tests in tests/, not here.
+"""
+#
+# Usage (from the top directory of the repository):
+#     python benchmarks/run_benchmarks.py
+#     python benchmarks/run_benchmarks.py --sizes 1e4 1e5 1e6 1e7
+#     python benchmarks/run_benchmarks.py --update-baseline
+#
+# Each catalog size runs in its own process, so that the peak memory
+# of one size does not hide that of the next one. Catalogs are written
+# once into --datadir and reused; sizes up to --maxcsv stars are
+# written as csv-files (like the RAVE-database exports), larger ones as
+# uncompressed .npz-files with binary columns.
+#
+# The stand-in only stores arrays, so the times measure the Python and
+# numpy code of the scripts, not Blender itself. Baselines depend on
+# the machine, so they are not part of the repository: the baseline is
+# kept in --datadir (baseline.json, ignored by git) and is created or
+# refreshed with --update-baseline on the machine where the benchmarks
+# are compared, e.g. before starting on a change.
+#
+
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+REPODIR = os.path.dirname(BENCHDIR)
+
+# Default catalog sizes (number of stars)
+SIZES = (10000, 100000, 1000000)
+
+# Largest catalog written as csv-file, larger ones as .npz-file
+MAXCSV = 1000000
+
+# Allowed relative regression of throughput, time and memory growth
+THRESHOLD = 0.25
+
+# Runs per catalog size; times vary between runs, so the best of
+# them is compared
+REPEAT = 3
+
+# Stages faster than this (in seconds) are too noisy for comparisons
+MINSECONDS = 0.05
+
+# Memory growth below this (in MB) is not compared
+MINGROWTH = 10.
+
+# Keyframes per star for the shift_keyframes-benchmark
+KEYS_PER_STAR = 0.1
+
+
+def synthetic_columns(n, seed=0):
+    """Return dictionary of catalog columns (RAVE-names) for n stars
+    in a thick disk around the sun, with 2% missing temperatures
+    """
+
+    rng = np.random.RandomState(seed)
+    glon = rng.uniform(0., 360., n)
+    glat = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))*0.3
+    dist = rng.exponential(0.4, n)
+    hrv = rng.normal(0., 40., n).astype(np.float32)
+    teff = rng.normal(5500., 800., n).astype(np.float32)
+    teff[rng.uniform(size=n) < 0.02] = np.nan
+
+    return {'RAVE_OBS_ID': np.arange(n), 'Glon': glon, 'Glat': glat,
+            'dist': dist, 'HRV': hrv, 'Teff_K': teff}
+
+
+def write_csv_catalog(filename, columns, chunksize=100000):
+    """Write columns into a csv-file like the Daiquiri exports,
+    missing values as blank fields
+    """
+
+    names = list(columns.keys())
+    n = len(columns[names[0]])
+    with open(filename, 'w') as f:
+        f.write(','.join(names) + '\n')
+        for start in range(0, n, chunksize):
+            fields = []
+            for name in names:
+                values = columns[name][start:start + chunksize]
+                if values.dtype.kind == 'f':
+                    text = np.char.mod('%.6f', values)
+                    text[np.isnan(values)] = ''
+                else:
+                    text = values.astype(str)
+                fields.append(text)
+            rows = np.char.add(fields[0], '')
+            for text in fields[1:]:
+                rows = np.char.add(np.char.add(rows, ','), text)
+            f.write('\n'.join(rows) + '\n')
+
+
+def make_catalog(n, datadir, maxcsv=MAXCSV):
+    """Return file name of the synthetic catalog with n stars,
+    write it first if it does not exist yet
+    """
+
+    if not os.path.isdir(datadir):
+        os.makedirs(datadir)
+
+    ext = '.csv' if n <= maxcsv else '.npz'
+    filename = os.path.join(datadir, 'stars-%d%s' % (n, ext))
+    if os.path.exists(filename):
+        return filename
+
+    print("Writing synthetic catalog %s ..." % filename)
+    columns = synthetic_columns(n)
+    tmpname = filename + '.tmp' + ext
+    if ext == '.csv':
+        write_csv_catalog(tmpname, columns)
+    else:
+        # Uncompressed, so the columns are memory-mapped when reading
+        with open(tmpname, 'wb') as f:
+            np.savez(f, **columns)
+    os.rename(tmpname, filename)
+
+    return filename
+
+
+def chained_stars(n, spacing=0.9):
+    """Return star columns of n stars on a line, spacing apart: with a
+    tolerance of 1, each star is within the tolerance of its neighbours,
+    so deciding the leaders goes along the whole chain, and every second
+    star is merged
+    """
+
+    x = np.arange(n)*spacing
+    zeros = np.zeros(n)
+
+    return {'x': x, 'y': zeros, 'z': zeros, 'hrv': zeros, 'teff': zeros}
+
+
+def add_synthetic_keyframes(bpy, nkeys, nfcurves=10):
+    """Create an object with an action of nkeys keyframes on nfcurves
+    fcurves, to give shift_keyframes() something to shift
+    """
+
+    obj = bpy.data.objects.new('bench-keys', None)
+    action = bpy.data.actions.new('bench-keysAction')
+    obj.animation_data_create().action = action
+
+    per_curve = max(1, nkeys//nfcurves)
+    frames = np.arange(per_curve, dtype=np.float32)
+    for i in range(nfcurves):
+        fcu = action.fcurves.new('location', index=i % 3)
+        fcu.keyframe_points.add(per_curve)
+        co = np.column_stack([frames, np.sin(frames*0.1 + i)])
+        fcu.keyframe_points.foreach_set('co', co.reshape(-1))
+        fcu.keyframe_points.foreach_set('handle_left',
+                                        (co - (0.3, 0.)).reshape(-1))
+        fcu.keyframe_points.foreach_set('handle_right',
+                                        (co + (0.3, 0.)).reshape(-1))
+
+    return obj
+
+
+def add_stepped_keyframes(bpy, nkeys, nfcurves=10):
+    """Create objects with actions of nkeys bezier keyframes each on
+    nfcurves fcurves, with flat runs next to value changes: steps
+    between 0 and 1 every 50 frames ('compact-steps') and flat runs of
+    30 frames joined by ramps of 40 frames ('compact-ramps')
+    """
+
+    per_curve = max(1, nkeys//nfcurves)
+    frames = np.arange(per_curve, dtype=np.float32)
+    curves = {'compact-steps': (frames//50) % 2,
+              'compact-ramps': np.clip((frames % 100 - 30)/40., 0., 1.)}
+
+    objects = []
+    for name, values in sorted(curves.items()):
+        obj = bpy.data.objects.new(name, None)
+        action = bpy.data.actions.new(name + 'Action')
+        obj.animation_data_create().action = action
+        for i in range(nfcurves):
+            fcu = action.fcurves.new('location', index=i % 3)
+            fcu.keyframe_points.add(per_curve)
+            co = np.column_stack([frames, values + i])
+            fcu.keyframe_points.foreach_set('co', co.reshape(-1))
+            fcu.update()
+        objects.append(obj)
+
+    return objects
+
+
+def write_catalog(n, datadir, maxcsv=MAXCSV):
+    """Return file name of the synthetic catalog with n stars, written
+    by a new process if needed: on Linux, the peak memory of a process
+    is passed on to the processes started by it, so this one must stay
+    small for measuring the peak memory of the benchmarks
+    """
+
+    command = [sys.executable, os.path.abspath(__file__), '--write',
+               str(n), '--datadir', datadir, '--maxcsv', str(maxcsv)]
+    if subprocess.call(command) != 0:
+        raise RuntimeError("Writing catalog with %d stars failed." % n)
+
+    return make_catalog(n, datadir, maxcsv)
+
+
+def run_single(n, catalog, reportfile):
+    """Run the pipelines for one catalog in this process,
+    write the profiling report to reportfile
+    """
+
+    # The stand-in must come first, before any script imports bpy
+    sys.path.insert(0, os.path.join(BENCHDIR, 'standin'))
+    sys.path.insert(1, REPODIR)
+
+    import bpy
+    import profiling
+    import starcatalog
+    import ravestars_mesh
+    import deform_starmesh
+    import shift_keyframes
+    import compact_keyframes
+
+    profiling.enable(reportfile, name='benchmark-%d' % n)
+    profiling.set_meta(nstars=n, catalog=os.path.basename(catalog))
+
+    with profiling.stage('import'):
+        with profiling.stage('load'):
+            stars = starcatalog.read_stars(catalog, usecache=False)
+        objects = ravestars_mesh.create_hrv_meshes(stars, (0, 0, 0),
+                                                   0.015, 1.8)
+
+    # Chains of close stars, the worst case for deciding the leaders
+    starcatalog.dedup_stars([chained_stars(n)], 1.)
+
+    with profiling.stage('deform'):
+        deform_starmesh.make_basis_shapekeys(objects, 'Basis')
+        deform_starmesh.make_form_shapekeys(
+            objects, [('KeySphere', 'SPHERE', {'rsphere': 2.}),
+                      ('KeyMap', 'MAP', {'mapw': 7.5, 'maph': 4.5})])
+        deform_starmesh.add_shape_animation(objects, 'Basis', 230,
+                                            'KeySphere', 170)
+        deform_starmesh.add_shape_timeline(
+            objects, [('KeyMap', 30, 30),
+                      ('KeySphere', 30, 100, 'BEZIER'),
+                      ('Basis', 170, 230, ('SINE', 'EASE_IN_OUT'))])
+
+    add_synthetic_keyframes(bpy, int(n*KEYS_PER_STAR))
+    with profiling.stage('shift'):
+        actions = shift_keyframes.get_actions_for_objects('bench-*')
+        shift_keyframes.shift_keyframes(actions, factor=2, frameshift=10)
+
+    add_stepped_keyframes(bpy, int(n*KEYS_PER_STAR))
+    with profiling.stage('compact'):
+        actions = shift_keyframes.get_actions_for_objects('compact-*')
+        compact_keyframes.compact_actions(actions)
+
+    with profiling.stage('cleanup'):
+        ravestars_mesh.delete_tracked()
+
+    profiling.finish()
+
+
+def run_size(n, catalog, reportfile):
+    """Run the benchmark for one catalog in a new process,
+    return its report
+    """
+
+    command = [sys.executable, os.path.abspath(__file__), '--single',
+               str(n), '--catalog', catalog, '--report', reportfile]
+    with open(os.devnull, 'w') as devnull:
+        result = subprocess.call(command, stdout=devnull)
+    if result != 0:
+        raise RuntimeError("Benchmark for %d stars failed." % n)
+
+    with open(reportfile) as f:
+        return json.load(f)
+
+
+def stage_summary(reports):
+    """Return dictionary of the measures compared with the baseline,
+    per stage, the best of the repeated runs (reports): shortest time,
+    highest throughput and smallest memory growth
+    """
+
+    summary = {}
+    for report in reports:
+        for entry in report['stages']:
+            best = summary.get(entry['stage'])
+            if best is None:
+                summary[entry['stage']] = {
+                    'seconds': entry['seconds'],
+                    'per_second': entry['per_second'],
+                    'peak_growth_mb': entry['peak_growth_mb']}
+                continue
+            best['seconds'] = min(best['seconds'], entry['seconds'])
+            if entry['per_second'] is not None:
+                best['per_second'] = max(best['per_second'] or 0.,
+                                         entry['per_second'])
+            best['peak_growth_mb'] = min(best['peak_growth_mb'],
+                                         entry['peak_growth_mb'])
+
+    return summary
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Compare stage summaries of all sizes with the baseline,
+    return list of messages for the regressions
+    """
+
+    regressions = []
+    for size, stages in sorted(results.items(), key=lambda s: int(s[0])):
+        base = baseline.get(size)
+        if base is None:
+            print("No baseline for %s stars." % size)
+            continue
+
+        for name, now in stages.items():
+            old = base.get(name)
+            if old is None:
+                continue
+
+            label = "%s stars, %s" % (size, name)
+            if max(now['seconds'], old['seconds']) >= MINSECONDS:
+                if now['per_second'] and old['per_second']:
+                    if now['per_second'] < old['per_second']*(1. - threshold):
+                        regressions.append(
+                            "%s: %.0f/s, baseline %.0f/s"
+                            % (label, now['per_second'], old['per_second']))
+                elif now['seconds'] > old['seconds']*(1. + threshold):
+                    regressions.append("%s: %.3f s, baseline %.3f s"
+                                       % (label, now['seconds'],
+                                          old['seconds']))
+
+            growth, oldgrowth = now['peak_growth_mb'], old['peak_growth_mb']
+            if (growth >= MINGROWTH
+                    and growth > oldgrowth*(1. + threshold) + MINGROWTH):
+                regressions.append("%s: +%.1f MB peak, baseline +%.1f MB"
+                                   % (label, growth, oldgrowth))
+
+    return regressions
+
+
+def format_stages(report):
+    """Return table of the stages of the report, see profiling.py"""
+
+    if REPODIR not in sys.path:
+        sys.path.insert(0, REPODIR)
+    import profiling
+
+    return profiling.format_report(report)
+
+
+def parse_size(text):
+    """Return number of stars for e.g. '100000' or '1e5'"""
+
+    return int(float(text))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sizes', nargs='+', type=parse_size,
+                        default=list(SIZES),
+                        help="catalog sizes (number of stars)")
+    parser.add_argument('--datadir',
+                        default=os.path.join(BENCHDIR, '.data'),
+                        help="directory for the synthetic catalogs")
+    parser.add_argument('--maxcsv', type=parse_size, default=MAXCSV,
+                        help="largest catalog written as csv-file")
+    parser.add_argument('--baseline',
+                        help="json-file with the baseline of this machine "
+                        "(default: baseline.json in --datadir)")
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help="runs per size, the best one is compared")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help="allowed relative regression (0.25: 25%%)")
+    parser.add_argument('--update-baseline', action='store_true',
+                        help="store the results as new baseline")
+    parser.add_argument('--output', help="json-file for all results")
+    parser.add_argument('--write', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--catalog', help=argparse.SUPPRESS)
+    parser.add_argument('--report', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.write is not None:
+        make_catalog(args.write, args.datadir, args.maxcsv)
+        return 0
+
+    if args.single is not None:
+        run_single(args.single, args.catalog, args.report)
+        return 0
+
+    if args.baseline is None:
+        args.baseline = os.path.join(args.datadir, 'baseline.json')
+
+    results = {}
+    reports = {}
+    for n in args.sizes:
+        catalog = write_catalog(n, args.datadir, args.maxcsv)
+        reportfile = os.path.join(args.datadir, 'report-%d.json' % n)
+
+        runs = []
+        for i in range(args.repeat):
+            runs.append(run_size(n, catalog, reportfile))
+        report = min(runs, key=lambda r: r['seconds'])
+        print("\n%d stars (best of %d runs, peak %.1f MB):"
+              % (n, len(runs), report['peak_mb'] or 0.))
+        print(format_stages(report))
+
+        reports[str(n)] = runs
+        results[str(n)] = stage_summary(runs)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=1)
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print("\nBaseline written to %s." % args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("\nNo baseline %s, create it with --update-baseline."
+              % args.baseline)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print("\nRegressions (threshold %d%%):" % (args.threshold*100))
+        for message in regressions:
+            print("  " + message)
+        return 1
+
+    print("\nNo regressions (threshold %d%%)." % (args.threshold*100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,711 @@
+"""
+Minimal in-process stand-in for the parts of Blender's bpy-module used
+by the scripts of this repository, for running benchmarks without
+Blender. Bulk data (vertex coordinates, shapekeys, attributes,
+keyframes) are stored in numpy arrays with foreach_get/foreach_set
+access, so the measured times show the cost of the Python and numpy
+code of the scripts, not of Blender itself.
+"""
+# Only what the scripts need is implemented; operators (bpy.ops) do
+# nothing. Don't use this for checking results in Blender.
+
+
+import types as _types
+import numpy as np
+
+
+class Collection(dict):
+    """Collection of datablocks by name (bpy.data.objects, ...),
+    new names get a suffix .001, .002, ... if needed
+    """
+
+    def __init__(self, factory):
+        dict.__init__(self)
+        self.factory = factory
+
+    def __iter__(self):
+        return iter(list(self.values()))
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.values())[key]
+        return dict.__getitem__(self, key)
+
+    def new(self, name, *args, **kwargs):
+        base = name
+        i = 0
+        while name in self:
+            i += 1
+            name = '%s.%03d' % (base, i)
+        idblock = self.factory(name, *args, **kwargs)
+        dict.__setitem__(self, name, idblock)
+        return idblock
+
+    def remove(self, idblock, do_unlink=True):
+        if self.get(idblock.name) is idblock:
+            dict.pop(self, idblock.name)
+        if isinstance(idblock, Object):
+            for scene in data.scenes.values():
+                if idblock in scene.objects:
+                    scene.objects.unlink(idblock)
+
+
+class ID(object):
+    """Datablock with name and custom properties"""
+
+    def __init__(self, name):
+        self._name = name
+        self._props = {}
+        self.animation_data = None
+        self.users = 0
+        self.use_fake_user = False
+
+    def _collection(self):
+        for collection in _collections():
+            if collection.get(self._name) is self:
+                return collection
+        return None
+
+    def _getname(self):
+        return self._name
+
+    def _setname(self, name):
+        collection = self._collection()
+        if collection is not None:
+            dict.pop(collection, self._name)
+            dict.__setitem__(collection, name, self)
+        self._name = name
+
+    name = property(_getname, _setname)
+
+    def __getitem__(self, key):
+        return self._props[key]
+
+    def __setitem__(self, key, value):
+        self._props[key] = value
+
+    def __delitem__(self, key):
+        del self._props[key]
+
+    def __contains__(self, key):
+        return key in self._props
+
+    def get(self, key, default=None):
+        return self._props.get(key, default)
+
+    def keys(self):
+        return self._props.keys()
+
+    def as_pointer(self):
+        return id(self)
+
+    def animation_data_create(self):
+        if self.animation_data is None:
+            self.animation_data = AnimData()
+        return self.animation_data
+
+    def animation_data_clear(self):
+        self.animation_data = None
+
+    def keyframe_insert(self, data_path, frame=0, index=-1):
+        insert_keyframe(self, self, data_path, frame)
+
+
+class AnimData(object):
+
+    def __init__(self):
+        self.action = None
+
+
+class ArrayProperty(object):
+    """Collection of elements with one array property (e.g. 'co'),
+    accessed in bulk with foreach_get/foreach_set
+    """
+
+    def __init__(self, n=0, size=3):
+        self.array = np.zeros((n, size), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.array)
+
+    def add(self, n):
+        self.array = np.concatenate([self.array,
+                                     np.zeros((n, self.array.shape[1]),
+                                              dtype=np.float32)])
+
+    def foreach_get(self, attr, seq):
+        seq[:] = self.array.reshape(-1)
+
+    def foreach_set(self, attr, seq):
+        self.array[:] = np.asarray(seq).reshape(self.array.shape)
+
+
+class Attributes(dict):
+
+    def __init__(self, mesh):
+        dict.__init__(self)
+        self.mesh = mesh
+
+    def new(self, name, type, domain):
+        attr = _types.SimpleNamespace(name=name, data_type=type,
+                                      domain=domain,
+                                      data=ArrayProperty(
+                                          len(self.mesh.vertices), 1))
+        self[name] = attr
+        return attr
+
+
+class Mesh(ID):
+
+    def __init__(self, name):
+        ID.__init__(self, name)
+        self.vertices = ArrayProperty()
+        self.materials = []
+        self.shape_keys = None
+        self.attributes = Attributes(self)
+
+    def from_pydata(self, vertices, edges, faces):
+        coords = np.asarray(vertices, dtype=np.float32).reshape(-1, 3)
+        self.vertices = ArrayProperty(len(coords))
+        self.vertices.array[:] = coords
+        self.polygons = list(faces)
+
+    def update(self):
+        pass
+
+
+class KeyBlock(object):
+
+    def __init__(self, name, coords, key):
+        self.name = name
+        self.data = ArrayProperty(len(coords))
+        self.data.array[:] = coords
+        self.id_data = key
+        self.value = 0.
+        self.slider_min = 0.
+        self.slider_max = 1.
+        self.mute = False
+        self.interpolation = 'KEY_LINEAR'
+        self.relative_key = self
+
+    def keyframe_insert(self, data_path, frame=0, index=-1):
+        insert_keyframe(self.id_data, self,
+                        'key_blocks["%s"].%s' % (self.name, data_path),
+                        frame, attr=data_path)
+
+
+class Key(ID):
+
+    def __init__(self, name):
+        ID.__init__(self, name)
+        self.key_blocks = Collection(None)
+        self.use_relative = True
+
+    @property
+    def reference_key(self):
+        if len(self.key_blocks) == 0:
+            return None
+        return list(self.key_blocks.values())[0]
+
+
+class Modifiers(list):
+
+    def new(self, name, type):
+        modifier = _types.SimpleNamespace(name=name, type=type,
+                                          node_group=None)
+        self.append(modifier)
+        return modifier
+
+
+class Object(ID):
+
+    def __init__(self, name, object_data=None):
+        ID.__init__(self, name)
+        self.data = object_data
+        self.location = (0, 0, 0)
+        self.select = False
+        self.hide = False
+        self.hide_viewport = False
+        self.hide_render = False
+        self.hide_select = False
+        self.material_slots = []
+        self.active_shape_key_index = 0
+        self.modifiers = Modifiers()
+        self.constraints = []
+        if object_data is not None:
+            object_data.users += 1
+
+    @property
+    def type(self):
+        return 'MESH' if isinstance(self.data, Mesh) else 'EMPTY'
+
+    def shape_key_add(self, name='Key', from_mix=True):
+        m = self.data
+        if m.shape_keys is None:
+            m.shape_keys = data.shape_keys.new('Key')
+        keyblocks = m.shape_keys.key_blocks
+        reference = m.shape_keys.reference_key
+        if reference is None:
+            coords = m.vertices.array
+        else:
+            coords = reference.data.array
+        keyblock = KeyBlock(name, coords, m.shape_keys)
+        if reference is not None:
+            keyblock.relative_key = reference
+        dict.__setitem__(keyblocks, name, keyblock)
+        return keyblock
+
+    def shape_key_clear(self):
+        self.data.shape_keys = None
+
+
+class Keyframe(object):
+    """One keyframe point, a view into the arrays of KeyframePoints"""
+
+    def __init__(self, points, i):
+        self._points = points
+        self._i = i
+
+    co = property(lambda self: self._points.arrays['co'][self._i])
+    handle_left = property(
+        lambda self: self._points.arrays['handle_left'][self._i])
+    handle_right = property(
+        lambda self: self._points.arrays['handle_right'][self._i])
+
+
+def _enum_property(attr, items):
+    """Property of Keyframe for an enum, stored as its value"""
+
+    def getter(self):
+        return _enum_name(items, self._points.enums[attr][self._i])
+
+    def setter(self, value):
+        self._points.enums[attr][self._i] = items[value]
+
+    return property(getter, setter)
+
+
+# Enum values as in Blender (rna_enum_beztriple_interpolation_mode_items)
+INTERPOLATIONS = {'CONSTANT': 0, 'LINEAR': 1, 'BEZIER': 2, 'BACK': 3,
+                  'BOUNCE': 4, 'CIRC': 5, 'CUBIC': 6, 'ELASTIC': 7,
+                  'EXPO': 8, 'QUAD': 9, 'QUART': 10, 'QUINT': 11, 'SINE': 12}
+EASINGS = {'AUTO': 0, 'EASE_IN': 1, 'EASE_OUT': 2, 'EASE_IN_OUT': 3}
+HANDLE_TYPES = {'FREE': 0, 'AUTO': 1, 'VECTOR': 2, 'ALIGNED': 3,
+                'AUTO_CLAMPED': 4}
+
+
+def _enum_name(items, value):
+    for name, item in items.items():
+        if item == value:
+            return name
+    raise ValueError("Unknown enum value %d" % value)
+
+
+KEYFRAME_ARRAYS = ('co', 'handle_left', 'handle_right')
+
+# Enum attributes of keyframes, with their items and default values
+KEYFRAME_ENUMS = {'interpolation': (INTERPOLATIONS, 'BEZIER'),
+                  'easing': (EASINGS, 'AUTO'),
+                  'handle_left_type': (HANDLE_TYPES, 'AUTO_CLAMPED'),
+                  'handle_right_type': (HANDLE_TYPES, 'AUTO_CLAMPED')}
+
+for _attr, (_items, _default) in KEYFRAME_ENUMS.items():
+    setattr(Keyframe, _attr, _enum_property(_attr, _items))
+
+
+class KeyframePoints(object):
+
+    def __init__(self):
+        self.arrays = dict((attr, np.zeros((0, 2), dtype=np.float32))
+                           for attr in KEYFRAME_ARRAYS)
+        self.enums = dict((attr, np.zeros(0, dtype=np.int32))
+                          for attr in KEYFRAME_ENUMS)
+
+    def __len__(self):
+        return len(self.arrays['co'])
+
+    def __iter__(self):
+        return (Keyframe(self, i) for i in range(len(self)))
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return Keyframe(self, i)
+
+    def _select(self, index):
+        for attr in KEYFRAME_ARRAYS:
+            self.arrays[attr] = self.arrays[attr][index]
+        for attr in KEYFRAME_ENUMS:
+            self.enums[attr] = self.enums[attr][index]
+
+    def add(self, count=1):
+        for attr in KEYFRAME_ARRAYS:
+            self.arrays[attr] = np.concatenate(
+                [self.arrays[attr], np.zeros((count, 2), dtype=np.float32)])
+        for attr, (items, default) in KEYFRAME_ENUMS.items():
+            self.enums[attr] = np.concatenate(
+                [self.enums[attr],
+                 np.full(count, items[default], dtype=np.int32)])
+
+    def insert(self, frame, value, options=set()):
+        co = self.arrays['co']
+        existing = np.nonzero(co[:, 0] == frame)[0]
+        if len(existing):
+            i = existing[0]
+        else:
+            self.add(1)
+            i = len(self) - 1
+        self.arrays['co'][i] = (frame, value)
+        self.arrays['handle_left'][i] = (frame - 1, value)
+        self.arrays['handle_right'][i] = (frame + 1, value)
+        self._sort()
+        return Keyframe(self, int(np.nonzero(self.arrays['co'][:, 0]
+                                             == frame)[0][0]))
+
+    def _sort(self):
+        self._select(np.argsort(self.arrays['co'][:, 0], kind='stable'))
+
+    def remove(self, keyframe, fast=False):
+        self._select(np.arange(len(self)) != keyframe._i)
+
+    def clear(self):
+        self.__init__()
+
+    def foreach_get(self, attr, seq):
+        if attr in KEYFRAME_ENUMS:
+            seq[:] = self.enums[attr]
+        else:
+            seq[:] = self.arrays[attr].reshape(-1)
+
+    def foreach_set(self, attr, seq):
+        if attr in KEYFRAME_ENUMS:
+            self.enums[attr][:] = np.asarray(seq)
+        else:
+            array = self.arrays[attr]
+            array[:] = np.asarray(seq).reshape(array.shape)
+
+    def _calc_handles(self):
+        """Set auto and vector handles from the neighbouring keyframes,
+        similar to Blender (BKE_nurb_handle_calc for fcurves)
+        """
+
+        co = self.arrays['co'].astype(np.float64)
+        n = len(co)
+        if n < 2:
+            return
+
+        # Neighbours, mirrored at the ends
+        prev = np.empty_like(co)
+        prev[1:] = co[:-1]
+        prev[0] = 2*co[0] - co[1]
+        nxt = np.empty_like(co)
+        nxt[:-1] = co[1:]
+        nxt[-1] = 2*co[-1] - co[-2]
+
+        dveca = co - prev
+        dvecb = nxt - co
+        lena = np.where(dveca[:, 0] != 0, dveca[:, 0], 1.)
+        lenb = np.where(dvecb[:, 0] != 0, dvecb[:, 0], 1.)
+        tvec = dvecb/lenb[:, None] + dveca/lena[:, None]
+        length = tvec[:, 0]*2.5614
+        length = np.where(length != 0, length, 1.)
+
+        left = co - tvec*(lena/length)[:, None]
+        right = co + tvec*(lenb/length)[:, None]
+
+        # Auto clamped: flat handles at extremes
+        ydiff1 = prev[:, 1] - co[:, 1]
+        ydiff2 = nxt[:, 1] - co[:, 1]
+        extreme = (((ydiff1 <= 0) & (ydiff2 <= 0))
+                   | ((ydiff1 >= 0) & (ydiff2 >= 0)))
+        extreme[[0, -1]] = False
+
+        vleft = co + (prev - co)/3.
+        vright = co + (nxt - co)/3.
+
+        for attr, handle, vector, typeattr in (
+                ('handle_left', left, vleft, 'handle_left_type'),
+                ('handle_right', right, vright, 'handle_right_type')):
+            types = self.enums[typeattr]
+            handle = handle.copy()
+            clamped = extreme & (types == HANDLE_TYPES['AUTO_CLAMPED'])
+            handle[clamped, 1] = co[clamped, 1]
+            auto = ((types == HANDLE_TYPES['AUTO'])
+                    | (types == HANDLE_TYPES['AUTO_CLAMPED']))
+            array = self.arrays[attr]
+            array[auto] = handle[auto]
+            isvector = types == HANDLE_TYPES['VECTOR']
+            array[isvector] = vector[isvector]
+
+
+class FCurve(object):
+
+    def __init__(self, data_path, index=0, action_group=''):
+        self.data_path = data_path
+        self.array_index = index
+        self.group = action_group
+        self.keyframe_points = KeyframePoints()
+        self.modifiers = []
+        self.extrapolation = 'CONSTANT'
+
+    def update(self):
+        self.keyframe_points._sort()
+        self.keyframe_points._calc_handles()
+
+    def evaluate(self, frame):
+        """Value at frame; CONSTANT, LINEAR and BEZIER segments as in
+        Blender, the other interpolations (easings) linear
+        """
+
+        points = self.keyframe_points
+        co = points.arrays['co']
+        if len(co) == 0:
+            return 0.
+        if frame <= co[0, 0]:
+            return float(co[0, 1])
+        if frame >= co[-1, 0]:
+            return float(co[-1, 1])
+
+        i = int(np.searchsorted(co[:, 0], frame, side='right')) - 1
+        interp = points.enums['interpolation'][i]
+        (x0, y0), (x3, y3) = co[i].tolist(), co[i + 1].tolist()
+        if interp == INTERPOLATIONS['CONSTANT']:
+            return float(y0)
+        if interp != INTERPOLATIONS['BEZIER']:
+            return float(y0 + (frame - x0)*(y3 - y0)/(x3 - x0))
+
+        # Handles shortened as in Blender (BKE_fcurve_correct_bezpart),
+        # so that x(t) is monotonic
+        x1, y1 = points.arrays['handle_right'][i].tolist()
+        x2, y2 = points.arrays['handle_left'][i + 1].tolist()
+        hlength = abs(x0 - x1) + abs(x3 - x2)
+        if hlength > x3 - x0:
+            fac = (x3 - x0)/hlength
+            x1, y1 = x0 - fac*(x0 - x1), y0 - fac*(y0 - y1)
+            x2, y2 = x3 - fac*(x3 - x2), y3 - fac*(y3 - y2)
+
+        lo, hi = 0., 1.
+        for iteration in range(50):
+            t = 0.5*(lo + hi)
+            s = 1. - t
+            x = s*s*s*x0 + 3*s*s*t*x1 + 3*s*t*t*x2 + t*t*t*x3
+            if x < frame:
+                lo = t
+            else:
+                hi = t
+        t = 0.5*(lo + hi)
+        s = 1. - t
+
+        return float(s*s*s*y0 + 3*s*s*t*y1 + 3*s*t*t*y2 + t*t*t*y3)
+
+
+class FCurves(list):
+
+    def new(self, data_path, index=0, action_group=''):
+        fcurve = FCurve(data_path, index, action_group)
+        self.append(fcurve)
+        return fcurve
+
+    def find(self, data_path, index=0):
+        for fcurve in self:
+            if fcurve.data_path == data_path and fcurve.array_index == index:
+                return fcurve
+        return None
+
+
+class Action(ID):
+
+    def __init__(self, name):
+        ID.__init__(self, name)
+        self.fcurves = FCurves()
+
+
+def insert_keyframe(idblock, owner, data_path, frame, attr=None):
+    """Insert keyframe for the current value of the property"""
+
+    if attr is None:
+        attr = data_path
+    animdata = idblock.animation_data_create()
+    if animdata.action is None:
+        animdata.action = data.actions.new(idblock.name + 'Action')
+    fcurves = animdata.action.fcurves
+    fcurve = fcurves.find(data_path) or fcurves.new(data_path)
+    fcurve.keyframe_points.insert(frame, getattr(owner, attr))
+
+
+class Node(object):
+
+    def __init__(self, bl_idname):
+        self.bl_idname = bl_idname
+        self.name = bl_idname
+        self.inputs = Sockets()
+        self.outputs = Sockets()
+        self.color_ramp = _types.SimpleNamespace(
+            interpolation='LINEAR',
+            elements=RampElements([
+                _types.SimpleNamespace(position=0., color=[0, 0, 0, 1]),
+                _types.SimpleNamespace(position=1., color=[1, 1, 1, 1])]))
+
+
+class Sockets(dict):
+
+    def __getitem__(self, key):
+        if key not in self:
+            dict.__setitem__(self, key,
+                             _types.SimpleNamespace(default_value=None))
+        return dict.__getitem__(self, key)
+
+    def new(self, type, name):
+        return self[name]
+
+
+class RampElements(list):
+
+    def new(self, position):
+        element = _types.SimpleNamespace(position=position,
+                                         color=[0, 0, 0, 1])
+        self.append(element)
+        self.sort(key=lambda e: e.position)
+        return element
+
+
+class Nodes(list):
+
+    def new(self, type):
+        node = Node(type)
+        self.append(node)
+        return node
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list.__getitem__(self, key)
+        for node in self:
+            if node.name == key:
+                return node
+        raise KeyError(key)
+
+    def clear(self):
+        del self[:]
+
+
+class Links(list):
+
+    def new(self, output, input):
+        self.append((output, input))
+
+
+class NodeTree(ID):
+
+    def __init__(self, name, type='ShaderNodeTree'):
+        ID.__init__(self, name)
+        self.nodes = Nodes()
+        self.links = Links()
+        self.inputs = Sockets()
+        self.outputs = Sockets()
+
+
+class Material(ID):
+
+    def __init__(self, name):
+        ID.__init__(self, name)
+        self.diffuse_color = [0., 0., 0.]
+        self.type = 'SURFACE'
+        self.halo = _types.SimpleNamespace(size=0.)
+        self.use_nodes = False
+        self.node_tree = NodeTree(name)
+
+
+class Texture(ID):
+
+    def __init__(self, name, type='NONE'):
+        ID.__init__(self, name)
+        self.type = type
+
+
+class SceneObjects(list):
+
+    def link(self, obj):
+        self.append(obj)
+
+    def unlink(self, obj):
+        self.remove(obj)
+
+
+class Scene(ID):
+
+    def __init__(self, name):
+        ID.__init__(self, name)
+        self.objects = SceneObjects()
+        self.objects.active = None
+        self.frame_start = 1
+        self.frame_current = 1
+        self.frame_end = 250
+
+
+data = _types.SimpleNamespace()
+data.objects = Collection(Object)
+data.meshes = Collection(Mesh)
+data.materials = Collection(Material)
+data.actions = Collection(Action)
+data.shape_keys = Collection(Key)
+data.node_groups = Collection(NodeTree)
+data.textures = Collection(Texture)
+data.scenes = Collection(Scene)
+data.filepath = ''
+
+
+def _collections():
+    return (data.objects, data.meshes, data.materials, data.actions,
+            data.shape_keys, data.node_groups, data.textures, data.scenes)
+
+
+def _batch_remove(ids):
+    for idblock in list(ids):
+        collection = idblock._collection()
+        if collection is not None:
+            collection.remove(idblock)
+
+
+data.batch_remove = _batch_remove
+
+context = _types.SimpleNamespace(scene=data.scenes.new('Scene'),
+                                 selected_objects=[], object=None)
+
+
+class _Operators(object):
+    """bpy.ops: every operator does nothing"""
+
+    def __getattr__(self, name):
+        return _Operators()
+
+    def __call__(self, *args, **kwargs):
+        return {'FINISHED'}
+
+
+ops = _Operators()
+
+
+def _persistent(function):
+    function._bpy_persistent = None
+    return function
+
+
+# Blender 2.7x, running in background mode (no timers)
+app = _types.SimpleNamespace(version=(2, 79, 0), background=True,
+                             driver_namespace={},
+                             handlers=_types.SimpleNamespace(
+                                 render_pre=[], render_post=[],
+                                 render_cancel=[], frame_change_pre=[],
+                                 persistent=_persistent))
+
+types = _types.SimpleNamespace()
+
+
+def reset():
+    """Remove all datablocks, e.g. between benchmark runs"""
+
+    for collection in _collections():
+        if collection is not data.scenes:
+            dict.clear(collection)
+    context.scene.objects[:] = []
+    context.scene._props.clear()
@@ -0,0 +1,23 @@
+"""
+Minimal stand-in for Blender's mathutils-module, see bpy.py
+"""
+
+
+class Vector(tuple):
+
+    def __new__(cls, values):
+        return tuple.__new__(cls, values)
+
+    x = property(lambda self: self[0])
+    y = property(lambda self: self[1])
+    z = property(lambda self: self[2])
+
+
+class Color(tuple):
+
+    def __new__(cls, values):
+        return tuple.__new__(cls, values)
+
+    r = property(lambda self: self[0])
+    g = property(lambda self: self[1])
+    b = property(lambda self: self[2])
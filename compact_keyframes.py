@@ -0,0 +1,557 @@
+#!BPY
+
+""" Remove redundant keyframes, which hardly change the animation,
+e.g. repeated identical values or keyframes on a straight line
+between their neighbours, so that fcurves are faster to evaluate.
+"""
+#
+# A keyframe is removed, if the curve without it differs from the
+# original curve by less than the tolerance (in units of the animated
+# value):
+# - flat keyframes: the values (and the relevant bezier handles) of the
+#   keyframe, its neighbours and all keyframes removed between them lie
+#   within the tolerance, so the curve stays within this band
+# - linear keyframes: the segments to both neighbours are LINEAR and all
+#   keyframes removed between them are within the tolerance of the
+#   straight line from one neighbour to the other
+# The first and last keyframe are only removed from curves with constant
+# extrapolation. Curves with fcurve-modifiers are left alone.
+#
+# The keyframes of each fcurve are checked at once with numpy, for every
+# second keyframe in turn, so the checks of removed keyframes do not
+# depend on each other; this is repeated until nothing changes.
+#
+# The remaining keyframes are written back at once and Blender
+# recalculates their automatic handles, which changes the bezier
+# segments next to removed keyframes. Around the removed keyframes,
+# the curve is compared with the original one at each original
+# keyframe and at samples in between, evaluated with numpy from the
+# keyframes and handles. For each segment which changed by more than
+# the tolerance, the removed keyframes right next to its two ends are
+# put back, which gives these ends their original handles, and the
+# check is repeated until the curve is within the tolerance.
+
+
+import os
+import sys
+import numpy as np
+
+# Make the helper modules next to this script importable,
+# also when running it from within Blender
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import profiling
+from shift_keyframes import get_actions_for_objects, INTERPOLATIONS
+
+
+CONSTANT = INTERPOLATIONS['CONSTANT']
+LINEAR = INTERPOLATIONS['LINEAR']
+BEZIER = INTERPOLATIONS['BEZIER']
+
+# These go beyond the values of their keyframes, so the curve may leave
+# the band of a flat keyframe
+OVERSHOOTING = (INTERPOLATIONS['BACK'], INTERPOLATIONS['ELASTIC'])
+
+# Handle types recalculated by Blender (AUTO, VECTOR, AUTO_CLAMPED)
+AUTO_HANDLES = (1, 2, 4)
+
+# Attributes of keyframes, which are copied when writing the remaining
+# keyframes, with number of values per keyframe and type
+KEYFRAME_ATTRIBUTES = (('co', 2, np.float32),
+                       ('handle_left', 2, np.float32),
+                       ('handle_right', 2, np.float32),
+                       ('interpolation', 1, np.int32),
+                       ('easing', 1, np.int32),
+                       ('handle_left_type', 1, np.int32),
+                       ('handle_right_type', 1, np.int32),
+                       ('type', 1, np.int32),
+                       ('back', 1, np.float32),
+                       ('amplitude', 1, np.float32),
+                       ('period', 1, np.float32))
+
+# Positions of the samples between two original keyframes, at which
+# the curve is compared after removing keyframes
+CHECK_SAMPLES = (0., 0.25, 0.5, 0.75)
+
+# Bisection steps for finding the curve parameter of a frame within a
+# bezier segment, see bezier_values()
+BEZIER_STEPS = 40
+
+
+def read_keyframes(fcurve):
+    """Return dictionary of arrays with frames, values, values of the
+    left and right handles and interpolations of all keyframes
+    """
+
+    points = fcurve.keyframe_points
+    n = len(points)
+
+    arrays = {}
+    for attr in ('co', 'handle_left', 'handle_right'):
+        values = np.empty(n*2, dtype=np.float32)
+        points.foreach_get(attr, values)
+        arrays[attr] = values.reshape(-1, 2).astype(np.float64)
+    interpolation = np.empty(n, dtype=np.int32)
+    points.foreach_get('interpolation', interpolation)
+
+    return {'frame': arrays['co'][:, 0],
+            'value': arrays['co'][:, 1],
+            'left': arrays['handle_left'][:, 1],
+            'right': arrays['handle_right'][:, 1],
+            'interpolation': interpolation}
+
+
+def value_bands(keys):
+    """Return lowest and highest value of each keyframe and its handles,
+    as far as the handles shape the curve (bezier segments)
+    """
+
+    value = keys['value']
+    interp = keys['interpolation']
+
+    # Left handle is used, if the segment before the keyframe is bezier,
+    # right handle, if the segment after it is
+    useleft = np.zeros(len(value), dtype=bool)
+    useleft[1:] = interp[:-1] == BEZIER
+    useright = interp == BEZIER
+
+    lo = value.copy()
+    hi = value.copy()
+    for handle, use in ((keys['left'], useleft), (keys['right'], useright)):
+        lo[use] = np.minimum(lo[use], handle[use])
+        hi[use] = np.maximum(hi[use], handle[use])
+
+    return lo, hi
+
+
+def removable_keyframes(keys, current, candidates, tolerance, ends=True):
+    """Return mask of the candidates which can be removed from the
+    current keyframes, see top of this file
+
+    keys -- original keyframes, see read_keyframes()
+    current -- sorted indexes of the remaining keyframes
+    candidates -- positions in current to be checked; no two of them
+                  may be neighbours
+    tolerance -- allowed change of the curve
+    ends -- check first and last keyframe as well
+    """
+
+    frame, value = keys['frame'], keys['value']
+    interp = keys['interpolation']
+    lo, hi = value_bands(keys)
+    m = len(current)
+    n = len(value)
+
+    # Each candidate stands for the segments to both of its neighbours;
+    # segment j is between current[j-1] and current[j], segment 0 is
+    # before the first and segment m after the last keyframe
+    owner = np.full(m + 1, -1)
+    owner[candidates] = candidates
+    owner[candidates + 1] = candidates
+
+    # Removed keyframes between the neighbours of each candidate
+    removed = np.ones(n, dtype=bool)
+    removed[current] = False
+    inner = np.nonzero(removed)[0]
+    innerowner = owner[np.searchsorted(current, inner, side='right')]
+    inner = inner[innerowner >= 0]
+    innerowner = innerowner[innerowner >= 0]
+
+    # Keyframes of each candidate range, as (position, original index):
+    # the removed ones, the candidate itself and its left neighbour,
+    # whose interpolation shapes the segment to the right neighbour
+    hasleft = candidates > 0
+    hasright = candidates < m - 1
+    rangepos = np.concatenate([innerowner, candidates, candidates[hasleft]])
+    rangekeys = np.concatenate([inner, current[candidates],
+                                current[candidates[hasleft] - 1]])
+
+    # Flat: everything between the neighbours within the tolerance
+    bandlo = np.full(m, np.inf)
+    bandhi = np.full(m, -np.inf)
+    np.minimum.at(bandlo, rangepos, lo[rangekeys])
+    np.maximum.at(bandhi, rangepos, hi[rangekeys])
+
+    overshoot = np.zeros(m, dtype=int)
+    np.add.at(overshoot, rangepos,
+              np.isin(interp[rangekeys], OVERSHOOTING).astype(int))
+
+    right = current[candidates[hasright] + 1]
+    np.minimum.at(bandlo, candidates[hasright], lo[right])
+    np.maximum.at(bandhi, candidates[hasright], hi[right])
+
+    # New segment from the left neighbour to the right one, with the
+    # interpolation of the left neighbour
+    both = hasleft & hasright
+    left = current[candidates[both] - 1]
+    right = current[candidates[both] + 1]
+    newbezier = interp[left] == BEZIER
+    pos = candidates[both][newbezier]
+    for handles in (keys['right'][left[newbezier]],
+                    keys['left'][right[newbezier]]):
+        np.minimum.at(bandlo, pos, handles)
+        np.maximum.at(bandhi, pos, handles)
+
+    flat = (bandhi[candidates] - bandlo[candidates] <= tolerance)
+    flat &= overshoot[candidates] == 0
+
+    # Linear: all segments between the neighbours linear, and the
+    # removed keyframes near the straight line between them
+    nonlinear = np.zeros(m, dtype=int)
+    np.add.at(nonlinear, rangepos, (interp[rangekeys] != LINEAR).astype(int))
+
+    pos = np.full(m, -1)
+    pos[candidates[both]] = np.arange(np.count_nonzero(both))
+    rangeline = pos[rangepos]
+    use = rangeline >= 0
+    k = rangekeys[use]
+    i = rangeline[use]
+    t0, t1 = frame[left][i], frame[right][i]
+    v0, v1 = value[left][i], value[right][i]
+    dt = np.where(t1 > t0, t1 - t0, 1.)
+    line = v0 + (frame[k] - t0)*(v1 - v0)/dt
+    deviation = np.zeros(m)
+    np.maximum.at(deviation, rangepos[use], np.abs(value[k] - line))
+
+    linear = np.zeros(len(candidates), dtype=bool)
+    linear[both] = ((nonlinear[candidates[both]] == 0)
+                    & (deviation[candidates[both]] <= tolerance))
+
+    result = flat | linear
+    if not ends:
+        result &= both
+
+    return result
+
+
+def read_keyframe_arrays(points, attrs=None):
+    """Return dictionary with arrays of shape (n, size) of all
+    attributes of the n keyframes (see KEYFRAME_ATTRIBUTES), which are
+    available in this Blender version
+
+    points -- keyframe_points of an fcurve
+    attrs -- names of the attributes to be read (default: all)
+    """
+
+    n = len(points)
+    arrays = {}
+    for attr, size, dtype in KEYFRAME_ATTRIBUTES:
+        if attrs is not None and attr not in attrs:
+            continue
+        if n and not hasattr(points[0], attr):
+            continue
+        values = np.empty(n*size, dtype=dtype)
+        points.foreach_get(attr, values)
+        arrays[attr] = values.reshape(n, size)
+
+    return arrays
+
+
+def rebuild_keyframes(fcurve, arrays, keep):
+    """Replace all keyframes of the fcurve by the kept ones at once,
+    then let Blender sort them and recalculate their handles
+
+    fcurve -- fcurve to be changed
+    arrays -- attributes of the original keyframes,
+              see read_keyframe_arrays()
+    keep -- sorted indexes of the kept keyframes
+    """
+
+    points = fcurve.keyframe_points
+    if hasattr(points, 'clear'):
+        points.clear()
+        points.add(len(keep))
+    else:
+        # Older versions: add missing keyframes or remove surplus ones
+        # from the end, which is cheap, and overwrite all of them
+        if len(points) < len(keep):
+            points.add(len(keep) - len(points))
+        for i in range(len(points) - 1, len(keep) - 1, -1):
+            points.remove(points[i], fast=True)
+
+    for attr, values in arrays.items():
+        points.foreach_set(attr, np.ascontiguousarray(values[keep].ravel()))
+
+    fcurve.update()
+
+
+def index_ranges(n, lo, hi):
+    """Return mask of the indexes 0..n-1 within any of the ranges
+    lo[i] <= index <= hi[i]
+    """
+
+    counts = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(counts, lo, 1)
+    np.add.at(counts, hi + 1, -1)
+
+    return np.cumsum(counts[:-1]) > 0
+
+
+def check_frames(frame, current):
+    """Return frames for comparing the curve before and after removing
+    keyframes: the original keyframes and the samples between them (see
+    CHECK_SAMPLES) around each removed keyframe, from the second kept
+    keyframe before it to the second one after it, since the handles of
+    its kept neighbours change
+
+    frame -- frames of the original keyframes
+    current -- sorted indexes of the remaining keyframes
+    """
+
+    n = len(frame)
+    m = len(current)
+    removed = np.setdiff1d(np.arange(n), current)
+
+    # Kept keyframes before and after each removed one: current[pos-1]
+    # and current[pos]
+    pos = np.searchsorted(current, removed)
+    lo = np.where(pos >= 2, current[np.maximum(pos - 2, 0)], 0)
+    hi = np.where(pos + 1 < m, current[np.minimum(pos + 1, m - 1)], n - 1)
+
+    # Original keyframes in these ranges and samples after each of them
+    # (except the last one of a range)
+    keys = np.nonzero(index_ranges(n, lo, hi))[0]
+    starts = np.nonzero(index_ranges(n, lo, np.maximum(hi - 1, lo)))[0]
+    starts = starts[starts < n - 1]
+    step = frame[starts + 1] - frame[starts]
+    samples = [frame[starts] + t*step for t in CHECK_SAMPLES if t > 0]
+
+    return np.unique(np.concatenate([frame[keys]] + samples))
+
+
+def bezier_values(p0, p1, p2, p3, frames):
+    """Return values of bezier segments at the frames, one frame per
+    segment. The handles are shortened as in Blender
+    (BKE_fcurve_correct_bezpart), so that a segment does not loop back,
+    and the curve parameter of each frame is found by bisection.
+
+    p0, p3 -- arrays of shape (n, 2) with the keyframes at both ends
+    p1, p2 -- arrays of shape (n, 2) with the right handle of p0 and
+              the left handle of p3
+    frames -- array of n frames
+    """
+
+    h1 = p0 - p1
+    h2 = p3 - p2
+    length = p3[:, 0] - p0[:, 0]
+    hlength = np.abs(h1[:, 0]) + np.abs(h2[:, 0])
+    fac = np.where(hlength > length,
+                   length/np.where(hlength > 0, hlength, 1.), 1.)
+    p1 = p0 - fac[:, None]*h1
+    p2 = p3 - fac[:, None]*h2
+
+    lo = np.zeros(len(frames))
+    hi = np.ones(len(frames))
+    for step in range(BEZIER_STEPS):
+        t = 0.5*(lo + hi)
+        s = 1. - t
+        x = (s*s*s*p0[:, 0] + 3*s*s*t*p1[:, 0] + 3*s*t*t*p2[:, 0]
+             + t*t*t*p3[:, 0])
+        below = x < frames
+        lo = np.where(below, t, lo)
+        hi = np.where(below, hi, t)
+    t = 0.5*(lo + hi)
+    s = 1. - t
+
+    return (s*s*s*p0[:, 1] + 3*s*s*t*p1[:, 1] + 3*s*t*t*p2[:, 1]
+            + t*t*t*p3[:, 1])
+
+
+def evaluate_keyframes(co, left, right, interp, frames):
+    """Return values of the curve through the keyframes at the frames,
+    with constant extrapolation, and mask of the frames evaluated: only
+    CONSTANT, LINEAR and BEZIER segments are, the other interpolations
+    (easings) are left to fcurve.evaluate()
+
+    co, left, right -- arrays of shape (n, 2) with the sorted keyframes
+                       and their left and right handles
+    interp -- interpolations of the keyframes
+    frames -- frames to be evaluated
+    """
+
+    co = co.astype(np.float64)
+    values = np.empty(len(frames))
+    if len(co) == 1:
+        values[:] = co[0, 1]
+        return values, np.ones(len(frames), dtype=bool)
+
+    values[frames <= co[0, 0]] = co[0, 1]
+    values[frames >= co[-1, 0]] = co[-1, 1]
+    inside = (frames > co[0, 0]) & (frames < co[-1, 0])
+
+    # Segment of each frame, from keyframe i to i+1
+    i = np.clip(np.searchsorted(co[:, 0], frames, side='right') - 1,
+                0, len(co) - 2)
+    kind = interp[i]
+    x0, y0 = co[i, 0], co[i, 1]
+    x3, y3 = co[i + 1, 0], co[i + 1, 1]
+
+    constant = inside & (kind == CONSTANT)
+    values[constant] = y0[constant]
+
+    linear = inside & (kind == LINEAR)
+    dt = np.where(x3 > x0, x3 - x0, 1.)
+    values[linear] = (y0 + (frames - x0)*(y3 - y0)/dt)[linear]
+
+    bezier = inside & (kind == BEZIER)
+    k = i[bezier]
+    values[bezier] = bezier_values(co[k], right[k].astype(np.float64),
+                                   left[k + 1].astype(np.float64),
+                                   co[k + 1], frames[bezier])
+
+    return values, ~inside | constant | linear | bezier
+
+
+def evaluate_fcurve(fcurve, co, left, right, interp, frames):
+    """Return values of the fcurve at the frames: see
+    evaluate_keyframes(), the frames in segments with other
+    interpolations are evaluated by Blender
+    """
+
+    values, evaluated = evaluate_keyframes(co, left, right, interp, frames)
+    others = np.nonzero(~evaluated)[0]
+    values[others] = [fcurve.evaluate(frames[i]) for i in others]
+
+    return values
+
+
+def restore_keyframes(frame, current, frames):
+    """Return indexes of the removed keyframes, which are put back
+    because the curve changed too much at the given frames: for each
+    frame, the removed keyframes right before and after both ends of
+    its segment, since the handles of a keyframe depend on its
+    neighbours. The check is repeated with them, so that only as many
+    keyframes come back as needed.
+
+    frame -- frames of the original keyframes
+    current -- sorted indexes of the remaining keyframes
+    frames -- frames at which the curve changed too much
+    """
+
+    n = len(frame)
+    m = len(current)
+
+    # Segment j is between current[j-1] and current[j]
+    j = np.searchsorted(frame[current], frames, side='right')
+    ends = np.concatenate([current[j[j >= 1] - 1], current[j[j < m]]])
+    near = np.concatenate([ends - 1, ends + 1])
+    near = near[(near >= 0) & (near < n)]
+
+    return np.setdiff1d(near, current)
+
+
+def compact_fcurve(fcurve, tolerance=1.e-4):
+    """Remove redundant keyframes of the fcurve, see top of this file.
+    Return the number of removed keyframes.
+
+    fcurve -- fcurve to be compacted
+    tolerance -- allowed change of the evaluated curve
+    """
+
+    points = fcurve.keyframe_points
+    n = len(points)
+    if n < 2 or len(fcurve.modifiers) > 0:
+        return 0
+
+    keys = read_keyframes(fcurve)
+    ends = fcurve.extrapolation == 'CONSTANT'
+
+    # Check every second keyframe in turn, until nothing changes
+    current = np.arange(n)
+    unchanged = 0
+    parity = 0
+    while unchanged < 2 and len(current) > 1:
+        candidates = np.arange(parity, len(current), 2)
+        remove = removable_keyframes(keys, current, candidates, tolerance,
+                                     ends=ends)
+        if np.any(remove):
+            current = np.delete(current, candidates[remove])
+            unchanged = 0
+        else:
+            unchanged += 1
+        parity = 1 - parity
+
+    if len(current) == n:
+        return 0
+
+    arrays = read_keyframe_arrays(points)
+    interp = arrays['interpolation'][:, 0]
+    handletypes = [arrays[attr][:, 0] for attr
+                   in ('handle_left_type', 'handle_right_type')
+                   if attr in arrays]
+    recalculated = (not handletypes
+                    or any(np.isin(types, AUTO_HANDLES).any()
+                           for types in handletypes))
+    if not (recalculated and np.any(interp == BEZIER)):
+        # The recalculated handles don't change the curve
+        rebuild_keyframes(fcurve, arrays, current)
+        return n - len(current)
+
+    # Compare the curve before and after around the removed keyframes,
+    # put back removed keyframes until it is within the tolerance
+    frames = check_frames(keys['frame'], current)
+    before = evaluate_fcurve(fcurve, arrays['co'], arrays['handle_left'],
+                             arrays['handle_right'], interp, frames)
+    while True:
+        rebuild_keyframes(fcurve, arrays, current)
+        handles = read_keyframe_arrays(points,
+                                       ('handle_left', 'handle_right'))
+        after = evaluate_fcurve(fcurve, arrays['co'][current],
+                                handles['handle_left'],
+                                handles['handle_right'], interp[current],
+                                frames)
+        changed = frames[np.abs(after - before) > tolerance]
+        restore = restore_keyframes(keys['frame'], current, changed)
+        if len(restore) == 0:
+            break
+        current = np.union1d(current, restore)
+
+    return n - len(current)
+
+
+def compact_actions(actions, tolerance=1.e-4):
+    """Remove redundant keyframes in all fcurves of the actions, see
+    compact_fcurve(). Return dictionary with (number of keyframes,
+    number of removed keyframes) for each action name.
+
+    actions -- set or list of actions, e.g. from
+               get_actions_for_objects()
+    tolerance -- allowed change of the evaluated curves
+    """
+
+    report = {}
+    with profiling.stage('compact') as st:
+        for action in actions:
+            nkeys = 0
+            nremoved = 0
+            for fcu in action.fcurves:
+                nkeys += len(fcu.keyframe_points)
+                nremoved += compact_fcurve(fcu, tolerance)
+
+            report[action.name] = (nkeys, nremoved)
+            st.add(nkeys)
+
+    for name, (nkeys, nremoved) in sorted(report.items()):
+        print("Action %s: %d of %d keyframes removed."
+              % (name, nremoved, nkeys))
+
+    return report
+
+
+if __name__ == "__main__":
+
+    # Measure the stages (wall time, keyframes per second, peak memory)
+    # and write a json-report to profilefile, or None
+    profilefile = None
+    if profilefile is not None:
+        profiling.enable(profilefile, name='compact_keyframes')
+
+    # Allowed change of the animated values
+    tolerance = 1.e-4
+
+    # Get actions for the star-meshes (shapekey animations, materials)
+    # and the camera
+    actions = get_actions_for_objects(namepattern=['stars-*', 'Camera*'])
+
+    compact_actions(actions, tolerance=tolerance)
+
+    profiling.finish()
@@ -8,10 +8,29 @@ animations."""
 # Thus use shapekeys here.
 #
 # Kristin Riebe, E-Science at AIP, kriebe@aip.de, 27.10.2014
+#
+# Updates:
+#   16.10.2026: read and write shapekey coordinates at once with numpy
+#   16.10.2026: projections for more forms (Aitoff, Mollweide, ...)
+#   16.10.2026: remember forms of shapekeys, for updating them later
+#   16.10.2026: optional profiling of the stages (profiling.py)
+#   16.10.2026: make_basis_shapekeys() uses the given objects
+#   16.10.2026: write shapekey keyframes at once, morph timelines
 
 import bpy
+import os
+import sys
 import fnmatch
-from math import sqrt, acos, atan2, pi
+import json
+import collections
+import numpy as np
+from math import pi
+
+# Make the helper modules next to this script importable,
+# also when running it from within Blender
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import profiling
+from shift_keyframes import INTERPOLATIONS, EASINGS
 
 
 def get_objects(namepattern):
@@ -29,44 +48,312 @@ def get_objects(namepattern):
     return objects
 
 
-def shapekey_vertices_to_sphere(obj, keyname, parameters):
-    """Move vertices of mesh to a sky-sphere, using shapekey
-    obj  -- mesh-object with stars as vertices
-    keyname -- name for shapekey (e.g. 'KeySphere')
-    parameters -- dictionary of necessary parameters,
-                  here: rsphere for radius of sphere
+def get_shapekey_coordinates(shapekey):
+    """Return coordinates of all vertices of the shapekey
+    as array of shape (n, 3), read at once with foreach_get
+    """
+
+    coords = np.empty(len(shapekey.data)*3, dtype=np.float32)
+    shapekey.data.foreach_get('co', coords)
+
+    return coords.reshape(-1, 3)
+
+
+def set_shapekey_coordinates(shapekey, coords):
+    """Write coordinates (array of shape (n, 3)) to all vertices
+    of the shapekey at once with foreach_set
+    """
+
+    coords = np.ascontiguousarray(coords, dtype=np.float32)
+    shapekey.data.foreach_set('co', coords.reshape(-1))
+
+
+def get_reference_coordinates(obj):
+    """Return coordinates of the reference (basis) shape of the
+    mesh-object, or of its vertices, if it has no shapekeys yet,
+    as array of shape (n, 3)
+    """
+
+    m = obj.data
+    if m.shape_keys is not None and m.shape_keys.reference_key is not None:
+        return get_shapekey_coordinates(m.shape_keys.reference_key)
+
+    coords = np.empty(len(m.vertices)*3, dtype=np.float32)
+    m.vertices.foreach_get('co', coords)
+
+    return coords.reshape(-1, 3)
+
+
+def spherical_coordinates(coords):
+    """Convert cartesian coordinates to spherical coordinates,
+    return dictionary of arrays:
+    coords -- the given cartesian coordinates, shape (n, 3)
+    r -- distance to the origin
+    theta -- polar angle, 0 at north pole (+z), pi at south pole
+    phi -- azimuth in the x-y-plane, -pi to pi
+    lat -- latitude, pi/2 - theta
+    valid -- mask for vertices with r > 0
+
+    Vertices at the origin (e.g. stars without distance) have no
+    direction; they get theta = pi/2 and phi = 0.
+    """
+
+    coords = np.asarray(coords, dtype=np.float64)
+    r = np.sqrt(np.einsum('ij,ij->i', coords, coords))
+    valid = r > 0
+
+    costheta = np.zeros(len(r))
+    costheta[valid] = coords[valid, 2]/r[valid]
+
+    sph = {}
+    sph['coords'] = coords
+    sph['r'] = r
+    sph['theta'] = np.arccos(np.clip(costheta, -1., 1.))
+    sph['phi'] = np.arctan2(coords[:, 1], coords[:, 0])
+    sph['lat'] = 0.5*pi - sph['theta']
+    sph['valid'] = valid
+
+    return sph
+
+
+def map_to_xz(u, v, mapw, maph):
+    """Put normalized map coordinates into the x-z-plane,
+    as used for all map-projections here.
+    u -- horizontal coordinate, -0.5 to 0.5 (from longitude)
+    v -- vertical coordinate, -0.5 to 0.5 (from latitude)
+    mapw, maph -- width and height of the map
+    """
+
+    coords = np.empty((len(u), 3))
+    coords[:, 0] = -u*mapw
+    coords[:, 1] = 0
+    coords[:, 2] = v*maph
+
+    return coords
+
+
+def project_sphere(sph, parameters):
+    """Move vertices to a sky-sphere
+    parameters -- rsphere: radius of sphere
     """
 
     rsphere = parameters["rsphere"]
 
-    bpy.ops.object.select_all(action='DESELECT')
+    scale = np.ones(len(sph['r']))
+    scale[sph['valid']] = rsphere/sph['r'][sph['valid']]
 
-    print("Adding sphere-shapekey for ", obj.name)
-    m = bpy.data.objects[obj.name]
+    return sph['coords']*scale[:, np.newaxis]
 
-    obj.select = True
 
-    # Add shape keys for modifying vertices of the mesh
-    shapekey = m.shape_key_add(name=keyname, from_mix=True)
-    shapekey.value = 1
+def project_map(sph, parameters):
+    """Move vertices to a flat, equirectangular map
+    parameters -- mapw, maph: width and height of the map
+    """
+
+    return map_to_xz(sph['phi']/(2*pi), sph['lat']/pi,
+                     parameters["mapw"], parameters["maph"])
+
+
+def project_aitoff(sph, parameters):
+    """Move vertices to a flat map with Aitoff projection
+    parameters -- mapw, maph: width and height of the map
+    """
+
+    lat, phi = sph['lat'], sph['phi']
+
+    alpha = np.arccos(np.cos(lat)*np.cos(0.5*phi))
+    sinc = np.ones(len(alpha))
+    nonzero = alpha > 0
+    sinc[nonzero] = np.sin(alpha[nonzero])/alpha[nonzero]
+
+    x = 2*np.cos(lat)*np.sin(0.5*phi)/sinc
+    y = np.sin(lat)/sinc
+
+    return map_to_xz(x/(2*pi), y/pi, parameters["mapw"], parameters["maph"])
+
+
+def project_mollweide(sph, parameters):
+    """Move vertices to a flat map with Mollweide projection
+    parameters -- mapw, maph: width and height of the map
+    """
+
+    lat, phi = sph['lat'], sph['phi']
+
+    # Solve 2t + sin(2t) = pi*sin(lat) for the auxiliary angle t
+    # with Newton iterations, for all vertices at once
+    target = pi*np.sin(lat)
+    t2 = 2*lat
+    for i in range(20):
+        denom = 1 + np.cos(t2)
+        denom = np.where(denom < 1.e-12, 1.e-12, denom)
+        t2 = t2 - (t2 + np.sin(t2) - target)/denom
+    t = np.clip(0.5*t2, -0.5*pi, 0.5*pi)
+
+    x = phi*np.cos(t)/pi  # -1 to 1
+    y = np.sin(t)         # -1 to 1
+
+    return map_to_xz(0.5*x, 0.5*y, parameters["mapw"], parameters["maph"])
+
+
+def project_hammer(sph, parameters):
+    """Move vertices to a flat map with Hammer projection
+    parameters -- mapw, maph: width and height of the map
+    """
+
+    lat, phi = sph['lat'], sph['phi']
+
+    denom = np.sqrt(1 + np.cos(lat)*np.cos(0.5*phi))
+    x = np.cos(lat)*np.sin(0.5*phi)/denom  # -1 to 1
+    y = np.sin(lat)/denom                   # -1 to 1
+
+    return map_to_xz(0.5*x, 0.5*y, parameters["mapw"], parameters["maph"])
+
+
+def project_cylinder(sph, parameters):
+    """Move vertices to the surface of a cylinder around the z-axis,
+    longitude goes around the cylinder, latitude along its height
+    parameters -- rcylinder: radius of the cylinder
+                  hcylinder: height of the cylinder
+    """
+
+    rcylinder = parameters["rcylinder"]
+    hcylinder = parameters["hcylinder"]
+
+    coords = np.empty((len(sph['r']), 3))
+    coords[:, 0] = rcylinder*np.cos(sph['phi'])
+    coords[:, 1] = rcylinder*np.sin(sph['phi'])
+    coords[:, 2] = sph['lat']/pi*hcylinder
+
+    return coords
+
+
+def project_disk(sph, parameters):
+    """Flatten the distribution towards the galactic plane (x-y-plane)
+    parameters -- zscale: factor for the z-coordinates,
+                  0 gives a completely flat disk
+    """
+
+    coords = sph['coords'].copy()
+    coords[:, 2] *= parameters["zscale"]
+
+    return coords
+
+
+def project_scaled_radius(sph, parameters):
+    """Keep directions, but change distances to rscale*r**exponent,
+    e.g. exponent < 1 pulls far away stars closer
+    parameters -- rscale: scaling factor
+                  exponent: exponent for the distance (default: 1)
+    """
+
+    rscale = parameters["rscale"]
+    exponent = parameters.get("exponent", 1.)
+
+    r, valid = sph['r'], sph['valid']
+    scale = np.ones(len(r))
+    scale[valid] = rscale*r[valid]**exponent/r[valid]
+
+    return sph['coords']*scale[:, np.newaxis]
+
+
+# Available forms and their projection functions.
+# Each function gets the dictionary from spherical_coordinates()
+# and the parameters and returns new coordinates of shape (n, 3).
+PROJECTIONS = {'SPHERE': project_sphere,
+               'MAP': project_map,
+               'AITOFF': project_aitoff,
+               'MOLLWEIDE': project_mollweide,
+               'HAMMER': project_hammer,
+               'CYLINDER': project_cylinder,
+               'DISK': project_disk,
+               'SCALED': project_scaled_radius}
+
+
+def register_projection(formtype, function):
+    """Add a new form, which can then be used with make_shapekeys()
+    formtype -- name of the form, e.g. 'MYFORM'
+    function -- projection function, see PROJECTIONS
+    """
+
+    PROJECTIONS[formtype] = function
+
+
+def get_projection(formtype):
+    """Return projection function for the given formtype"""
+
+    if formtype not in PROJECTIONS:
+        raise RuntimeError("There is no function implemented for \
+                           formtype='%s' yet." % formtype)
+
+    return PROJECTIONS[formtype]
+
+
+# Custom property of the objects, which stores the form of each
+# shapekey made by make_form_shapekeys(), as json-string
+# {keyname: [formtype, parameters]}
+FORMS_PROPERTY = 'shapekey_forms'
+
+
+def get_shapekey_forms(obj):
+    """Return dictionary with (formtype, parameters)-tuple for each
+    shapekey of the object, which was made by make_form_shapekeys()
+    """
+
+    if FORMS_PROPERTY not in obj:
+        return {}
 
-    for p in shapekey.data:
+    forms = json.loads(obj[FORMS_PROPERTY])
 
-        r = sqrt(p.co.x*p.co.x + p.co.y*p.co.y + p.co.z*p.co.z)
+    return dict((keyname, tuple(form)) for keyname, form in forms.items())
 
-        scale = rsphere*1./r
 
-        p.co.x = p.co.x * scale
-        p.co.y = p.co.y * scale
-        p.co.z = p.co.z * scale
+def project_coordinates(coords, formtype, parameters):
+    """Return coordinates (shape (n, 3)) projected to the given form,
+    see make_shapekeys()
+    """
+
+    project = get_projection(formtype)
+
+    return project(spherical_coordinates(coords), parameters)
+
+
+def add_projected_shapekey(obj, keyname, coords):
+    """Add shapekey with given coordinates to the mesh-object
+    obj -- mesh-object with stars as vertices
+    keyname -- name for shapekey
+    coords -- new coordinates of the vertices, shape (n, 3)
+    """
+
+    # The first shapekey is the basis, so make sure there is one
+    if obj.data.shape_keys is None:
+        obj.shape_key_add(name='Basis')
+
+    # Add shape keys for modifying vertices of the mesh
+    shapekey = obj.shape_key_add(name=keyname, from_mix=False)
+    set_shapekey_coordinates(shapekey, coords)
 
     shapekey.value = 0
-    m.active_shape_key_index = 0
-    obj.select = False
+    obj.active_shape_key_index = 0
 
     return shapekey
 
 
+def shapekey_vertices_to_sphere(obj, keyname, parameters):
+    """Move vertices of mesh to a sky-sphere, using shapekey
+    obj  -- mesh-object with stars as vertices
+    keyname -- name for shapekey (e.g. 'KeySphere')
+    parameters -- dictionary of necessary parameters,
+                  here: rsphere for radius of sphere
+    """
+
+    print("Adding sphere-shapekey for ", obj.name)
+
+    sph = spherical_coordinates(get_reference_coordinates(obj))
+
+    return add_projected_shapekey(obj, keyname,
+                                  project_sphere(sph, parameters))
+
+
 def shapekey_vertices_to_map(obj, keyname, parameters):
     """Move vertices of mesh to a flat, equirectangular map
     obj  -- mesh-object with stars as vertices
@@ -77,36 +364,12 @@ def shapekey_vertices_to_map(obj, keyname, parameters):
                   maph -- height of the map
     """
 
-    mapw, maph = parameters["mapw"], parameters["maph"]
-
-    bpy.ops.object.select_all(action='DESELECT')
-
     print("Adding map-shapekey for ", obj.name)
-    m = bpy.data.objects[obj.name]
-
-    obj.select = True
-
-    # Add shape keys for modifying vertices of the mesh
-    shapekey = m.shape_key_add(name=keyname, from_mix=True)
-    shapekey.value = 1
-
-    for p in shapekey.data:
 
-        r = sqrt(p.co.x*p.co.x + p.co.y*p.co.y + p.co.z*p.co.z)
+    sph = spherical_coordinates(get_reference_coordinates(obj))
 
-        theta = acos(p.co.z/r)
-        phi = atan2(p.co.y, p.co.x)
-
-        p.co.x = -(phi/(2*pi)*mapw)  # - 0.5*mapw
-        p.co.y = 0
-        p.co.z = -(theta/(pi)*maph - 0.5*maph)
-
-    shapekey.value = 0
-    m.active_shape_key_index = 0
-
-    obj.select = False
-
-    return shapekey
+    return add_projected_shapekey(obj, keyname,
+                                  project_map(sph, parameters))
 
 
 def make_basis_shapekeys(objects, basisname):
@@ -115,9 +378,6 @@ def make_basis_shapekeys(objects, basisname):
     basisname -- name for basis shapekey
     """
 
-    bpy.ops.object.select_all(action='DESELECT')
-    bpy.ops.object.select_pattern(pattern=namepattern)
-    objects = bpy.context.selected_objects
     bpy.ops.object.select_all(action='DESELECT')
 
     for obj in objects:
@@ -134,25 +394,45 @@ def make_shapekeys(objects, keyname, formtype, parameters):
     """Create shapekeys for given formtype for all matching objects
     objects    -- list of objects to be used
     keyname    -- name for shapekey
-    formtype   -- type of form, e.g. 'SPHERE' or 'MAP'
+    formtype   -- type of form, e.g. 'SPHERE' or 'MAP',
+                  see PROJECTIONS for all available forms
     parameters -- dictionary of necessary parameters, e.g. rsphere, maph;
                   see individual functions for what is needed.
     """
 
-    bpy.ops.object.select_all(action='DESELECT')
+    make_form_shapekeys(objects, [(keyname, formtype, parameters)])
+
+    return
+
+
+def make_form_shapekeys(objects, forms):
+    """Create shapekeys for several forms for all given objects.
+    The spherical coordinates of each mesh are computed only once
+    and then used for all forms.
+    objects -- list of objects to be used
+    forms   -- list of (keyname, formtype, parameters)-tuples,
+               see make_shapekeys()
+    """
+
+    # Check all forms before changing anything
+    projections = [get_projection(formtype) for keyname, formtype, p
+                   in forms]
 
     for obj in objects:
-        m = bpy.data.objects[obj.name]
-        obj.select = True
+        sph = spherical_coordinates(get_reference_coordinates(obj))
+        records = get_shapekey_forms(obj)
 
-        # Add shapekeys depending on given formtype
-        if formtype == 'SPHERE':
-            key = shapekey_vertices_to_sphere(obj, keyname, parameters)
-        elif formtype == 'MAP':
-            key = shapekey_vertices_to_map(obj, keyname, parameters)
-        else:
-            raise RuntimeError("There is no function implemented for \
-                               formtype='%s' yet." % formtype)
+        for (keyname, formtype, parameters), project in zip(forms,
+                                                            projections):
+            print("Adding %s-shapekey for %s" % (formtype, obj.name))
+            with profiling.stage('shapekeys', len(sph['r'])):
+                add_projected_shapekey(obj, keyname,
+                                       project(sph, parameters))
+            records[keyname] = (formtype, parameters)
+
+        # Remember the forms, so the shapekeys can be computed again
+        # for changed vertices (see ravestars_mesh.py)
+        obj[FORMS_PROPERTY] = json.dumps(records)
 
     return
 
@@ -162,20 +442,250 @@ def delete_shapekeys(objects):
 
     bpy.ops.object.select_all(action='DESELECT')
 
-    for obj in objects:
-        # Select, set active, then delete all shapekeys
-        obj.select = True
-        bpy.context.scene.objects.active = obj
+    with profiling.stage('cleanup', len(objects)):
+        for obj in objects:
+            # Select, set active, then delete all shapekeys
+            obj.select = True
+            bpy.context.scene.objects.active = obj
+
+            if obj.data.shape_keys is not None:
+                bpy.ops.object.shape_key_remove(all=True)
+                print("Shapekeys for %s deleted." % obj.name)
 
-        if obj.data.shape_keys is not None:
-            bpy.ops.object.shape_key_remove(all=True)
-            print("Shapekeys for %s deleted." % obj.name)
+            if FORMS_PROPERTY in obj:
+                del obj[FORMS_PROPERTY]
 
-        obj.select = False
+            obj.select = False
 
     return
 
 
+# One stage of a morph timeline, see add_shape_timeline():
+# keyname -- shapekey reached at the end of the stage
+# start, end -- frames of the morph from the previous shape to this one
+# easing -- interpolation of the morph, see parse_easing()
+TimelineStage = collections.namedtuple('TimelineStage',
+                                       ['keyname', 'start', 'end', 'easing'])
+TimelineStage.__new__.__defaults__ = ('BEZIER',)
+
+
+def parse_easing(easing):
+    """Return enum values of interpolation and easing (see INTERPOLATIONS,
+    EASINGS) for easing given as name of the interpolation,
+    e.g. 'BEZIER' or 'LINEAR', or as (interpolation, easing)-tuple,
+    e.g. ('CUBIC', 'EASE_IN_OUT')
+    """
+
+    if isinstance(easing, str):
+        easing = (easing, 'AUTO')
+
+    interpolation, mode = easing
+    if interpolation not in INTERPOLATIONS or mode not in EASINGS:
+        raise RuntimeError("Unknown easing %s, use one of %s, optionally "
+                           "with one of %s."
+                           % (easing, ', '.join(sorted(INTERPOLATIONS)),
+                              ', '.join(sorted(EASINGS))))
+
+    return INTERPOLATIONS[interpolation], EASINGS[mode]
+
+
+def validate_timeline(stages, reference=None):
+    """Return stages of a morph timeline as TimelineStage-tuples,
+    sorted by their start frames; raise RuntimeError, if the frames
+    of a stage are reversed, stages overlap or all stages use the
+    reference key.
+    stages -- list of (keyname, start, end, easing)-tuples,
+              easing is optional, see TimelineStage
+    reference -- name of the reference (basis) shapekey, or None
+    """
+
+    stages = sorted((TimelineStage(*stage) for stage in stages),
+                    key=lambda stage: stage.start)
+    if not stages:
+        raise RuntimeError("Need at least one stage for the timeline.")
+
+    # The value of the reference key has no effect, so there would be
+    # nothing to animate
+    if all(stage.keyname == reference for stage in stages):
+        print("All stages of the timeline use the basis shapekey %s!"
+              % reference)
+        raise RuntimeError("Stopping script because the timeline needs "
+                           "another shapekey than the basis.")
+
+    for i, stage in enumerate(stages):
+        parse_easing(stage.easing)
+
+        # Only the first stage may jump to its shape without a morph
+        if stage.end < stage.start or (i > 0 and stage.end == stage.start):
+            raise RuntimeError("Stage %s needs an end frame after its "
+                               "start frame, not %s to %s."
+                               % (stage.keyname, stage.start, stage.end))
+
+        if i > 0 and stage.start < stages[i-1].end:
+            raise RuntimeError("Stage %s (frames %s to %s) overlaps stage "
+                               "%s (frames %s to %s)."
+                               % (stage.keyname, stage.start, stage.end,
+                                  stages[i-1].keyname, stages[i-1].start,
+                                  stages[i-1].end))
+
+    return stages
+
+
+def timeline_keyframes(stages, keynames):
+    """Return frames (array of length n), values of the given shapekeys
+    (array of shape (len(keynames), n)), interpolations and easings
+    (arrays of length n, values of INTERPOLATIONS and EASINGS) of all
+    keyframes needed for the stages of a timeline.
+    In each stage, the value of its shapekey goes from 0 to 1 and that
+    of the previous one from 1 to 0; the shapes are kept between the
+    stages. A stage with the reference key goes back to the basis shape.
+    stages -- validated stages, see validate_timeline()
+    keynames -- names of the animated shapekeys
+    """
+
+    frames = []
+    values = []
+    interpolations = []
+    easings = []
+
+    # Hold the shape between stages
+    hold = (INTERPOLATIONS['CONSTANT'], EASINGS['AUTO'])
+
+    previous = np.zeros(len(keynames))
+    for stage in stages:
+        shape = np.array([1. if keyname == stage.keyname else 0.
+                          for keyname in keynames])
+        morph = parse_easing(stage.easing)
+
+        if stage.start == stage.end:
+            # First stage without morph
+            pass
+        elif frames and frames[-1] == stage.start:
+            # Stage starts right at the end of the previous one
+            interpolations[-1], easings[-1] = morph
+        else:
+            frames.append(stage.start)
+            values.append(previous)
+            interpolations.append(morph[0])
+            easings.append(morph[1])
+
+        frames.append(stage.end)
+        values.append(shape)
+        interpolations.append(hold[0])
+        easings.append(hold[1])
+
+        previous = shape
+
+    return (np.array(frames, dtype=np.float32),
+            np.array(values, dtype=np.float32).T.reshape(len(keynames), -1),
+            np.array(interpolations, dtype=np.int32),
+            np.array(easings, dtype=np.int32))
+
+
+def write_keyframes(fcurve, frames, values, interpolations=None,
+                    easings=None):
+    """Set keyframes of the fcurve at once: existing keyframes at the
+    given frames get the new values, the others are added. Keyframes
+    at other frames are kept.
+    fcurve -- fcurve to be changed
+    frames, values -- arrays of frames and values of the keyframes
+    interpolations, easings -- arrays of values of INTERPOLATIONS and
+                               EASINGS per keyframe (default: existing
+                               keyframes are unchanged, new ones get
+                               BEZIER and the default easing)
+    """
+    # Read all keyframes, change and append in the arrays, then write
+    # them back; fcurve.update() sorts the keyframes and sets the
+    # handles, as keyframe_insert() would.
+
+    points = fcurve.keyframe_points
+    nold = len(points)
+    frames = np.asarray(frames, dtype=np.float32)
+
+    co = np.empty(nold*2, dtype=np.float32)
+    points.foreach_get('co', co)
+    co = co.reshape(-1, 2)
+    interp = np.empty(nold, dtype=np.int32)
+    points.foreach_get('interpolation', interp)
+
+    # Index of each frame among the existing keyframes, or -1
+    index = np.full(len(frames), -1)
+    if nold:
+        order = np.argsort(co[:, 0], kind='stable')
+        pos = np.clip(np.searchsorted(co[order, 0], frames), 0, nold - 1)
+        found = co[order[pos], 0] == frames
+        index[found] = order[pos[found]]
+
+    new = index < 0
+    nnew = np.count_nonzero(new)
+    index[new] = nold + np.arange(nnew)
+    if nnew:
+        points.add(nnew)
+        co = np.concatenate([co, np.zeros((nnew, 2), dtype=np.float32)])
+        interp = np.concatenate([interp, np.zeros(nnew, dtype=np.int32)])
+
+    co[index, 0] = frames
+    co[index, 1] = values
+    points.foreach_set('co', co.reshape(-1))
+
+    # Like keyframe_insert(), keep the interpolation of existing
+    # keyframes, unless new ones are given
+    if interpolations is not None:
+        interp[index] = interpolations
+    else:
+        interp[index[new]] = INTERPOLATIONS['BEZIER']
+    if interpolations is not None or nnew:
+        points.foreach_set('interpolation', interp)
+
+    if easings is not None:
+        ease = np.empty(len(co), dtype=np.int32)
+        points.foreach_get('easing', ease)
+        ease[index] = easings
+        points.foreach_set('easing', ease)
+
+    fcurve.update()
+
+    return fcurve
+
+
+def check_interpolations(fcurve, interpolations):
+    """Raise RuntimeError, if the interpolations of the keyframes of the
+    fcurve, read by name, are not the given ones (values of
+    INTERPOLATIONS), i.e. if this Blender version uses other values
+    """
+
+    names = dict((value, name) for name, value in INTERPOLATIONS.items())
+    for point, value in zip(fcurve.keyframe_points, interpolations):
+        if point.interpolation != names[value]:
+            print("Keyframe at frame %g has interpolation %s instead of %s!"
+                  % (point.co[0], point.interpolation, names[value]))
+            raise RuntimeError("Stopping script because the enum values "
+                               "of INTERPOLATIONS don't match Blender.")
+
+
+def shapekey_data_path(keyname):
+    """Return data path of the value of the shapekey,
+    as used by fcurves of shapekey-actions
+    """
+
+    return 'key_blocks["%s"].value' % keyname
+
+
+def shapekey_fcurve(key, keyname):
+    """Return fcurve for the value of the shapekey of key (the
+    shapekeys-datablock of a mesh), create action and fcurve if needed
+    """
+
+    animdata = key.animation_data_create()
+    if animdata.action is None:
+        animdata.action = bpy.data.actions.new(key.name + 'Action')
+
+    fcurves = animdata.action.fcurves
+    datapath = shapekey_data_path(keyname)
+
+    return fcurves.find(datapath) or fcurves.new(datapath)
+
+
 def add_shape_animation(objects, keyname0, iframe0, keyname1, iframe1):
     """Add animation keyframes for shapekeys
     objects    -- list of objects to be used
@@ -184,41 +694,112 @@ def add_shape_animation(objects, keyname0, iframe0, keyname1, iframe1):
     keyname1 -- name of new shapekey
     iframe1 -- frame at which new shape gets value 1, keyframed
     """
+    # Write the keyframes to the fcurves directly instead of using
+    # keyframe_insert() for each of them; other keyframes are kept,
+    # so several transitions can be added one after another.
+    # See add_shape_timeline() for all transitions at once.
+
+    frames = [iframe0, iframe1]
+
+    # Two keyframes for each of the two shapekeys per object
+    with profiling.stage('keyframes', 4*len(objects)):
+        for obj in objects:
+            key = obj.data.shape_keys
+            for keyname, values in ((keyname0, [1., 0.]),
+                                    (keyname1, [0., 1.])):
+                # Raises KeyError for missing shapekeys, as before
+                key.key_blocks[keyname]
+                write_keyframes(shapekey_fcurve(key, keyname), frames,
+                                values)
 
-    bpy.ops.object.select_all(action='DESELECT')
+    return
 
-    for obj in objects:
-        m = bpy.data.objects[obj.name]
 
-        # Select the object
-        obj.select = True
+def add_shape_timeline(objects, stages, name='ShapeTimeline'):
+    """Animate the shapekeys of the objects by a timeline of morphs
+    from one shapekey to the next one, e.g.
+        [('KeyMap', 30, 30),
+         ('KeySphere', 30, 100, 'BEZIER'),
+         ('Basis', 170, 230, ('SINE', 'EASE_IN_OUT'))]
+    shows the map at frame 30, morphs to the sphere until frame 100,
+    holds it until frame 170 and then morphs back to the basis shape.
+    All keyframes are written once into one action, which is shared
+    by the shapekeys of all objects; this replaces their previous
+    shapekey animations.
+    objects -- list of mesh-objects with the shapekeys of the stages
+    stages -- list of (keyname, start, end, easing)-tuples, see
+              TimelineStage; they must not overlap
+    name -- name of the action
+    Return the action.
+    """
+    # Since fcurves refer to shapekeys by name, one action works for
+    # all meshes with the same shapekeys, so adding more objects costs
+    # nothing but assigning the action.
 
-        # Set the keyframes for this object
-        keyblocks = m.data.shape_keys.key_blocks
-        key0 = keyblocks[keyname0]
-        key1 = keyblocks[keyname1]
+    # Check all objects before changing anything
+    reference = None
+    for obj in objects:
+        key = obj.data.shape_keys
+        if key is None:
+            print("Object %s has no shapekeys!" % obj.name)
+            raise RuntimeError("Stopping script because of missing "
+                               "shapekeys.")
+        if reference is None:
+            reference = key.reference_key.name
+        elif key.reference_key.name != reference:
+            print("Objects have different basis shapekeys (%s, %s)!"
+                  % (reference, key.reference_key.name))
+            raise RuntimeError("Stopping script because the timeline "
+                               "needs the same shapekeys for all objects.")
+
+    stages = validate_timeline(stages, reference)
 
-        # Initial shape, value of new shapekey is 0
-        iframe = iframe0
-        key0.value = 1
-        key1.value = 0
-        key0.keyframe_insert(data_path="value", frame=iframe)
-        key1.keyframe_insert(data_path="value", frame=iframe)
+    for obj in objects:
+        key = obj.data.shape_keys
+        for stage in stages:
+            if stage.keyname not in key.key_blocks:
+                print("Shapekey %s not found for %s!"
+                      % (stage.keyname, obj.name))
+                raise RuntimeError("Stopping script because of missing "
+                                   "shapekey.")
+
+    # The value of the reference key has no effect
+    keynames = []
+    for stage in stages:
+        if stage.keyname != reference and stage.keyname not in keynames:
+            keynames.append(stage.keyname)
+
+    frames, values, interpolations, easings = timeline_keyframes(stages,
+                                                                 keynames)
+    useeasing = np.any(easings != EASINGS['AUTO'])
+
+    action = bpy.data.actions.new(name)
+    with profiling.stage('keyframes', len(frames)*len(keynames)):
+        for keyname, keyvalues in zip(keynames, values):
+            fcurve = action.fcurves.new(shapekey_data_path(keyname))
+            write_keyframes(fcurve, frames, keyvalues, interpolations,
+                            easings if useeasing else None)
+
+    # The frames are sorted, so the keyframes are in the same order
+    check_interpolations(action.fcurves[0], interpolations)
 
-        # New shape with key1
-        iframe = iframe1
-        key0.value = 0
-        key1.value = 1
-        key0.keyframe_insert(data_path="value", frame=iframe)
-        key1.keyframe_insert(data_path="value", frame=iframe)
+    for obj in objects:
+        obj.data.shape_keys.animation_data_create().action = action
 
-        obj.select = False
+    print("Timeline with %d stages for %d objects."
+          % (len(stages), len(objects)))
 
-    return
+    return action
 
 
 if __name__ == '__main__':
 
+    # Measure the stages (wall time, vertices per second, peak memory)
+    # and write a json-report to profilefile, or None
+    profilefile = None
+    if profilefile is not None:
+        profiling.enable(profilefile, name='deform_starmesh')
+
     # Set parameters: sphere radius, width and height of flat map
     rsphere = 2.
 
@@ -243,25 +824,23 @@ if __name__ == '__main__':
     # Make basis shapekey
     make_basis_shapekeys(objects, basisname)
 
-    # Add sphere-shapekey
-    parameters = {"rsphere": rsphere}
-    make_shapekeys(objects, spherekeyname, 'SPHERE', parameters)
-
-    # Add map-shapekey
-    parameters = {"mapw": mapw, "maph": maph}
-    make_shapekeys(objects, mapkeyname, 'MAP', parameters)
+    # Add sphere- and map-shapekeys
+    forms = [(spherekeyname, 'SPHERE', {"rsphere": rsphere}),
+             (mapkeyname, 'MAP', {"mapw": mapw, "maph": maph})]
+    make_form_shapekeys(objects, forms)
 
-    # Add animations. Go backwards, because want initial distribution
-    # at the end.
-
-    # Set keyframes for animations
-    imap1 = 0
-    imap2 = 30
+    # Add animations: start with the map, morph to the sphere, keep it
+    # for a while and end with the initial distribution
+    imap = 30
     isphere1 = 100
     isphere2 = 170
     ibasis = 230
 
-    add_shape_animation(objects, basisname, ibasis, spherekeyname, isphere2)
-    add_shape_animation(objects, spherekeyname, isphere1, mapkeyname, imap2)
+    timeline = [(mapkeyname, imap, imap),
+                (spherekeyname, imap, isphere1, 'BEZIER'),
+                (basisname, isphere2, ibasis, 'BEZIER')]
+    add_shape_timeline(objects, timeline)
+
+    profiling.finish()
 
     print("\nDone.")
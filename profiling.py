@@ -0,0 +1,302 @@
+"""
+Lightweight instrumentation for the scripts of this repository:
+wall time, number of processed items (stars, vertices, keyframes)
+per second and peak memory for each stage of a run, written as
+json-report. When it is not enabled, stage() returns a shared object
+that does nothing, so the instrumented code runs as before.
+"""
+# Usage:
+#     import profiling
+#     profiling.enable('import-profile.json')
+#
+#     with profiling.stage('read') as st:
+#         stars = ...
+#         st.add(len(stars['x']))
+#
+#     for chunk in profiling.iterate('read', chunks, count=len):
+#         ...
+#
+#     profiling.finish()  # writes the report
+#
+# Stages with the same name (e.g. one per chunk) are added up. Stages
+# within other stages get the names of the outer ones as prefix,
+# e.g. 'load/read'. Only the stages of this process are recorded,
+# not those of worker processes.
+#
+# This module only needs the standard library (no bpy), so it can
+# also be used outside of Blender. Peak memory is the maximum resident
+# set size of the process, which is not available on Windows.
+
+
+import os
+import sys
+import json
+import time
+import platform
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_memory():
+    """Return peak resident memory of this process and of its finished
+    child processes in MB, or (None, None) if not available
+    """
+
+    if resource is None:
+        return None, None
+
+    # ru_maxrss is given in bytes on macOS, in kB elsewhere
+    unit = 1. if sys.platform == 'darwin' else 1024.
+    mb = 1024.*1024.
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*unit/mb
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*unit/mb
+
+    return own, children
+
+
+class NullStage(object):
+    """Stage doing nothing, used when profiling is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def add(self, count):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+    """Context manager measuring one stage, see stage()"""
+
+    def __init__(self, profiler, name, count=None):
+
+        self.profiler = profiler
+        self.name = name
+        self.count = count
+
+    def __enter__(self):
+
+        self.profiler.stack.append(self.name)
+        self.path = '/'.join(self.profiler.stack)
+        self.peak = peak_memory()[0]
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *args):
+
+        seconds = time.perf_counter() - self.start
+        self.profiler.stack.pop()
+        self.profiler.record(self.path, seconds, self.count, self.peak)
+
+        return False
+
+    def add(self, count):
+        """Add number of processed items (stars, vertices, ...)"""
+
+        self.count = (self.count or 0) + count
+
+
+class Profiler(object):
+    """Collects the measurements of all stages of a run
+
+    reportfile -- name of the json-file for the report, or None
+    name -- name of the run, e.g. of the script
+    """
+
+    def __init__(self, reportfile=None, name=None):
+
+        if name is None:
+            name = os.path.basename(sys.argv[0]) if sys.argv else ''
+
+        self.reportfile = reportfile
+        self.name = name
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.stack = []
+        self.stages = {}
+        self.meta = {}
+
+    def record(self, path, seconds, count=None, peak=None):
+        """Add measurement for the stage with the given path
+
+        seconds -- wall time of the stage
+        count -- number of processed items, or None
+        peak -- peak memory in MB before the stage, or None
+        """
+
+        entry = self.stages.get(path)
+        if entry is None:
+            entry = {'stage': path, 'calls': 0, 'seconds': 0., 'count': None,
+                     'peak_mb': None, 'peak_children_mb': None,
+                     'peak_growth_mb': 0.}
+            self.stages[path] = entry
+
+        entry['calls'] += 1
+        entry['seconds'] += seconds
+        if count is not None:
+            entry['count'] = (entry['count'] or 0) + count
+
+        # How much the stage raised the peak memory of the process
+        own, children = peak_memory()
+        if own is not None:
+            entry['peak_mb'] = own
+            entry['peak_children_mb'] = children
+            entry['peak_growth_mb'] += own - peak
+
+    def report(self):
+        """Return report as dictionary, stages in order of their first
+        completion; per_second is the processed items per second
+        """
+
+        stages = []
+        for entry in self.stages.values():
+            entry = dict(entry)
+            if entry['count'] is not None and entry['seconds'] > 0:
+                entry['per_second'] = entry['count']/entry['seconds']
+            else:
+                entry['per_second'] = None
+            stages.append(entry)
+
+        own, children = peak_memory()
+
+        return {'name': self.name,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                         time.localtime(self.started)),
+                'seconds': time.perf_counter() - self.start,
+                'peak_mb': own,
+                'peak_children_mb': children,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'meta': self.meta,
+                'stages': stages}
+
+
+# Profiler of the current run, None if profiling is disabled
+_profiler = None
+
+
+def enable(reportfile=None, name=None):
+    """Start recording stages, report is written by finish()
+
+    reportfile -- name of the json-file for the report, or None
+                  for only printing a summary
+    name -- name of the run (default: name of the script)
+    """
+
+    global _profiler
+    _profiler = Profiler(reportfile, name=name)
+
+    return _profiler
+
+
+def disable():
+    """Stop recording stages, without writing a report"""
+
+    global _profiler
+    _profiler = None
+
+
+def is_enabled():
+    """Return True, if stages are recorded"""
+
+    return _profiler is not None
+
+
+def stage(name, count=None):
+    """Return context manager measuring the enclosed code as stage
+
+    name -- name of the stage, e.g. 'read', 'mesh' or 'keyframes'
+    count -- number of processed items, or use add() on the stage
+    """
+
+    if _profiler is None:
+        return NULL_STAGE
+
+    return Stage(_profiler, name, count)
+
+
+def iterate(name, iterable, count=None):
+    """Iterate over iterable, measuring the time for getting each item
+    as stage name (e.g. for reading chunks of a file)
+
+    count -- function returning the number of items in one item
+             (e.g. len), or None
+    """
+
+    if _profiler is None:
+        return iterable
+
+    return _iterate(name, iterable, count)
+
+
+def _iterate(name, iterable, count):
+
+    iterator = iter(iterable)
+    while True:
+        with stage(name) as st:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            if count is not None:
+                st.add(count(item))
+        yield item
+
+
+def set_meta(**values):
+    """Add information about the run to the report,
+    e.g. catalog size or mode"""
+
+    if _profiler is not None:
+        _profiler.meta.update(values)
+
+
+def format_report(report):
+    """Return report as table, one line per stage"""
+
+    lines = ["%-32s %6s %10s %12s %10s %10s"
+             % ('stage', 'calls', 'seconds', 'per second', 'peak MB',
+                '+peak MB')]
+    for entry in report['stages']:
+        persecond = entry['per_second']
+        lines.append("%-32s %6d %10.3f %12s %10s %10s"
+                     % (entry['stage'], entry['calls'], entry['seconds'],
+                        '-' if persecond is None else '%.0f' % persecond,
+                        '-' if entry['peak_mb'] is None
+                        else '%.1f' % entry['peak_mb'],
+                        '%.1f' % entry['peak_growth_mb']))
+    lines.append("total %.3f seconds" % report['seconds'])
+
+    return '\n'.join(lines)
+
+
+def finish():
+    """Print summary, write report of the current run (if enabled)
+    and stop recording; return the report or None
+    """
+
+    global _profiler
+    if _profiler is None:
+        return None
+
+    profiler = _profiler
+    _profiler = None
+
+    report = profiler.report()
+    print(format_report(report))
+
+    if profiler.reportfile is not None:
+        with open(profiler.reportfile, 'w') as f:
+            json.dump(report, f, indent=1)
+        print("Profile written to %s." % profiler.reportfile)
+
+    return report
@@ -12,22 +12,43 @@ radial velocities for color.
 #
 # Kristin Riebe, E-Science at AIP, kriebe@aip.de, Oct. 2014
 #
-# TODO:
-# - properly clean up unused lists (lines, stars)
-#
-#
 # Updates:
 #   16.12.2014: properly read csv-files
 #   19.01.2015: delete unused materials
+#   16.10.2026: column-wise conversion with numpy (starcatalog.py)
+#   16.10.2026: read csv-files in chunks of rows
+#   16.10.2026: cache converted stars on disk
+#   16.10.2026: create meshes with data API and foreach_set
+#   16.10.2026: configurable bins and colors (create_binned_meshes)
+#   16.10.2026: one mesh with vertex attributes (create_attribute_mesh)
+#   16.10.2026: spatial chunks with levels of detail (create_chunked_meshes)
+#   16.10.2026: read large csv-files with several processes
+#   16.10.2026: read binary catalogs (.npy, .npz, raw columns)
+#   16.10.2026: filter stars while reading
+#   16.10.2026: preview with a fraction of stars, refine later
+#   16.10.2026: import chunk by chunk with a timer (ChunkedImport)
+#   16.10.2026: keep track of created datablocks, reuse materials
+#   16.10.2026: update meshes of the last import with changed stars only
+#   16.10.2026: aggregate stars on a voxel grid (points or volume)
+#   16.10.2026: merge (nearly) coincident stars
+#   16.10.2026: optional profiling of the stages (profiling.py)
 
 
 import bpy
 import os
 import sys
+import uuid
 import fnmatch
 from mathutils import Vector, Color
-from math import sin, cos, pi
 import csv
+import numpy as np
+
+# Make the helper modules next to this script importable,
+# also when running it from within Blender
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import starcatalog
+import deform_starmesh
+import profiling
 
 
 def get_objects(namepattern):
@@ -107,15 +128,164 @@ def delete_unused_materials():
     return
 
 
+# Custom properties for keeping track of the created datablocks:
+# each datablock gets the id of the import run, and the scene gets
+# the names of all datablocks of the last run, by kind. Kept materials
+# (and textures) stay registered for one more run, with the id of
+# their run as 'kept'; reusing them tags them with the new run id.
+RUN_PROPERTY = 'ravestars_run'
+REGISTRY_PROPERTY = 'ravestars_datablocks'
+REGISTRY_KINDS = ('objects', 'meshes', 'materials', 'node_groups',
+                  'textures')
+
+
+def get_registry(scene=None):
+    """Return registry of created datablocks (custom property of the
+    scene), start a new one with a new run id, if there is none.
+    """
+
+    if scene is None:
+        scene = bpy.context.scene
+
+    if REGISTRY_PROPERTY not in scene:
+        registry = {'run': uuid.uuid4().hex}
+        for kind in REGISTRY_KINDS:
+            registry[kind] = {}
+        scene[REGISTRY_PROPERTY] = registry
+
+    return scene[REGISTRY_PROPERTY]
+
+
+def track(idblock, kind, scene=None):
+    """Tag datablock with the current run id and add it to the
+    registry, so it can be removed by delete_tracked()
+
+    idblock -- object, mesh, material or node group
+    kind -- collection of bpy.data, one of REGISTRY_KINDS
+    """
+
+    registry = get_registry(scene)
+    idblock[RUN_PROPERTY] = registry['run']
+    registry[kind][idblock.name] = 1
+
+    return idblock
+
+
+def remove_datablocks(idblocks):
+    """Remove list of (kind, datablock)-tuples from bpy.data,
+    in one call if possible (Blender 2.81 and newer)
+    """
+
+    if hasattr(bpy.data, 'batch_remove'):
+        bpy.data.batch_remove([idblock for kind, idblock in idblocks])
+        return
+
+    for kind, idblock in idblocks:
+        if kind == 'objects':
+            bpy.data.objects.remove(idblock, do_unlink=True)
+        else:
+            getattr(bpy.data, kind).remove(idblock)
+
+
+def delete_tracked(scene=None, keep_materials=True):
+    """Delete all objects, meshes and node groups created by the last
+    run (as stored in the registry of the scene), without searching
+    through all datablocks of the file. Datablocks which were renamed
+    or are tagged with another run id are not touched.
+
+    scene -- scene with the registry (default: current scene)
+    keep_materials -- keep the materials (and textures) of the last run
+                      in the registry, so they can be reused by the next
+                      run, which gets a new run id; the ones kept before
+                      and not reused are deleted, if nothing uses them.
+                      Otherwise delete all of them as well.
+    Return number of deleted datablocks.
+    """
+
+    if scene is None:
+        scene = bpy.context.scene
+    if REGISTRY_PROPERTY not in scene:
+        return 0
+
+    registry = scene[REGISTRY_PROPERTY]
+    runid = registry['run']
+    keptid = registry.get('kept')
+
+    idblocks = []
+    used = {'materials': {}, 'textures': {}}
+    for kind in REGISTRY_KINDS:
+        collection = getattr(bpy.data, kind)
+        for name in registry[kind].keys():
+            idblock = collection.get(name)
+            if idblock is None:
+                continue
+            tag = idblock.get(RUN_PROPERTY)
+            if kind in used and keep_materials:
+                if tag == runid:
+                    # Used by the last run, keep for the next one
+                    used[kind][name] = 1
+                elif tag == keptid and idblock.users == 0:
+                    # Kept before, but not reused
+                    idblocks.append((kind, idblock))
+            elif tag == runid or (kind in used and tag == keptid):
+                idblocks.append((kind, idblock))
+
+    remove_datablocks(idblocks)
+    if keep_materials:
+        for kind in REGISTRY_KINDS:
+            registry[kind] = used.get(kind, {})
+        registry['kept'] = runid
+        registry['run'] = uuid.uuid4().hex
+    else:
+        del scene[REGISTRY_PROPERTY]
+
+    print("%d datablocks were deleted." % len(idblocks))
+
+    return len(idblocks)
+
+
+def find_material(matname, keyname, key):
+    """Return existing material with the given key (custom property
+    keyname), named matname or registered in the registry, or None
+    """
+
+    candidates = [matname]
+    if REGISTRY_PROPERTY in bpy.context.scene:
+        candidates.extend(get_registry()['materials'].keys())
+
+    for name in candidates:
+        mat = bpy.data.materials.get(name)
+        if mat is not None and mat.get(keyname) == key:
+            return mat
+
+    return None
+
+
+def find_halo_material(matname, key):
+    """Return existing halo-material with the given key (color and size),
+    named matname or registered in the registry, or None
+    """
+
+    return find_material(matname, 'halo_key', key)
+
+
 def make_halo_material(matname, col, size):
-    """Function for basic material creation
+    """Function for basic material creation.
+    An existing halo-material with the same color and size is reused.
 
     matname -- name for material
     col -- mathutils.Color()-object, RGB-triplet for diffuse color
     size -- halo-size
     """
 
+    key = '%g %g %g %g' % (col.r, col.g, col.b, size)
+    mat = find_halo_material(matname, key)
+    if mat is not None:
+        return track(mat, 'materials')
+
     mat = bpy.data.materials.new(matname)
+    mat['halo_key'] = key
+    track(mat, 'materials')
     mat.diffuse_color = [col.r, col.g, col.b]
     #mat.use_transparency = True
     #mat.alpha = 0
@@ -126,6 +296,152 @@ def make_halo_material(matname, col, size):
     return mat
 
 
+def set_attribute_colors(mat, attribute, edges, colors):
+    """Set attribute, bins and colors of an attribute-material,
+    as created by make_attribute_material(). Use this for changing
+    the colors of stars without recreating the mesh.
+
+    mat -- material with node tree from make_attribute_material()
+    attribute -- name of vertex attribute used for coloring
+    edges -- sorted bin edges, bin i contains edges[i-1] < value <= edges[i]
+    colors -- list of RGB-tuples, one per bin (len(edges)+1)
+    """
+
+    nodes = mat.node_tree.nodes
+    nodes['Attribute'].attribute_name = attribute
+
+    # Map the value range (with some margin) to 0..1 for the color ramp
+    lo, hi = float(edges[0]), float(edges[-1])
+    if hi <= lo:
+        hi = lo + 1.
+    margin = 0.05*(hi - lo)
+    lo, hi = lo - margin, hi + margin
+
+    maprange = nodes['Map Range']
+    maprange.inputs['From Min'].default_value = lo
+    maprange.inputs['From Max'].default_value = hi
+
+    # Constant color ramp with one element per bin,
+    # each starting just above its lower bin edge
+    ramp = nodes['Color Ramp'].color_ramp
+    ramp.interpolation = 'CONSTANT'
+    while len(ramp.elements) > 1:
+        ramp.elements.remove(ramp.elements[-1])
+    ramp.elements[0].position = 0.
+    ramp.elements[0].color = list(colors[0]) + [1.]
+    for edge, col in zip(edges, colors[1:]):
+        element = ramp.elements.new((edge - lo)/(hi - lo) + 1.e-6)
+        element.color = list(col) + [1.]
+
+
+def make_attribute_material(matname, attribute, edges, colors):
+    """Create material, which colors the stars by the value of a
+    vertex attribute, using a color ramp with one color per bin.
+    An existing material for the same attribute is reused, with the
+    given bins and colors. Needs Blender 2.91 or newer.
+
+    matname -- name for material
+    attribute, edges, colors -- see set_attribute_colors()
+    """
+
+    mat = find_material(matname, 'attribute_key', attribute)
+    if mat is not None:
+        track(mat, 'materials')
+        set_attribute_colors(mat, attribute, edges, colors)
+        return mat
+
+    mat = bpy.data.materials.new(matname)
+    mat['attribute_key'] = attribute
+    track(mat, 'materials')
+    mat.use_nodes = True
+    nodes = mat.node_tree.nodes
+    links = mat.node_tree.links
+    nodes.clear()
+
+    attr = nodes.new('ShaderNodeAttribute')
+    attr.name = 'Attribute'
+    maprange = nodes.new('ShaderNodeMapRange')
+    maprange.name = 'Map Range'
+    ramp = nodes.new('ShaderNodeValToRGB')
+    ramp.name = 'Color Ramp'
+    emission = nodes.new('ShaderNodeEmission')
+    output = nodes.new('ShaderNodeOutputMaterial')
+
+    links.new(attr.outputs['Fac'], maprange.inputs['Value'])
+    links.new(maprange.outputs['Result'], ramp.inputs['Fac'])
+    links.new(ramp.outputs['Color'], emission.inputs['Color'])
+    links.new(emission.outputs['Emission'], output.inputs['Surface'])
+
+    set_attribute_colors(mat, attribute, edges, colors)
+
+    return mat
+
+
+def add_vertex_attributes(m, values):
+    """Add float attributes per vertex to the mesh,
+    each written at once with foreach_set.
+    Needs Blender 2.91 or newer.
+
+    m -- mesh
+    values -- dictionary of attribute names and arrays of values
+    """
+
+    if not hasattr(m, 'attributes'):
+        raise RuntimeError("Vertex attributes need Blender 2.91 or newer.")
+
+    for name, vals in values.items():
+        with profiling.stage('attributes', len(vals)):
+            attr = m.attributes.new(name=name, type='FLOAT', domain='POINT')
+            attr.data.foreach_set('value',
+                                  np.ascontiguousarray(vals,
+                                                       dtype=np.float32))
+
+
+def add_points_modifier(obj, radius, mat, radius_attribute=None):
+    """Add geometry nodes modifier, which turns the vertices of
+    the mesh-object into points with given radius and material,
+    so they are rendered (with Cycles). Needs Blender 3.0 or newer.
+    If radius_attribute is given, the radius of each point is taken
+    from this float attribute of the vertices instead.
+    """
+
+    tree = bpy.data.node_groups.new(obj.name + '-points', 'GeometryNodeTree')
+    track(tree, 'node_groups')
+    if hasattr(tree, 'interface'):
+        # Blender 4.0 and newer
+        tree.interface.new_socket('Geometry', in_out='INPUT',
+                                  socket_type='NodeSocketGeometry')
+        tree.interface.new_socket('Geometry', in_out='OUTPUT',
+                                  socket_type='NodeSocketGeometry')
+    else:
+        tree.inputs.new('NodeSocketGeometry', 'Geometry')
+        tree.outputs.new('NodeSocketGeometry', 'Geometry')
+
+    nodes = tree.nodes
+    groupin = nodes.new('NodeGroupInput')
+    groupout = nodes.new('NodeGroupOutput')
+    topoints = nodes.new('GeometryNodeMeshToPoints')
+    topoints.inputs['Radius'].default_value = radius
+    setmat = nodes.new('GeometryNodeSetMaterial')
+    setmat.inputs['Material'].default_value = mat
+
+    if radius_attribute is not None:
+        attribute = nodes.new('GeometryNodeInputNamedAttribute')
+        attribute.data_type = 'FLOAT'
+        attribute.inputs['Name'].default_value = radius_attribute
+        tree.links.new(attribute.outputs['Attribute'],
+                       topoints.inputs['Radius'])
+
+    tree.links.new(groupin.outputs[0], topoints.inputs['Mesh'])
+    tree.links.new(topoints.outputs['Points'], setmat.inputs['Geometry'])
+    tree.links.new(setmat.outputs['Geometry'], groupout.inputs[0])
+
+    modifier = obj.modifiers.new('Points', 'NODES')
+    modifier.node_group = tree
+
+    return modifier
+
+
 def read_daiquiri_csv(filename):
     """Read content of file into a dictionary,
     with keys taken from first row,
@@ -133,22 +449,11 @@ def read_daiquiri_csv(filename):
     Assumes a "usual" csv-file, as returned by Daiquiri web
     interface, which is also used for RAVE-Database
     """
-
-    if (os.path.isfile(filename)):
-        pass
-    else:
-        print("File %s does not exist!" % filename)
-        raise RuntimeError("Stopping script because file was not found.")
+    # This keeps all rows in memory; for large catalogs rather use
+    # starcatalog.iter_daiquiri_chunks(), which reads chunks of rows.
 
     lines = []
-    with open(filename, newline='') as csvfile:
-        headerFlag = csv.Sniffer().has_header(csvfile.read(1024))
-        csvfile.seek(0)
-        if (not headerFlag):
-            print("No header found in csv file!")
-            raise RuntimeError("Stopping script because file has no proper \
-                               header.")
-
+    with starcatalog.open_daiquiri_csv(filename) as csvfile:
         reader = csv.DictReader(csvfile, delimiter=',')
 
         for r in reader:
@@ -164,129 +469,1070 @@ def adjust_values(lines):
     convert to cartesian coordinates,
     return as list of dictionaries
     """
+    # This is only a thin wrapper around the column-wise conversion
+    # in starcatalog.galactic_to_cartesian(), which is much faster
+    # for large catalogs.
 
-    stars = []
-    for line in lines:
-        RAdeg = float(line['RAdeg'])
-        DEdeg = float(line['DEdeg'])
+    columns = {}
+    for name in ('Glon', 'Glat', 'dist', 'HRV', 'Teff_K'):
+        columns[name] = starcatalog.parse_column([line[name]
+                                                  for line in lines])
 
-        Glon = float(line['Glon'])
-        Glat = float(line['Glat'])
+    stars = starcatalog.galactic_to_cartesian(columns['Glon'],
+                                              columns['Glat'],
+                                              columns['dist'],
+                                              hrv=columns['HRV'],
+                                              teff=columns['Teff_K'])
 
-        dist = line['dist']
-        if (dist):
-            dist = float(dist)
-        else:
-            dist = 0
+    starlist = [{'x': x, 'y': y, 'z': z, 'hrv': hrv, 'teff': teff}
+                for x, y, z, hrv, teff
+                in zip(*[stars[key].tolist()
+                         for key in starcatalog.STAR_COLUMNS])]
 
-        hrv = line['HRV']
-        if (hrv):
-            hrv = float(hrv)
-        else:
-            hrv = 0
+    return starlist
 
-        teff = line['Teff_K']
-        if (teff):
-            teff = float(teff)
-        else:
-            teff = 0
 
-        # convert from galactic to cartesian
-        phi = Glon/360.*2*pi
-        theta = (90 - Glat)/180.*pi
-        r = dist
+def link_object(obj, scene=None):
+    """Link object to the given scene (default: current scene)"""
 
-        star = {}
-        star['x'] = r*cos(phi)*sin(theta)
-        star['y'] = r*sin(phi)*sin(theta)
-        star['z'] = r*cos(theta)
+    if scene is None:
+        scene = bpy.context.scene
+
+    if hasattr(scene, 'collection'):
+        # Blender 2.8 and newer
+        scene.collection.objects.link(obj)
+    else:
+        scene.objects.link(obj)
 
-        star['teff'] = teff
-        star['hrv'] = hrv
 
-        stars.append(star)
+def star_coordinates(stars, posfac=1., dtype=np.float32):
+    """Return array of shape (n, 3) with the scaled positions of the
+    stars, which can be used directly as vertices for create_mesh()
 
-    return stars
+    stars -- dictionary of star columns (x, y, z, ...)
+    posfac -- scaling factor for the positions
+    dtype -- float type of the array; Blender stores vertex
+             coordinates as 32 bit floats
+    """
+
+    coords = np.empty((len(stars['x']), 3), dtype=dtype)
+    for i, key in enumerate(('x', 'y', 'z')):
+        np.multiply(stars[key], posfac, out=coords[:, i], casting='unsafe')
+
+    return coords
+
+
+def create_mesh_data(verts, mat, name):
+    """Create mesh-datablock from vertices only
+
+    verts -- vertex coordinates, array of shape (n, 3),
+             flat array of x, y, z-values or list of (x, y, z)-tuples
+    mat -- material-object, for assigning the proper material
+    name -- desired name for the mesh
+    """
+    # Copy all coordinates at once from a contiguous buffer
+    # instead of using from_pydata().
+
+    coords = np.ascontiguousarray(verts, dtype=np.float32).reshape(-1)
+
+    with profiling.stage('mesh', len(coords)//3):
+        m = bpy.data.meshes.new(name)
+        track(m, 'meshes')
+        m.vertices.add(len(coords)//3)
+        m.vertices.foreach_set('co', coords)
+        m.update()
+
+    # Assign material
+    m.materials.append(mat)
+
+    return m
 
 
 def create_mesh(origin, verts, mat, name):
-    """Create a mesh from list of vertices only
+    """Create a mesh from vertices only
 
     origin -- origin of the mesh
-    verts -- list of vertices of the mesh
+    verts -- vertex coordinates, array of shape (n, 3),
+             flat array of x, y, z-values or list of (x, y, z)-tuples
     mat -- material-object, for assigning the proper material
     name -- desired name for the mesh-object
     """
+    # Use the data API instead of operators, so this does not depend
+    # on the context.
+
+    m = create_mesh_data(verts, mat, name)
+
+    obj = bpy.data.objects.new(name, m)
+    track(obj, 'objects')
+    obj.location = origin
+    link_object(obj)
+
+    return obj
+
+
+def create_binned_meshes(stars, origin, halosize, posfac, column='hrv',
+                         edges=starcatalog.HRV_EDGES, colors=None,
+                         colormap='hrv', names=None, prefix='stars-',
+                         statefile=None):
+    """Distribute stars into bins of the given column,
+    create one mesh with its own halo-color per bin.
+
+    stars -- dictionary of star columns (x, y, z, hrv, ...),
+             as returned by starcatalog.read_stars()
+    origin -- origin of the meshes
+    halosize -- size of the halo-dots
+    posfac -- scaling factor for positions
+    column -- column used for binning, e.g. 'hrv', 'teff' or 'dist'
+    edges -- sorted bin edges, bin i contains edges[i-1] < value <= edges[i]
+    colors -- list of RGB-tuples, one per bin (len(edges)+1);
+              if None, they are taken from the colormap
+    colormap -- name of colormap, see starcatalog.COLORMAPS
+    names -- list of names for the bins, used for meshes
+             (prefix+name) and materials (default: bin00, bin01, ...)
+    prefix -- prefix for the names of the mesh-objects
+    statefile -- if given and the stars have ids, write the state of
+                 this import into this file, for update_binned_meshes()
+    """
+
+    nbins = len(edges) + 1
+
+    if colors is None:
+        colors = starcatalog.colormap_colors(colormap, nbins)
+    if names is None:
+        names = ['bin%02d' % i for i in range(nbins)]
+
+    if len(colors) != nbins or len(names) != nbins:
+        raise RuntimeError("Need %d colors and names for %d bin edges."
+                           % (nbins, len(edges)))
+
+    with profiling.stage('bin', len(stars['x'])):
+        values = starcatalog.column_values(stars, column)
+        bins = starcatalog.assign_bins(values, edges)
+        order, offsets = starcatalog.partition_bins(bins, nbins)
+        coords = star_coordinates(stars, posfac)[order]
+
+    print("%d stars sorted into %d bins of %s." % (len(values), nbins,
+                                                   column))
+
+    objects = []
+    for i, (name, col) in enumerate(zip(names, colors)):
+        mat = make_halo_material('Mesh-' + name, Color(col), halosize)
+        objects.append(create_mesh(origin, coords[offsets[i]:offsets[i+1]],
+                                   mat, prefix + name))
+
+    if statefile is not None and 'id' in stars:
+        starcatalog.save_import_state(statefile, stars, order, offsets,
+                                      posfac, column, edges,
+                                      [obj.name for obj in objects])
+
+    return objects
+
+
+def get_vertex_coordinates(m):
+    """Return coordinates of all vertices of the mesh,
+    array of shape (n, 3)
+    """
+
+    coords = np.empty(len(m.vertices)*3, dtype=np.float32)
+    m.vertices.foreach_get('co', coords)
+
+    return coords.reshape(-1, 3)
+
+
+def updated_shapekey_coordinates(obj, coords, source):
+    """Return dictionary with new coordinates for each shapekey of the
+    mesh-object, for the new vertex coordinates coords.
+    The basis gets coords, shapekeys made from a form (by
+    deform_starmesh.make_form_shapekeys) are projected again, other
+    shapekeys keep the offsets of the old vertices to the basis.
+
+    obj -- mesh-object with shapekeys
+    coords -- new vertex coordinates, array of shape (n, 3)
+    source -- for each new vertex, index of the same star in the old
+              mesh, or -1 for new stars
+    """
+
+    keys = obj.data.shape_keys
+    forms = deform_starmesh.get_shapekey_forms(obj)
+    oldbasis = deform_starmesh.get_shapekey_coordinates(keys.reference_key)
+    old = source >= 0
+
+    keycoords = {}
+    for keyblock in keys.key_blocks:
+        if keyblock.name == keys.reference_key.name:
+            keycoords[keyblock.name] = coords
+        elif keyblock.name in forms:
+            formtype, parameters = forms[keyblock.name]
+            keycoords[keyblock.name] = deform_starmesh.project_coordinates(
+                coords, formtype, parameters)
+        else:
+            oldkey = deform_starmesh.get_shapekey_coordinates(keyblock)
+            newkey = np.array(coords, dtype=np.float32)
+            newkey[old] += oldkey[source[old]] - oldbasis[source[old]]
+            keycoords[keyblock.name] = newkey
+
+    return keycoords
+
+
+def patch_mesh(obj, coords):
+    """Write new coordinates to the vertices (and shapekeys) of the
+    mesh-object, keeping the number and order of the vertices
+
+    obj -- mesh-object
+    coords -- new vertex coordinates, array of shape (n, 3)
+    """
 
-    bpy.ops.object.add(type='MESH', location=(origin))
-    obj = bpy.context.object
-    obj.name = name
     m = obj.data
-    m.from_pydata(verts, [], [])
-    m.update()
-    bpy.ops.object.mode_set(mode='OBJECT')
+    if m.shape_keys is not None:
+        with profiling.stage('shapekeys', len(coords)):
+            keycoords = updated_shapekey_coordinates(obj, coords,
+                                                     np.arange(len(coords)))
+            for keyblock in m.shape_keys.key_blocks:
+                deform_starmesh.set_shapekey_coordinates(
+                    keyblock, keycoords[keyblock.name])
+
+    with profiling.stage('mesh', len(coords)):
+        m.vertices.foreach_set('co', np.ascontiguousarray(coords,
+                                                          dtype=np.float32)
+                               .reshape(-1))
+        m.update()
+
+
+def rebuild_mesh(obj, coords, source):
+    """Replace the mesh of the object by a new one with the given
+    vertices. Materials, shapekeys (with their settings) and the
+    animation of the shapekeys are kept.
+
+    obj -- mesh-object
+    coords -- new vertex coordinates, array of shape (n, 3)
+    source -- for each new vertex, index of the same star in the old
+              mesh, or -1 for new stars
+    """
+    # Vertices cannot be removed from a mesh with the data API,
+    # and adding vertices would break its shapekeys,
+    # so create a new mesh instead.
+
+    old = obj.data
+    name = old.name
+    materials = list(old.materials)
+
+    keys = old.shape_keys
+    if keys is not None:
+        with profiling.stage('shapekeys', len(coords)):
+            keycoords = updated_shapekey_coordinates(obj, coords, source)
+        keyblocks = [(kb.name, kb.relative_key.name, kb.value,
+                      kb.slider_min, kb.slider_max, kb.mute,
+                      kb.interpolation) for kb in keys.key_blocks]
+        use_relative = keys.use_relative
+        action = None
+        if keys.animation_data is not None:
+            action = keys.animation_data.action
+
+    m = create_mesh_data(coords, materials[0] if materials else None, name)
+    for mat in materials[1:]:
+        m.materials.append(mat)
+    obj.data = m
+
+    if keys is not None:
+        with profiling.stage('shapekeys', len(coords)*len(keyblocks)):
+            for (keyname, relname, value, slider_min, slider_max, mute,
+                 interpolation) in keyblocks:
+                keyblock = obj.shape_key_add(name=keyname, from_mix=False)
+                deform_starmesh.set_shapekey_coordinates(keyblock,
+                                                         keycoords[keyname])
+                keyblock.slider_min = slider_min
+                keyblock.slider_max = slider_max
+                keyblock.value = value
+                keyblock.mute = mute
+                keyblock.interpolation = interpolation
+
+        newkeys = m.shape_keys
+        for keyblock, kbsettings in zip(newkeys.key_blocks, keyblocks):
+            keyblock.relative_key = newkeys.key_blocks[kbsettings[1]]
+        newkeys.use_relative = use_relative
+
+        # F-curves refer to the shapekeys by name, so the same
+        # action works for the new shapekeys
+        if action is not None:
+            newkeys.animation_data_create()
+            newkeys.animation_data.action = action
+
+    bpy.data.meshes.remove(old)
+    m.name = name
+
+    return m
+
+
+def update_binned_meshes(stars, posfac, statefile):
+    """Update the meshes of an earlier import (create_binned_meshes()
+    with statefile) for a new version of the catalog. Stars are matched
+    by their ids; only meshes with added, removed or changed stars are
+    modified. Meshes keep their materials, shapekeys and animations.
+
+    stars -- dictionary of star columns with ids (x, y, z, hrv, id, ...),
+             as returned by starcatalog.read_stars() with a schema from
+             starcatalog.with_id_column()
+    posfac -- scaling factor for positions, same as for the import
+    statefile -- state of the earlier import, is updated afterwards
+    """
 
-    # Assign material
-    bpy.ops.object.material_slot_remove()
-    obj.data.materials.append(mat)
+    if 'id' not in stars:
+        print("Stars have no ids, use starcatalog.with_id_column()!")
+        raise RuntimeError("Stopping script because star ids are needed.")
+
+    state = starcatalog.load_import_state(statefile)
+    if state['posfac'] != posfac:
+        print("Scaling factor differs from the earlier import (%g)!"
+              % state['posfac'])
+        raise RuntimeError("Stopping script, use a full import instead.")
+
+    objects = []
+    for objname in state['objects']:
+        obj = bpy.data.objects.get(objname)
+        if obj is None:
+            print("Object %s of the earlier import not found!" % objname)
+            raise RuntimeError("Stopping script, use a full import instead.")
+        objects.append(obj)
+
+    nbins = len(objects)
+    offsets = state['offsets']
+    bins = starcatalog.assign_bins(
+        starcatalog.column_values(stars, state['column']), state['edges'])
+    coords = star_coordinates(stars, posfac)
+
+    with profiling.stage('diff', len(bins)):
+        # Index of each star in the state (i.e. in the old vertex order),
+        # and index of the new star for each old one
+        index = starcatalog.match_ids(state['ids'], stars['id'])
+        found = index >= 0
+        newindex = np.full(len(state['ids']), -1, dtype=np.int64)
+        newindex[index[found]] = np.nonzero(found)[0]
+
+        moved = np.zeros(len(bins), dtype=bool)
+        moved[found] = state['bins'][index[found]] != bins[found]
+        changed = np.zeros(len(bins), dtype=bool)
+        for key in ('x', 'y', 'z'):
+            changed[found] |= state[key][index[found]] != stars[key][found]
+
+    print("%d stars added, %d removed, %d moved to another bin, "
+          "%d changed." % (np.count_nonzero(~found),
+                           np.count_nonzero(newindex < 0),
+                           np.count_nonzero(moved),
+                           np.count_nonzero(changed & ~moved)))
+
+    order = []
+    newoffsets = np.zeros(nbins + 1, dtype=np.int64)
+    for i, obj in enumerate(objects):
+        # Stars staying in this bin keep the order of their vertices,
+        # added stars and stars from other bins are appended
+        oldstars = newindex[offsets[i]:offsets[i+1]]
+        stay = oldstars >= 0
+        stay[stay] = bins[oldstars[stay]] == i
+        incoming = np.nonzero((bins == i) & (~found | moved))[0]
+        binorder = np.concatenate([oldstars[stay], incoming])
+        order.append(binorder)
+        newoffsets[i+1] = newoffsets[i] + len(binorder)
+
+        if len(incoming) or not stay.all():
+            source = np.concatenate([np.nonzero(stay)[0],
+                                     np.full(len(incoming), -1,
+                                             dtype=np.int64)])
+            print("Rebuilding %s." % obj.name)
+            rebuild_mesh(obj, coords[binorder], source)
+        elif changed[binorder].any():
+            print("Updating %s." % obj.name)
+            patch_mesh(obj, coords[binorder])
+
+    starcatalog.save_import_state(statefile, stars, np.concatenate(order),
+                                  newoffsets, posfac, state['column'],
+                                  state['edges'],
+                                  [obj.name for obj in objects])
+
+    return objects
+
+
+def append_vertices(m, verts):
+    """Append vertices to a mesh; the coordinates of all vertices are
+    read and written at once
+
+    m -- mesh
+    verts -- coordinates of the new vertices, array of shape (n, 3)
+    """
+
+    verts = np.ascontiguousarray(verts, dtype=np.float32).reshape(-1)
+    nold = 3*len(m.vertices)
+
+    with profiling.stage('mesh', len(verts)//3):
+        coords = np.empty(nold + len(verts), dtype=np.float32)
+        m.vertices.foreach_get('co', coords[:nold])
+        coords[nold:] = verts
+
+        m.vertices.add(len(verts)//3)
+        m.vertices.foreach_set('co', coords)
+        m.update()
+
+
+def preview_partition(stars, column, edges, seed):
+    """Return bins of the stars, sorted by bin and within each bin by a
+    stable random key, as sorting indices and offsets of the bins,
+    see starcatalog.partition_bins()
+    """
+
+    bins = starcatalog.assign_bins(starcatalog.column_values(stars, column),
+                                   edges)
+    keys = starcatalog.star_keys(len(bins), seed=seed)
+
+    return starcatalog.partition_bins(bins, len(edges) + 1, keys=keys)
 
 
-def create_hrv_meshes(starlist, origin, halosize, posfac):
+def create_preview_meshes(stars, origin, halosize, posfac, fraction=None,
+                          count=None, column='hrv',
+                          edges=starcatalog.HRV_EDGES,
+                          colors=starcatalog.HRV_COLORS,
+                          names=starcatalog.HRV_NAMES, prefix='stars-',
+                          seed=0):
+    """Like create_binned_meshes(), but only use a reproducible random
+    fraction (or count) of the stars of each bin, e.g. for quickly
+    adjusting positions, sizes and the camera. Every bin keeps at least
+    one star. Use refine_preview_meshes() for adding more stars later on.
+
+    fraction -- fraction of stars per bin, 0 to 1
+    count -- total number of stars (instead of fraction)
+    seed -- seed for choosing the stars
+    For the other arguments see create_binned_meshes().
+    """
+
+    nbins = len(edges) + 1
+    order, offsets = preview_partition(stars, column, edges, seed)
+    ns = starcatalog.preview_counts(np.diff(offsets), fraction=fraction,
+                                    count=count)
+
+    coords = star_coordinates(stars, posfac)
+
+    objects = []
+    for i in range(nbins):
+        verts = coords[order[offsets[i]:offsets[i] + ns[i]]]
+        mat = make_halo_material('Mesh-' + names[i], Color(colors[i]),
+                                 halosize)
+        obj = create_mesh(origin, verts, mat, prefix + names[i])
+        obj['preview_count'] = int(ns[i])
+        obj['preview_seed'] = seed
+        obj['preview_bin'] = i
+        objects.append(obj)
+
+    print("Preview with %d of %d stars is created."
+          % (ns.sum(), len(order)))
+
+    return objects
+
+
+def refine_preview_meshes(objects, stars, posfac, fraction=None, count=None,
+                          column='hrv', edges=starcatalog.HRV_EDGES,
+                          names=starcatalog.HRV_NAMES, prefix='stars-'):
+    """Add more stars to preview meshes created by
+    create_preview_meshes(), up to the given fraction or count
+    (all stars, if both are None). Only the missing stars are appended,
+    the meshes are not recreated. stars, column and edges must be the
+    same as for creating the preview; names and prefix are only needed
+    for previews without the bin of each object (preview_bin).
+    Shapekeys do not get proper positions for the new stars, so refine
+    before adding shapekeys.
+    """
+
+    objects = [obj for obj in objects if 'preview_count' in obj]
+    if not objects:
+        return
+
+    order, offsets = preview_partition(stars, column, edges,
+                                       objects[0]['preview_seed'])
+    ns = starcatalog.preview_counts(np.diff(offsets), fraction=fraction,
+                                    count=count)
+
+    coords = star_coordinates(stars, posfac)
+
+    nadded = 0
+    for obj in objects:
+        # Blender may have renamed the object, e.g. to stars-bin3.001
+        if 'preview_bin' in obj:
+            i = obj['preview_bin']
+        else:
+            i = names.index(obj.name[len(prefix):])
+        nold = obj['preview_count']
+        if ns[i] <= nold:
+            continue
+
+        append_vertices(obj.data, coords[order[offsets[i] + nold:
+                                               offsets[i] + ns[i]]])
+        obj['preview_count'] = int(ns[i])
+        nadded += ns[i] - nold
+
+    print("%d stars added to preview meshes." % nadded)
+
+
+class ChunkedImport(object):
+    """Import stars into binned meshes (like create_binned_meshes())
+    chunk by chunk. Each step reads one chunk; its stars are appended
+    to the meshes in batches which grow with the meshes. Use start()
+    for running the steps with a timer, so the user interface stays
+    responsive, or run() for running all steps at once (e.g. in
+    background mode).
+
+    Attributes for checking the progress:
+    nstars -- number of stars added so far
+    total -- total number of stars, or None if not known (yet)
+    done -- True, when all stars are imported
+    cancelled -- True, if cancel() was called
+    """
+
+    def __init__(self, filename, origin, halosize, posfac,
+                 chunksize=starcatalog.CHUNKSIZE, filters=None,
+                 columns=starcatalog.RAVE_SCHEMA, column='hrv',
+                 edges=starcatalog.HRV_EDGES, colors=starcatalog.HRV_COLORS,
+                 names=starcatalog.HRV_NAMES, prefix='stars-'):
+        """Prepare import, nothing is read or created yet.
+        See starcatalog.read_stars() and create_binned_meshes() for
+        the arguments.
+        """
+
+        self.filename = filename
+        self.origin = origin
+        self.halosize = halosize
+        self.posfac = posfac
+        self.chunksize = chunksize
+        self.filters = filters
+        self.columns = columns
+        self.column = column
+        self.edges = edges
+        self.colors = colors
+        self.names = names
+        self.prefix = prefix
+
+        self.nstars = 0
+        self.total = None
+        self.done = False
+        self.cancelled = False
+        self.paused = False
+        self.interval = 0.01
+        self.objects = []
+        self._steps = None
+        self._pending = []
+        self._npending = []
+
+    def steps(self):
+        """Generator doing the import, one chunk per step"""
+
+        total, chunks = starcatalog.open_star_chunks(
+            self.filename, columns=self.columns, chunksize=self.chunksize,
+            filters=self.filters)
+        self.total = total
+
+        # Start with empty meshes
+        nbins = len(self.edges) + 1
+        for name, col in zip(self.names, self.colors):
+            mat = make_halo_material('Mesh-' + name, Color(col),
+                                     self.halosize)
+            self.objects.append(create_mesh(self.origin, [], mat,
+                                            self.prefix + name))
+        yield
+
+        # Appending rewrites all vertices of a mesh, so the new vertices
+        # of each bin are collected until they are at least as many as
+        # the mesh already has. Meshes grow geometrically, and all
+        # appends together write each vertex only a few times.
+        self._pending = [[] for i in range(nbins)]
+        self._npending = [0]*nbins
+        try:
+            for chunk in chunks:
+                with profiling.stage('bin',
+                                     starcatalog.chunk_length(chunk)):
+                    bins = starcatalog.assign_bins(
+                        starcatalog.column_values(chunk, self.column),
+                        self.edges)
+                    verts = starcatalog.split_bins(
+                        star_coordinates(chunk, self.posfac), bins, nbins)
+
+                for i, binverts in enumerate(verts):
+                    if len(binverts):
+                        self._pending[i].append(binverts)
+                        self._npending[i] += len(binverts)
+                        if (self._npending[i]
+                                >= len(self.objects[i].data.vertices)):
+                            self.flush_bin(i)
+
+                self.nstars += len(bins)
+                yield
+        finally:
+            # Also keeps the stars read so far, when cancelled
+            for i in range(nbins):
+                self.flush_bin(i)
+
+        self.total = self.nstars
+        self.done = True
+
+        # Report of the stages, if profiling was enabled
+        profiling.finish()
+
+    def flush_bin(self, i):
+        """Append the collected vertices of bin i to its mesh"""
+
+        if self._npending[i]:
+            append_vertices(self.objects[i].data,
+                            np.concatenate(self._pending[i]))
+            self._pending[i] = []
+            self._npending[i] = 0
+
+    def step(self):
+        """Do one step of the import, return False when finished"""
+
+        if self.done or self.cancelled:
+            return False
+
+        if self._steps is None:
+            self._steps = self.steps()
+
+        try:
+            next(self._steps)
+        except StopIteration:
+            self.done = True
+
+        return not self.done
+
+    def run(self):
+        """Do all (remaining) steps at once"""
+
+        while self.step():
+            pass
+
+        print("%d stars imported." % self.nstars)
+
+    def progress(self):
+        """Return fraction of imported stars (0 to 1),
+        or None if the total number is not known yet"""
+
+        if self.done:
+            return 1.
+        if not self.total:
+            return None
+
+        return float(self.nstars)/self.total
+
+    def start(self, interval=0.01):
+        """Run the import with a timer, one step per call, so Blender
+        stays responsive. In background mode, or without
+        bpy.app.timers (Blender 2.7x), everything is done at once.
+        """
+
+        self.interval = interval
+        self.paused = False
+
+        if bpy.app.background or not hasattr(bpy.app, 'timers'):
+            self.run()
+            return
+
+        if not bpy.app.timers.is_registered(self.timer_step):
+            bpy.app.timers.register(self.timer_step)
+
+    def pause(self):
+        """Stop the timer after the current step, continue with
+        resume()"""
+
+        self.paused = True
+
+    def resume(self):
+        """Continue a paused import"""
+
+        if not self.cancelled:
+            self.start(self.interval)
+
+    def cancel(self):
+        """Stop the import; the stars imported so far are kept"""
+
+        self.cancelled = True
+        if self._steps is not None:
+            self._steps.close()
+
+    def timer_step(self):
+        """Function for bpy.app.timers: do one step and return the
+        time until the next one, or None for stopping the timer"""
+
+        if self.paused or self.cancelled:
+            return None
+
+        running = self.step()
+
+        if self.total:
+            print("%d of %d stars imported." % (self.nstars, self.total))
+        else:
+            print("%d stars imported." % self.nstars)
+
+        if not running:
+            return None
+
+        return self.interval
+
+
+def create_hrv_meshes(stars, origin, halosize, posfac, statefile=None):
     """Create vertex-lists for stars,
     distribute stars according to their HRV-value
+
+    stars -- dictionary of star columns (x, y, z, hrv, ...),
+             as returned by starcatalog.read_stars()
+    statefile -- file for the state of the import, needed for updating
+                 the meshes later, see create_binned_meshes()
     """
 
-    verts_r = []
-    verts_o = []
-    verts_y = []
-    verts_c = []
-    verts_b = []
+    objects = create_binned_meshes(stars, origin, halosize, posfac,
+                                   column='hrv',
+                                   edges=starcatalog.HRV_EDGES,
+                                   colors=starcatalog.HRV_COLORS,
+                                   names=starcatalog.HRV_NAMES,
+                                   statefile=statefile)
 
-    i = 0
-    for star in starlist:
-
-        x = star['x']*posfac
-        y = star['y']*posfac
-        z = star['z']*posfac
-
-        radvel = star['hrv']
-        if radvel > 50:
-            verts_r.append((x, y, z))
-        elif radvel > 10:
-            verts_o.append((x, y, z))
-        elif radvel > -10:
-            verts_y.append((x, y, z))
-        elif radvel > -50:
-            verts_c.append((x, y, z))
+    print("HRV-meshes are created.")
+
+    return objects
+
+
+# Fractions of stars for the levels of detail of chunked meshes
+LOD_FRACTIONS = (1., 0.25, 0.05)
+
+
+def set_hidden(obj, hidden):
+    """Hide or unhide object in the viewport"""
+
+    if hasattr(obj, 'hide_viewport'):
+        # Blender 2.8 and newer
+        obj.hide_viewport = hidden
+    else:
+        obj.hide = hidden
+
+
+def get_chunk_objects(objects=None):
+    """Return objects with levels of detail,
+    as created by create_chunked_meshes()
+    """
+
+    if objects is None:
+        objects = bpy.data.objects
+
+    return [obj for obj in objects if 'lod_meshes' in obj]
+
+
+def set_lod(objects, level):
+    """Switch chunk-objects to the given level of detail,
+    0 is full detail. This only exchanges the mesh of each object.
+    """
+
+    for obj in get_chunk_objects(objects):
+        names = obj['lod_meshes']
+        name = names[min(level, len(names) - 1)]
+        if obj.data.name != name:
+            obj.data = bpy.data.meshes[name]
+
+
+def set_lod_by_distance(objects, location, distances):
+    """Choose level of detail of chunk-objects by the distance of
+    their chunk center to the given location (e.g. the camera).
+    The chunk centers are in object space, so the objects may be moved,
+    rotated, scaled or parented. Chunks further away than the last
+    distance are hidden.
+
+    objects -- chunk-objects, as created by create_chunked_meshes()
+    location -- (x, y, z) position, e.g. camera.location
+    distances -- increasing distances, up to which level 0, 1, ...
+                 is used
+    """
+
+    location = np.asarray(location, dtype=np.float64)
+    for obj in get_chunk_objects(objects):
+        center = Vector(obj['chunk_center'])
+        if bpy.app.version >= (2, 80, 0):
+            center = obj.matrix_world @ center
         else:
-            verts_b.append((x, y, z))
+            center = obj.matrix_world * center
+        center = np.asarray(center)
+        d = np.linalg.norm(center - location)
+        level = int(np.searchsorted(distances, d))
+        if level >= len(distances):
+            set_hidden(obj, True)
+            continue
 
-        i = i + 1
-        if (i % 10000 == 0):
-            print("Star %d added to vertices." % i)
-
-    # Define the HRV colors
-    red = Color((1, 0, 0))
-    orange = Color((1, 0.4, 0))
-    yellow = Color((1, 1, 0))
-    cyan = Color((0, 1, 1))
-    blue = Color((0, 0, 1))
-
-    # Create corresponding materials
-    matred = make_halo_material('Mesh-red', red,  halosize)  # hrv > 50
-    matorange = make_halo_material('Mesh-orange', orange,  halosize)
-    matyellow = make_halo_material('Mesh-yellow', yellow, halosize)
-    matcyan = make_halo_material('Mesh-cyan', cyan, halosize)
-    matblue = make_halo_material('Mesh-blue', blue, halosize)
-
-    # Create meshes for each group of vertices
-    create_mesh(origin, verts_r, matred, 'stars-red')
-    create_mesh(origin, verts_o, matorange, 'stars-orange')
-    create_mesh(origin, verts_y, matyellow, 'stars-yellow')
-    create_mesh(origin, verts_c, matcyan, 'stars-cyan')
-    create_mesh(origin, verts_b, matblue, 'stars-blue')
+        set_hidden(obj, False)
+        names = obj['lod_meshes']
+        name = names[min(level, len(names) - 1)]
+        if obj.data.name != name:
+            obj.data = bpy.data.meshes[name]
 
-    print("HRV-meshes are created.")
+
+@bpy.app.handlers.persistent
+def lod_render_pre(scene, *args):
+    """Handler: remember levels of detail and use full detail
+    for rendering"""
+
+    for obj in get_chunk_objects():
+        obj['lod_viewport'] = obj.data.name
+        obj.data = bpy.data.meshes[obj['lod_meshes'][0]]
+
+
+@bpy.app.handlers.persistent
+def lod_render_post(scene, *args):
+    """Handler: restore levels of detail after rendering"""
+
+    for obj in get_chunk_objects():
+        if 'lod_viewport' in obj:
+            obj.data = bpy.data.meshes[obj['lod_viewport']]
+            del obj['lod_viewport']
+
+
+def use_full_detail_for_render():
+    """Register handlers, so that chunk-objects are rendered
+    with full detail, whatever level is shown in the viewport.
+    The handlers stay registered when another .blend file is loaded.
+    """
+
+    handlers = bpy.app.handlers
+    for handlerlist, function in ((handlers.render_pre, lod_render_pre),
+                                  (handlers.render_post, lod_render_post),
+                                  (handlers.render_cancel, lod_render_post)):
+        # Compare by name, since running this script again creates
+        # new functions; the handlers of earlier runs are replaced
+        for handler in list(handlerlist):
+            if getattr(handler, '__name__', None) == function.__name__:
+                handlerlist.remove(handler)
+        handlerlist.append(function)
+
+
+def create_chunked_meshes(stars, origin, halosize, posfac, cellsize,
+                          fractions=LOD_FRACTIONS, column='hrv',
+                          edges=starcatalog.HRV_EDGES,
+                          colors=starcatalog.HRV_COLORS,
+                          names=starcatalog.HRV_NAMES, prefix='stars-',
+                          seed=0):
+    """Distribute stars into bins of the given column (like
+    create_binned_meshes()) and into cubic cells of a spatial grid,
+    create one object per bin and cell. Each object gets one mesh
+    per level of detail, containing the given fractions of its stars.
+    The stars of a level are chosen by a stable random key per star,
+    and each level contains all stars of the coarser levels.
+
+    Use set_lod(), set_lod_by_distance() and
+    use_full_detail_for_render() for switching the levels.
+    Shapekeys (deform_starmesh.py) are only added to the mesh
+    which is used at that time, so switch to level 0 before.
+
+    stars, origin, halosize, posfac -- see create_binned_meshes()
+    cellsize -- edge length of the grid cells, in scene units
+                (i.e. after scaling with posfac)
+    fractions -- fractions of stars for each level of detail,
+                 starting with full detail
+    column, edges, colors, names, prefix -- see create_binned_meshes()
+    seed -- seed for the random keys of the stars
+    """
+
+    nbins = len(edges) + 1
+    if colors is None:
+        colors = starcatalog.colormap_colors('hrv', nbins)
+    if names is None:
+        names = ['bin%02d' % i for i in range(nbins)]
+
+    coords = star_coordinates(stars, posfac)
+    bins = starcatalog.assign_bins(starcatalog.column_values(stars, column),
+                                   edges)
+    cells, cellids = starcatalog.grid_cells(coords, cellsize)
+    keys = starcatalog.star_keys(len(coords), seed=seed)
+
+    # One sort by bin, cell and key; each group (bin, cell) is then
+    # contiguous and sorted by key, so the levels are prefixes.
+    order = np.lexsort((keys, cellids, bins))
+    bins, cellids = bins[order], cellids[order]
+    coords, cells = coords[order], cells[order]
+
+    newgroup = np.ones(len(order), dtype=bool)
+    newgroup[1:] = (bins[1:] != bins[:-1]) | (cellids[1:] != cellids[:-1])
+    starts = np.flatnonzero(newgroup)
+    ends = np.append(starts[1:], len(order))
+
+    materials = [make_halo_material('Mesh-' + name, Color(col), halosize)
+                 for name, col in zip(names, colors)]
+
+    objects = []
+    for ichunk, (start, end) in enumerate(zip(starts, ends)):
+        ibin = bins[start]
+        name = '%s%s-c%04d' % (prefix, names[ibin], ichunk)
+        verts = coords[start:end]
+
+        lodnames = []
+        for level, fraction in enumerate(fractions):
+            n = max(1, int(np.ceil(fraction*len(verts))))
+            m = create_mesh_data(verts[:n], materials[ibin],
+                                 '%s-lod%d' % (name, level))
+            # Keep meshes which are currently not used by the object
+            m.use_fake_user = True
+            lodnames.append(m.name)
+
+        obj = bpy.data.objects.new(name, bpy.data.meshes[lodnames[0]])
+        track(obj, 'objects')
+        obj.location = origin
+        obj['lod_meshes'] = lodnames
+        # Center of the cell in mesh coordinates, relative to the origin
+        obj['chunk_center'] = ((cells[start] + 0.5)*cellsize).tolist()
+        link_object(obj)
+        objects.append(obj)
+
+    print("%d stars distributed to %d chunks with %d levels of detail."
+          % (len(order), len(objects), len(fractions)))
+
+    return objects
+
+
+# Columns stored as vertex attributes by create_attribute_mesh()
+ATTRIBUTE_COLUMNS = ('hrv', 'teff', 'dist')
+
+
+def create_attribute_mesh(stars, origin, halosize, posfac, column='hrv',
+                          edges=starcatalog.HRV_EDGES, colors=None,
+                          colormap='hrv', name='stars-all'):
+    """Create one mesh for all stars, store hrv, teff and dist as
+    float attributes per vertex and color the stars with a material
+    that maps one of these attributes to colors. Changing the colors
+    later on only needs set_attribute_colors() on the material.
+    Needs Blender 3.0 or newer.
+
+    stars -- dictionary of star columns (x, y, z, hrv, ...),
+             as returned by starcatalog.read_stars()
+    origin -- origin of the mesh
+    halosize -- radius of the rendered points
+    posfac -- scaling factor for positions
+    column -- attribute used for the colors, one of ATTRIBUTE_COLUMNS
+    edges -- sorted bin edges for the colors
+    colors -- list of RGB-tuples, one per bin (len(edges)+1);
+              if None, they are taken from the colormap
+    colormap -- name of colormap, see starcatalog.COLORMAPS
+    name -- name of the mesh-object
+    """
+
+    if colors is None:
+        colors = starcatalog.colormap_colors(colormap, len(edges) + 1)
+
+    mat = make_attribute_material('Mesh-' + column, column, edges, colors)
+    obj = create_mesh(origin, star_coordinates(stars, posfac), mat, name)
+
+    values = dict((key, starcatalog.column_values(stars, key))
+                  for key in ATTRIBUTE_COLUMNS)
+    add_vertex_attributes(obj.data, values)
+    add_points_modifier(obj, halosize, mat)
+
+    print("Mesh with %d stars and attributes %s is created."
+          % (len(values['hrv']), ', '.join(ATTRIBUTE_COLUMNS)))
+
+    return obj
+
+
+def create_voxel_points(grid, origin, posfac, column='hrv',
+                        edges=starcatalog.HRV_EDGES, colors=None,
+                        colormap='hrv', name='stars-voxels'):
+    """Create one mesh with a vertex per occupied voxel of the grid,
+    with the number of stars and the mean of each column of the voxel
+    as float attributes. The vertices are rendered as points, whose
+    size grows with the number of stars (up to half a voxel), colored
+    by the mean of one column. Needs Blender 3.0 or newer.
+
+    grid -- starcatalog.VoxelGrid with the aggregated stars
+    origin -- origin of the mesh
+    posfac -- scaling factor for positions
+    column -- column used for the colors, e.g. 'hrv' or 'teff'
+    edges -- sorted bin edges for the colors
+    colors -- list of RGB-tuples, one per bin (len(edges)+1);
+              if None, they are taken from the colormap
+    colormap -- name of colormap, see starcatalog.COLORMAPS
+    name -- name of the mesh-object
+    """
+
+    if colors is None:
+        colors = starcatalog.colormap_colors(colormap, len(edges) + 1)
+
+    voxels = grid.occupied()
+    mat = make_attribute_material('Voxels-' + column, column, edges, colors)
+    obj = create_mesh(origin, star_coordinates(voxels, posfac), mat, name)
+
+    # Volume of the points proportional to the number of stars
+    counts = voxels['count'].astype(np.float64)
+    radius = 0.5*grid.voxelsize*posfac*np.cbrt(counts/max(1, counts.max()))
+
+    values = dict((key, voxels[key]) for key in grid.sums.keys())
+    values['count'] = counts
+    values['radius'] = radius
+    add_vertex_attributes(obj.data, values)
+    add_points_modifier(obj, 0.5*grid.voxelsize*posfac, mat,
+                        radius_attribute='radius')
+
+    print("Mesh with %d voxels is created." % len(counts))
+
+    return obj
+
+
+def create_voxel_volume(grid, bvoxfile, origin, posfac, density=1.,
+                        name='stars-volume'):
+    """Write the number of stars per voxel into a voxel data file and
+    create a box with a volume material, which renders it as density.
+    Needs Blender Internal (Blender 2.7x).
+
+    grid -- starcatalog.VoxelGrid with the aggregated stars
+    bvoxfile -- name of the voxel data file (.bvox) to be written
+    origin -- origin of the box
+    posfac -- scaling factor for positions
+    density -- density of the volume for the voxel with most stars
+    name -- name of the box-object, material and texture
+    """
+
+    if not hasattr(bpy.types, 'VoxelDataTexture'):
+        raise RuntimeError("Volume materials with voxel data need "
+                           "Blender Internal (Blender 2.7x).")
+
+    starcatalog.write_bvox(bvoxfile, grid.density())
+
+    # Box around the grid, the voxel data fill its bounding box
+    lo = grid.lo*posfac
+    hi = grid.hi*posfac
+    verts = [(x, y, z) for x in (lo[0], hi[0]) for y in (lo[1], hi[1])
+             for z in (lo[2], hi[2])]
+    faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1),
+             (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+
+    m = bpy.data.meshes.new(name)
+    track(m, 'meshes')
+    m.from_pydata(verts, [], faces)
+    m.update()
+
+    mat = bpy.data.materials.new(name)
+    track(mat, 'materials')
+    mat.type = 'VOLUME'
+    mat.volume.density = 0.
+    mat.volume.emission = 1.
+
+    tex = bpy.data.textures.new(name, type='VOXEL_DATA')
+    track(tex, 'textures')
+    tex.voxel_data.file_format = 'BLENDER_VOXEL'
+    tex.voxel_data.filepath = bvoxfile
+    tex.voxel_data.interpolation = 'TRILINEAR'
+
+    slot = mat.texture_slots.add()
+    slot.texture = tex
+    slot.texture_coords = 'ORCO'
+    slot.use_map_density = True
+    slot.density_factor = density
+    slot.use_map_emission = True
+
+    m.materials.append(mat)
+
+    obj = bpy.data.objects.new(name, m)
+    track(obj, 'objects')
+    obj.location = origin
+    link_object(obj)
+
+    print("Volume with %d x %d x %d voxels is created." % grid.shape)
+
+    return obj
 
 
 if __name__ == '__main__':
@@ -300,32 +1546,177 @@ if __name__ == '__main__':
     # Origin of the distribution
     origin = Vector((0, 0, 0))
 
-    # File path
+    # Create one mesh per HRV-bin with halo-materials ('BINS'),
+    # one mesh per HRV-bin and grid cell with levels of detail ('CHUNKS'),
+    # or one mesh with attributes for hrv, teff, dist ('ATTRIBUTES').
+    # 'TIMER' creates the same meshes as 'BINS', but adds the stars
+    # chunk by chunk with a timer, so Blender stays responsive.
+    # Stop it with bpy.app.driver_namespace['ravestars_import'].cancel()
+    # 'VOXELS' aggregates the stars on a grid chunk by chunk, for
+    # catalogs too large for one vertex per star.
+    mode = 'BINS'
+
+    # Edge length of grid cells for mode 'CHUNKS'
+    cellsize = 2.
+
+    # Grid for mode 'VOXELS': edge length of the voxels and corners of
+    # the grid (in kpc, stars outside are skipped), and the output:
+    # one point per voxel ('POINTS', Blender 3.0+) or a density
+    # volume ('VOLUME', Blender 2.7x) from the file bvoxfile
+    voxelsize = 0.05
+    voxelbounds = ((-3., -3., -3.), (3., 3., 3.))
+    voxeloutput = 'POINTS'
+
+    # For a quick preview, only use this fraction of stars of each
+    # HRV-bin (e.g. 0.05), or None for all stars.
+    # With refine = True, the existing preview meshes are kept and
+    # only the missing stars (up to the new fraction) are added.
+    preview = None
+    refine = False
+
+    # Only use stars matching these expressions, e.g. 'dist < 2',
+    # '4000 <= teff <= 7000' or 'hrv valid' (see starcatalog.make_filter)
+    filters = []
+
+    # Merge stars closer than this distance (in Blender units, i.e.
+    # after scaling with posfac), e.g. repeated observations of the same
+    # star, or None for keeping all stars. Their columns are combined
+    # with dedupreducer: 'mean', 'max', 'min' or 'first'.
+    # Not used for modes 'TIMER' and 'VOXELS'.
+    tolerance = None
+    dedupreducer = 'mean'
+
+    # File path; this can also be a .npy-/.npz-file or a directory
+    # with binary columns (see starcatalog.py)
     #dirname = "C:\\Users\\..."  # for Windows users
     dirname = "./examples/"
     filename = 'ravestars-demo.csv'
     filename = dirname+filename
 
-    # Deselect everything before deleting
-    bpy.ops.object.select_all(action='DESELECT')
-
-    # Delete everything we don't need anymore or want to recreate
-    # Be careful to not remove more than you want!
-    objects = get_objects('stars-*')
-    delete_objects(objects)
-
-    delete_unused_meshes()
-
-    # Delete unused materials. This would also be done automatically
-    # when restarting Blender or reloading the file.
-    delete_unused_materials()
-
-    # Read data from file, adjust values
-    lines = read_daiquiri_csv(filename)
-    starlist = adjust_values(lines)
-    del lines[:]
-
-    # Go through the stars, sort them by radial velocity and
-    # add them to corresponding meshes
-    create_hrv_meshes(starlist, origin, halosize, posfac)
-    del starlist[:]
+    # Incremental updates (mode 'BINS' only, not used by default):
+    # set idcolumn to a column with a stable id for each star (e.g.
+    # 'RAVE_OBS_ID') and statefile to a file for the state of the
+    # import (e.g. dirname + 'ravestars-state.npz'), which is then
+    # written by the full import. When a new version of the catalog
+    # changes only some stars, use update = True with the same settings:
+    # then only the meshes with added, removed or changed stars are
+    # modified, and shapekeys, animations and materials are kept.
+    idcolumn = None
+    statefile = None
+    update = False
+    bvoxfile = dirname + 'ravestars-density.bvox'
+
+    if update and (idcolumn is None or statefile is None):
+        print("Updating needs idcolumn and statefile of the first import!")
+        raise RuntimeError("Stopping script because idcolumn or statefile "
+                           "is not set.")
+
+    columns = starcatalog.RAVE_SCHEMA
+    if idcolumn is not None and mode == 'BINS' and preview is None:
+        columns = starcatalog.with_id_column(columns, idcolumn)
+
+    # Measure the stages of the import (wall time, stars per second,
+    # peak memory) and write a json-report to profilefile, or None
+    profilefile = None
+    if profilefile is not None:
+        profiling.enable(profilefile, name='ravestars_mesh')
+        profiling.set_meta(filename=filename, mode=mode)
+
+    with profiling.stage('cleanup'):
+        if refine or update:
+            # Keep the existing meshes
+            pass
+        elif REGISTRY_PROPERTY in bpy.context.scene:
+            # Delete exactly the objects, meshes etc. created by the
+            # last run; materials are kept and reused, if possible
+            delete_tracked(keep_materials=True)
+        else:
+            # No registry yet (file from an older version of this script)
+            # Deselect everything before deleting
+            bpy.ops.object.select_all(action='DESELECT')
+
+            # Delete everything we don't need anymore or want to recreate
+            # Be careful to not remove more than you want!
+            objects = get_objects('stars-*')
+            delete_objects(objects)
+
+            delete_unused_meshes()
+
+            # Delete unused materials. This would also be done automatically
+            # when restarting Blender or reloading the file.
+            delete_unused_materials()
+
+    if mode == 'TIMER' and not (refine or update):
+        importer = ChunkedImport(filename, origin, halosize, posfac,
+                                 chunksize=100000, filters=filters)
+        # Keep a reference, e.g. for cancelling the import
+        bpy.app.driver_namespace['ravestars_import'] = importer
+        importer.start()
+    elif mode == 'VOXELS' and not (refine or update):
+        # Only the grid is kept in memory, not the stars; the chunks are
+        # taken from the cache, if there is one
+        total, chunks = starcatalog.open_star_chunks(filename,
+                                                     chunksize=100000,
+                                                     filters=filters)
+        grid = starcatalog.aggregate_stars(chunks, voxelbounds[0],
+                                           voxelbounds[1], voxelsize)
+        if voxeloutput == 'VOLUME':
+            create_voxel_volume(grid, bvoxfile, origin, posfac)
+        else:
+            create_voxel_points(grid, origin, posfac, column='hrv',
+                                edges=starcatalog.HRV_EDGES,
+                                colors=starcatalog.HRV_COLORS)
+        profiling.finish()
+    else:
+        # Read data from file chunk by chunk, convert to cartesian
+        # coordinates and only keep the converted star columns.
+        # These are cached in .starcache next to the file, so reruns with
+        # the same file don't need to read and convert it again.
+        # Large files are read by several processes (workers=None: all CPUs).
+        # Only stars passing all filters are converted and used.
+        with profiling.stage('load') as st:
+            if tolerance is None:
+                stars = starcatalog.read_stars(filename, columns=columns,
+                                               chunksize=100000,
+                                               usecache=True, workers=None,
+                                               filters=filters)
+            else:
+                # Merge coincident stars chunk by chunk while reading
+                total, chunks = starcatalog.open_star_chunks(
+                    filename, columns=columns, chunksize=100000,
+                    filters=filters)
+                stars = starcatalog.dedup_stars(chunks, tolerance,
+                                                posfac=posfac,
+                                                reducer=dedupreducer)
+            st.add(len(stars['x']))
+
+        if update:
+            # Only apply the changes since the last import
+            update_binned_meshes(stars, posfac, statefile)
+        elif refine:
+            # Add missing stars to the existing preview meshes
+            refine_preview_meshes(get_objects('stars-*'), stars, posfac,
+                                  fraction=preview)
+        elif preview is not None:
+            # Only a fraction of the stars of each HRV-bin
+            create_preview_meshes(stars, origin, halosize, posfac,
+                                  fraction=preview)
+        elif mode == 'CHUNKS':
+            # One object per HRV-bin and grid cell, with levels of detail
+            create_chunked_meshes(stars, origin, halosize, posfac,
+                                  cellsize=cellsize)
+            use_full_detail_for_render()
+        elif mode == 'ATTRIBUTES':
+            # One mesh for all stars, colored by attributes (Blender 3.0+)
+            create_attribute_mesh(stars, origin, halosize, posfac,
+                                  column='hrv', edges=starcatalog.HRV_EDGES,
+                                  colors=starcatalog.HRV_COLORS)
+        else:
+            # Sort the stars by radial velocity and
+            # add them to corresponding meshes
+            create_hrv_meshes(stars, origin, halosize, posfac,
+                              statefile=statefile)
+        del stars
+
+        # The timer import ('TIMER') writes its report when it is done
+        profiling.finish()
@@ -7,71 +7,518 @@ or give time for another sequence of animations in between.
 # Kristin Riebe, E-Science at AIP, kriebe@aip.de, 04.02.2015
 #
 # NOTE: This can break your animation completely, if keyframes
-#       'overtake' one another. There's no error handling included here.
+#       'overtake' one another. Moved keyframes keep their order,
+#       but they can still pass keyframes outside of the frame range.
 # NOTE: Only works properly for fcurves with bezier-shape or poly-curves.
 #       Fcurve-modifiers are not taken into account.
 #
 # TODO: Maybe only stretch keyframes with data_path location etc.
 # for material/texture fades, keep the distance, but
 # shift the initial keyframe?
+#
+# Updates:
+#   16.10.2026: optional profiling of the stages (profiling.py)
+#   16.10.2026: move keyframes of each fcurve at once with numpy,
+#               piecewise time remapping (TimeRemap)
+#   16.10.2026: index of actions and their users (AnimationIndex)
 
 
 import bpy
+import os
+import sys
+import re
 import fnmatch
+import numpy as np
+
+# Make the helper modules next to this script importable,
+# also when running it from within Blender
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import profiling
+
+
+# Enum values of the interpolations and easings of keyframes in
+# Blender, as written with foreach_set and read with foreach_get
+INTERPOLATIONS = {'CONSTANT': 0,
+                  'LINEAR': 1,
+                  'BEZIER': 2,
+                  'BACK': 3,
+                  'BOUNCE': 4,
+                  'CIRC': 5,
+                  'CUBIC': 6,
+                  'ELASTIC': 7,
+                  'EXPO': 8,
+                  'QUAD': 9,
+                  'QUART': 10,
+                  'QUINT': 11,
+                  'SINE': 12}
+EASINGS = {'AUTO': 0,
+           'EASE_IN': 1,
+           'EASE_OUT': 2,
+           'EASE_IN_OUT': 3}
+
+
+def get_action(idblock):
+    """Return action of the datablock, or None"""
+
+    animdata = getattr(idblock, 'animation_data', None)
+    if animdata is None:
+        return None
+
+    return animdata.action
+
+
+def animated_datablocks(obj):
+    """Yield (kind, datablock)-tuples for the object and the datablocks
+    it uses, which can have actions: 'OBJECT', 'DATA' (mesh, camera,
+    ...), 'SHAPEKEYS' (shapekeys of the mesh) and 'MATERIAL'
+    """
+
+    yield 'OBJECT', obj
+
+    if obj.data is not None:
+        yield 'DATA', obj.data
+        shapekeys = getattr(obj.data, 'shape_keys', None)
+        if shapekeys is not None:
+            yield 'SHAPEKEYS', shapekeys
+
+    for matslot in obj.material_slots:
+        if matslot.material is not None:
+            yield 'MATERIAL', matslot.material
+
+
+def compile_patterns(patterns):
+    """Return list of compiled regular expressions for one or a list
+    of name patterns (like fnmatch, e.g. 'stars-*') and/or compiled
+    regular expressions (used as they are, with match())
+    """
+
+    if isinstance(patterns, str) or hasattr(patterns, 'match'):
+        patterns = [patterns]
+
+    return [pattern if hasattr(pattern, 'match')
+            else re.compile(fnmatch.translate(pattern))
+            for pattern in patterns]
+
+
+class AnimationIndex(object):
+    """Index of the actions of objects, their data, shapekeys and
+    materials, and of the users of each action. It is built once and
+    then answers many queries by name patterns without walking through
+    all objects and materials again. After changes, refresh() indexes
+    new objects, drops removed ones and indexes the given or changed
+    ones again (see track_updates()).
+
+    objects -- objects to be indexed (default: all objects)
+    """
+
+    def __init__(self, objects=None):
+        # Names are stored as they were when indexing, so entries can
+        # still be removed after datablocks were renamed
+
+        # Object name -> list of (kind, datablock name, action)
+        self.entries = {}
+
+        # Action -> set of (kind, datablock name, object name)
+        self.users = {}
+
+        # Object name -> list of (kind, datablock name, datablock)
+        self.blocks = {}
+
+        # Datablock pointer (as_pointer()) -> set of object names, for
+        # the object itself, its datablocks and their actions
+        self.users_of_pointer = {}
+
+        # Object name -> pointers of its datablocks and actions
+        self.pointers = {}
+
+        # Names of objects to be indexed again by refresh()
+        self.changed = set()
+        self.handler = None
+
+        if objects is None:
+            objects = bpy.data.objects
+        with profiling.stage('index') as st:
+            st.add(self.update(objects))
+
+    def add(self, obj):
+        """Add object to the index (again)"""
+
+        self.remove(obj.name)
+
+        entries = []
+        blocks = []
+        pointers = set([obj.as_pointer()])
+        for kind, idblock in animated_datablocks(obj):
+            blocks.append((kind, idblock.name, idblock))
+            pointers.add(idblock.as_pointer())
+
+            action = get_action(idblock)
+            if action is not None:
+                entries.append((kind, idblock.name, action))
+                self.users.setdefault(action, set()).add(
+                    (kind, idblock.name, obj.name))
+                pointers.add(action.as_pointer())
+
+        self.entries[obj.name] = entries
+        self.blocks[obj.name] = blocks
+        self.pointers[obj.name] = pointers
+        for pointer in pointers:
+            self.users_of_pointer.setdefault(pointer, set()).add(obj.name)
+
+    def remove(self, name):
+        """Remove object with the given name from the index"""
+
+        entries = self.entries.pop(name, None)
+        if entries is None:
+            return
+
+        for kind, blockname, action in entries:
+            users = self.users.get(action)
+            if users is not None:
+                users.discard((kind, blockname, name))
+                if not users:
+                    del self.users[action]
+
+        del self.blocks[name]
+
+        # Pointers were stored when indexing, the datablocks themselves
+        # may already be gone
+        for pointer in self.pointers.pop(name):
+            names = self.users_of_pointer.get(pointer)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self.users_of_pointer[pointer]
+
+    def update(self, objects):
+        """Index the given objects again, return their number"""
+
+        n = 0
+        for obj in objects:
+            self.add(obj)
+            self.changed.discard(obj.name)
+            n += 1
+
+        return n
+
+    def refresh(self, objects=None):
+        """Update the index for changed objects: add new objects, drop
+        removed ones and index the given objects (default: the ones
+        marked as changed, see mark_changed()) again.
+        Return the number of indexed objects.
+        """
+
+        names = set(obj.name for obj in bpy.data.objects)
+        for name in set(self.entries.keys()) - names:
+            self.remove(name)
+
+        changed = set(self.changed)
+        if objects is not None:
+            changed.update(obj.name for obj in objects)
+        changed.update(names - set(self.entries.keys()))
+        self.changed.clear()
+
+        with profiling.stage('index') as st:
+            n = self.update(bpy.data.objects[name] for name in changed
+                            if name in names)
+            st.add(n)
+
+        return n
+
+    def mark_changed(self, idblock):
+        """Mark the objects using the datablock (object, data,
+        shapekeys, material or action) as changed, for refresh().
+        New objects need no marking, refresh() adds them anyway.
+        """
+
+        # Look up the datablock by its pointer, not its name, which may
+        # have changed; runs for every update, so must not scan the index
+        names = self.users_of_pointer.get(idblock.as_pointer())
+        if names is not None:
+            self.changed.update(names)
+
+    def on_update(self, scene, depsgraph=None):
+        """Handler: mark updated datablocks as changed"""
+
+        if depsgraph is None:
+            depsgraph = bpy.context.evaluated_depsgraph_get()
+
+        for update in depsgraph.updates:
+            self.mark_changed(getattr(update.id, 'original', update.id))
+
+    def track_updates(self):
+        """Mark datablocks as changed whenever Blender updates them
+        (Blender 2.80 or newer), so that refresh() indexes only the
+        changed objects again. Return False, if not supported.
+        """
+
+        handlers = getattr(bpy.app.handlers, 'depsgraph_update_post', None)
+        if handlers is None:
+            print("Tracking updates needs Blender 2.80 or newer, "
+                  "use refresh() with the changed objects instead.")
+            return False
+
+        if self.handler is None:
+            self.handler = self.on_update
+            handlers.append(self.handler)
+
+        return True
+
+    def untrack_updates(self):
+        """Stop marking updated datablocks, see track_updates()"""
+
+        if self.handler is not None:
+            bpy.app.handlers.depsgraph_update_post.remove(self.handler)
+            self.handler = None
+
+    def match(self, patterns="*"):
+        """Return sorted names of the indexed objects matching any of
+        the patterns, see compile_patterns()
+        """
+
+        regexes = compile_patterns(patterns)
+
+        return sorted(name for name in self.entries
+                      if any(regex.match(name) for regex in regexes))
 
+    def query(self, patterns):
+        """Return dictionary with the set of actions for the matching
+        objects for each of the patterns, collected in one pass
+        patterns -- list of name patterns and/or compiled regular
+                    expressions, see compile_patterns()
+        """
 
-def get_actions_for_objects(namepattern="*"):
-    """Collect all actions for the matching objects, their data 
-    and their materials. Each material-action is to be used only once.
+        if isinstance(patterns, str) or hasattr(patterns, 'match'):
+            patterns = [patterns]
+        regexes = list(zip(patterns, compile_patterns(patterns)))
+
+        result = dict((pattern, set()) for pattern in patterns)
+        for name, entries in self.entries.items():
+            for pattern, regex in regexes:
+                if regex.match(name):
+                    result[pattern].update(action for kind, blockname, action
+                                           in entries)
+
+        return result
+
+    def actions(self, patterns="*"):
+        """Return set of actions for the objects matching any of the
+        patterns, their data, shapekeys and materials; each action
+        only once, even if it is shared
+        """
+
+        actions = set()
+        for name in self.match(patterns):
+            actions.update(action for kind, blockname, action
+                           in self.entries[name])
+
+        return actions
+
+    def action_users(self, action):
+        """Return sorted list of (kind, datablock name, object name)
+        for the users of the action
+        """
+
+        return sorted(self.users.get(action, ()))
+
+    def shared_actions(self, patterns="*"):
+        """Return dictionary of the actions for the matching objects
+        which are also used by non-matching objects (e.g. by a shared
+        material), with the sorted list of these other users; changing
+        such an action changes the animation of these objects as well
+        """
+
+        names = set(self.match(patterns))
+
+        shared = {}
+        for action in self.actions(patterns):
+            others = [user for user in self.action_users(action)
+                      if user[2] not in names]
+            if others:
+                shared[action.name] = others
+
+        return shared
+
+    def report_shared(self, patterns="*"):
+        """Print warning for each action of the matching objects that
+        is also used by non-matching objects, return shared_actions()
+        """
+
+        shared = self.shared_actions(patterns)
+        for actionname, others in sorted(shared.items()):
+            print("Warning: action %s is also used by %s."
+                  % (actionname, ', '.join("%s %s of %s" % user
+                                           for user in others)))
+
+        return shared
+
+
+def get_actions_for_objects(namepattern="*", index=None):
+    """Collect all actions for the matching objects, their data,
+    shapekeys and their materials. Each material-action is to be
+    used only once.
     Return set of actions that can be used as input for
     shift_keyframes().
 
     Keyword arguments:
     namepattern -- name pattern of objects for which the animation-
-                   actions are collected. (default: *)
+                   actions are collected, or compiled regular expression,
+                   or list of them (default: *)
+    index -- AnimationIndex to be used, e.g. for many calls with
+             different patterns (default: a new one for all objects)
 
     """
     # NOTE: If a non-matching object has the same material as a
     # matching object, its material keyframes will be shifted!!
     # If you don't want that, make the non-matching object's material
-    # unique beforehand.
-
-    # Find matching objects and store in list
-    bpy.ops.object.select_all(action='DESELECT')
-    objects = [obj for obj in bpy.data.objects
-               if fnmatch.fnmatchcase(obj.name, namepattern)]
-
-    # Gather all necessary actions for the objects and their materials,
-    # use set() in order to get unique values only,
-    # i.e. each animation-action (especially for materials) shall occur only
-    # once.
-    actions = set()
-    for obj in objects:
-        print("Object ", obj.name)
-
-        if obj.animation_data is not None:
-            action = obj.animation_data.action
-            if action is not None:
-                actions.add(action)
+    # unique beforehand. A warning is printed for these actions.
 
-        if obj.data is not None:
-            if obj.data.animation_data is not None:
-                action = obj.data.animation_data.action
-                if action is not None:
-                    actions.add(action)
+    if index is None:
+        index = AnimationIndex()
 
-        # Loop over materials of this object
-        for matslot in obj.material_slots:
-            print("Material ", matslot.name)
+    with profiling.stage('collect') as st:
+        st.add(len(index.match(namepattern)))
+        actions = index.actions(namepattern)
 
-            if matslot.material.animation_data is not None:
-                action = matslot.material.animation_data.action
-                if action is not None:
-                    actions.add(action)
+    print("%d actions found for %s." % (len(actions), namepattern))
+    index.report_shared(namepattern)
 
     return actions
 
 
+class TimeRemap(object):
+    """Piecewise linear mapping of old frames to new frames, given by
+    (oldframe, newframe)-points; beyond the first and last point, the
+    first and last segment are continued.
+    E.g. TimeRemap([(0, 0), (100, 100), (200, 300)]) keeps frames up
+    to 100 and stretches the following ones by factor 2.
+
+    points -- list of (oldframe, newframe)-tuples, at least two,
+              both strictly increasing (keyframes must not overtake
+              one another)
+    """
+
+    def __init__(self, points):
+
+        points = np.array(sorted(points), dtype=np.float64).reshape(-1, 2)
+        if (len(points) < 2 or np.any(np.diff(points[:, 0]) <= 0)
+                or np.any(np.diff(points[:, 1]) <= 0)):
+            print("Invalid time remapping %s!" % points.tolist())
+            raise RuntimeError("Need at least two points with increasing "
+                               "old and new frames for remapping.")
+
+        self.old = points[:, 0]
+        self.new = points[:, 1]
+        self.slope = np.diff(self.new)/np.diff(self.old)
+
+    def segments(self, frames, side='right'):
+        """Return index of the segment for each frame; at the given
+        points, the one to the right or left of it (side)
+        """
+
+        index = np.searchsorted(self.old, frames, side=side) - 1
+        return np.clip(index, 0, len(self.slope) - 1)
+
+    def __call__(self, frames):
+        """Return new frames for the given (array of) old frames"""
+
+        frames = np.asarray(frames, dtype=np.float64)
+        seg = self.segments(frames)
+
+        return self.new[seg] + (frames - self.old[seg])*self.slope[seg]
+
+    def slopes(self, frames):
+        """Return slopes left and right of the given frames"""
+
+        return (self.slope[self.segments(frames, side='left')],
+                self.slope[self.segments(frames, side='right')])
+
+
+def affine_remap(factor=1, frameshift=0):
+    """Return TimeRemap, which multiplies frames by factor and then
+    adds frameshift
+    """
+
+    return TimeRemap([(0, frameshift), (1, factor + frameshift)])
+
+
+def retime_fcurve(fcurve, remap, frame_start=0, frame_end=1000000):
+    """Move keyframes of the fcurve in the given range of frames to
+    new frames, reading and writing all keyframes at once. The handles
+    keep their direction relative to the keyframe, scaled by the slope
+    of the remapping; then Blender sorts the keyframes and recalculates
+    automatic handles. Return the number of moved keyframes.
+
+    fcurve -- fcurve to be changed
+    remap -- TimeRemap or function for arrays of frames
+    frame_start, frame_end -- range of frames of the keyframes which
+                              are moved
+    """
+
+    points = fcurve.keyframe_points
+    n = len(points)
+    if n == 0:
+        return 0
+
+    arrays = {}
+    for attr in ('co', 'handle_left', 'handle_right'):
+        values = np.empty(n*2, dtype=np.float32)
+        points.foreach_get(attr, values)
+        arrays[attr] = values.reshape(-1, 2)
+
+    frames = arrays['co'][:, 0].astype(np.float64)
+    mask = (frames >= frame_start) & (frames <= frame_end)
+    nmoved = int(np.count_nonzero(mask))
+    if nmoved == 0:
+        return 0
+
+    frames = frames[mask]
+    if hasattr(remap, 'slopes'):
+        left, right = remap.slopes(frames)
+    else:
+        left = right = 1.
+    newframes = remap(frames)
+
+    for attr, slope in (('handle_left', left), ('handle_right', right)):
+        offset = arrays[attr][mask, 0] - frames
+        arrays[attr][mask, 0] = newframes + offset*slope
+    arrays['co'][mask, 0] = newframes
+
+    for attr, values in arrays.items():
+        points.foreach_set(attr, values.reshape(-1))
+    fcurve.update()
+
+    return nmoved
+
+
+def retime_actions(actions, remap, frame_start=0, frame_end=1000000):
+    """Move keyframes of all fcurves of the actions in the given range
+    of frames to new frames, see retime_fcurve().
+    Return the number of moved keyframes.
+
+    actions -- set or list of actions
+    remap -- TimeRemap, e.g. from affine_remap(), or function
+             for arrays of frames
+    frame_start, frame_end -- range of frames of the keyframes which
+                              are moved
+    """
+
+    nshifted = 0
+    with profiling.stage('keyframes') as st:
+        for action in actions:
+            nmoved = 0
+            for fcu in action.fcurves:
+                nmoved += retime_fcurve(fcu, remap, frame_start, frame_end)
+
+            print("Action %s: %d keyframes in %d fcurves moved."
+                  % (action.name, nmoved, len(action.fcurves)))
+            nshifted += nmoved
+
+        st.add(nshifted)
+
+    return nshifted
+
+
 def shift_keyframes(actions=bpy.data.actions, factor=1, frameshift=0,
                     frame_start=0, frame_end=1000000):
     """
@@ -86,37 +533,28 @@ def shift_keyframes(actions=bpy.data.actions, factor=1, frameshift=0,
                 shifted (default: all actions available)
     frame_start, frame_end -- range of frames for which keyframe_points
                               are shifted
-    factor -- stretch keyframe_points in given range by this factor
+    factor -- stretch keyframe_points in given range by this factor,
+              must be positive
     frameshift -- add this number to the keyframe_points in given range
     """
 
-    # Loop over all actions and their fcurves,
-    # multiply keyframe-positions and handles by given factor
-    # and then shift by given frameshift
-    for action in actions:
-        print("Action ", action.name)
-
-        for fcu in action.fcurves:
-            print("  %s  channel %d" % (fcu.data_path, fcu.array_index))
-
-            for keyframe in fcu.keyframe_points:
-
-                if (keyframe.co[0] >= frame_start
-                        and keyframe.co[0] <= frame_end):
-
-                    #print("    %s" % keyframe.co)  # coordinates x,y
-
-                    keyframe.co[0] = keyframe.co[0]*factor + frameshift
-                    keyframe.handle_left[0] = (keyframe.handle_left[0]*factor
-                                               + frameshift)
-                    keyframe.handle_right[0] = (keyframe.handle_right[0]*factor
-                                                + frameshift)
+    # Multiply keyframe-positions and handles by given factor
+    # and then shift by given frameshift, for all keyframes
+    # of an fcurve at once, see retime_actions()
+    retime_actions(actions, affine_remap(factor, frameshift),
+                   frame_start=frame_start, frame_end=frame_end)
 
     return
 
 
 if __name__ == "__main__":
 
+    # Measure the stages (wall time, keyframes per second, peak memory)
+    # and write a json-report to profilefile, or None
+    profilefile = None
+    if profilefile is not None:
+        profiling.enable(profilefile, name='shift_keyframes')
+
     # Just stretch everything by factor 3
     #shift_keyframes(factor=3)
 
@@ -124,5 +562,17 @@ if __name__ == "__main__":
     actions = get_actions_for_objects(namepattern='C*')
     #print('Actions: ', actions)
 
+    # For several parts of a film, build the index only once
+    #index = AnimationIndex()
+    #actions = get_actions_for_objects('C*', index=index)
+    #parts = index.query(['stars-*', re.compile(r'Camera\.\d+')])
+
     # Stretch only keyframes for these animation actions
     shift_keyframes(actions=actions, factor=2)
+
+    # Or keep frames up to 100, slow down the following 100 frames
+    # by factor 3 and shift everything after them accordingly
+    #remap = TimeRemap([(0, 0), (100, 100), (200, 400), (300, 500)])
+    #retime_actions(actions, remap)
+
+    profiling.finish()
@@ -0,0 +1,1853 @@
+"""
+Column-wise helpers for star catalogs, e.g. the RAVE-stars used by
+ravestars_mesh.py. Whole columns (numpy arrays) are converted at once
+instead of looping over single stars in Python.
+"""
+# This module only needs numpy (which is shipped with Blender),
+# not bpy, so it can also be used outside of Blender.
+#
+# Missing values (blank fields in the csv-file) are stored as NaN
+# in the float columns, so they can be masked instead of checked
+# row by row.
+#
+# Only the columns declared in a schema (see Column, RAVE_SCHEMA) are
+# kept when parsing, with their own float type, default for missing
+# values and unit factor. Other catalogs just need another schema.
+#
+# Catalogs are read in chunks of rows, so that the memory needed for
+# parsing depends on the chunk size, not on the size of the catalog.
+#
+# Besides csv-files, catalogs can also be given as binary columns,
+# which are memory-mapped and read in chunks without copying:
+# - .npy-file with a structured array, one field per column
+# - .npz-file with one array per column (memory-mapped only if the
+#   file is not compressed, i.e. written with numpy.savez)
+# - directory with one raw binary file per column and a file
+#   columns.json, describing them:
+#       {"nrows": 1000000,
+#        "columns": {"Glon": {"file": "Glon.bin", "dtype": "<f8"},
+#                    "HRV": {"file": "HRV.bin", "dtype": "<f4"}, ...}}
+#   The column names are the same as in the csv-files (see schema).
+#
+# Rows can be filtered by simple expressions like 'dist < 2',
+# '4000 <= teff <= 7000' or 'hrv valid', which are applied to each
+# chunk as vectorized masks before the conversion, see make_filters().
+#
+# Large files can also be split into byte ranges (at line boundaries),
+# which are parsed and converted in parallel by several processes.
+#
+# The converted star columns can be cached on disk as .npy-files
+# (one per column), which are memory-mapped when reading them again.
+# The cache is keyed by file path, size and modification time of the
+# csv-file and by the column mapping, so it is renewed automatically
+# when any of these change.
+#
+# Stars can have a stable id (schema key 'id', see with_id_column()),
+# e.g. for updating the meshes of an earlier import when a new data
+# release changes only some of the stars. The state of an import
+# (ids, bins and positions of the stars in the order of the mesh
+# vertices) is stored in a .npz-file, see save_import_state().
+#
+# For very large catalogs, stars can be aggregated on a regular 3D grid
+# (VoxelGrid) chunk by chunk, keeping only the number of stars and the
+# sums of some columns per voxel, so the memory depends on the size of
+# the grid, not on the number of stars.
+#
+# Stars at (nearly) the same position, e.g. from repeated observations
+# or merged catalogs, can be merged: each star is merged into the first
+# earlier star within the tolerance, found with a spatial hash (cells
+# of the size of the tolerance and their neighbours), see
+# StarDeduplicator.
+
+
+import os
+import sys
+import csv
+import json
+import multiprocessing
+import shutil
+import hashlib
+import re
+import zipfile
+import operator
+import collections
+import numpy as np
+
+import profiling
+
+
+# Names of the converted star columns
+STAR_COLUMNS = ('x', 'y', 'z', 'hrv', 'teff')
+
+# Columns needed for the conversion and their names in the
+# csv-files of the RAVE-database (Daiquiri web interface)
+RAVE_COLUMNS = {'glon': 'Glon',
+                'glat': 'Glat',
+                'dist': 'dist',
+                'hrv': 'HRV',
+                'teff': 'Teff_K'}
+
+# Declaration of an input column:
+# name -- column name in the file
+# dtype -- numpy float type used for storing the values
+# default -- value for missing (blank) fields, NaN by default
+# scale -- factor for converting to the units used here
+#          (kpc, km/s, K), 1 by default
+Column = collections.namedtuple('Column', ['name', 'dtype', 'default',
+                                           'scale'])
+Column.__new__.__defaults__ = (np.float64, np.nan, 1.)
+
+# Schema for the RAVE-database; positions need double precision,
+# radial velocities and temperatures don't
+RAVE_SCHEMA = {'glon': Column('Glon', np.float64),
+               'glat': Column('Glat', np.float64),
+               'dist': Column('dist', np.float64),
+               'hrv': Column('HRV', np.float32),
+               'teff': Column('Teff_K', np.float32)}
+
+# Schema for Gaia-like exports (e.g. Gaia DR3 gaia_source),
+# distances are given in pc there
+GAIA_SCHEMA = {'glon': Column('l', np.float64),
+               'glat': Column('b', np.float64),
+               'dist': Column('distance_gspphot', np.float64, np.nan, 0.001),
+               'hrv': Column('radial_velocity', np.float32),
+               'teff': Column('teff_gspphot', np.float32)}
+
+# Default number of rows per chunk
+CHUNKSIZE = 100000
+
+# Files smaller than this (in bytes) are always read by one process
+PARALLEL_MINSIZE = 32*1024*1024
+
+# Increase this when the layout of cached files changes,
+# so that old caches are not used anymore
+CACHE_VERSION = 2
+
+# Bins for radial velocities (HRV), as used for the RAVE-stars:
+# blue: HRV <= -50, cyan: <= -10, yellow: <= 10, orange: <= 50, red: > 50
+HRV_EDGES = [-50, -10, 10, 50]
+HRV_COLORS = [(0, 0, 1), (0, 1, 1), (1, 1, 0), (1, 0.4, 0), (1, 0, 0)]
+HRV_NAMES = ['blue', 'cyan', 'yellow', 'orange', 'red']
+
+# Anchor colors of named colormaps, interpolated linearly
+# for the requested number of bins
+COLORMAPS = {'hrv': HRV_COLORS,
+             'coolwarm': [(0.23, 0.30, 0.75), (0.87, 0.87, 0.87),
+                          (0.71, 0.02, 0.15)],
+             'viridis': [(0.27, 0.00, 0.33), (0.23, 0.32, 0.55),
+                         (0.13, 0.57, 0.55), (0.37, 0.79, 0.38),
+                         (0.99, 0.91, 0.14)],
+             'heat': [(0.2, 0, 0), (1, 0, 0), (1, 0.6, 0), (1, 1, 0.6)]}
+
+
+def parse_column(values, dtype=np.float64):
+    """Convert a sequence of strings into a float array,
+    blank strings become NaN. For a string dtype (e.g. for ids),
+    the strings are kept as they are.
+
+    values -- sequence of strings, e.g. one column of a csv-file
+    dtype -- numpy float type for the returned array
+    """
+
+    raw = np.asarray(values, dtype=str)
+    if raw.size == 0:
+        return np.empty(0, dtype=dtype)
+    if np.dtype(dtype).kind in 'US':
+        return raw
+
+    raw = np.where(raw == '', 'nan', raw)
+
+    return raw.astype(dtype)
+
+
+def open_daiquiri_csv(filename):
+    """Open a csv-file, as returned by the Daiquiri web interface,
+    check that it has a header and return the file object.
+    """
+
+    if (os.path.isfile(filename)):
+        pass
+    else:
+        print("File %s does not exist!" % filename)
+        raise RuntimeError("Stopping script because file was not found.")
+
+    csvfile = open(filename, newline='')
+    headerFlag = csv.Sniffer().has_header(csvfile.read(1024))
+    csvfile.seek(0)
+    if (not headerFlag):
+        csvfile.close()
+        print("No header found in csv file!")
+        raise RuntimeError("Stopping script because file has no proper \
+                           header.")
+
+    return csvfile
+
+
+def make_schema(columns):
+    """Return schema, i.e. dictionary of our names and Column-tuples.
+
+    columns -- dictionary, maps our names to Column-tuples or just to
+               column names in the file (for float64 columns)
+    """
+
+    schema = {}
+    for key, col in columns.items():
+        if isinstance(col, str):
+            col = Column(col)
+        schema[key] = Column(col.name, np.dtype(col.dtype), col.default,
+                             col.scale)
+
+    return schema
+
+
+def with_id_column(columns, name, dtype=str):
+    """Return copy of the schema with an additional column 'id',
+    which is kept as star id in the converted star columns
+
+    columns -- schema or dictionary of column names, see make_schema()
+    name -- name of the id column in the file, e.g. 'RAVE_OBS_ID'
+    dtype -- str for text ids (hashed to integers, see hash_ids()),
+             or an integer type
+    """
+
+    schema = make_schema(columns)
+    schema['id'] = Column(name, np.dtype(dtype))
+
+    return schema
+
+
+def star_columns(columns):
+    """Return names of the converted star columns for the given schema,
+    i.e. STAR_COLUMNS and 'id', if the schema has an id column
+    """
+
+    if 'id' in columns:
+        return STAR_COLUMNS + ('id',)
+
+    return STAR_COLUMNS
+
+
+def schema_key(columns):
+    """Return a string describing the schema, e.g. for cache keys"""
+
+    schema = make_schema(columns)
+
+    return repr(sorted((key, col.name, col.dtype.str, repr(col.default),
+                        col.scale) for key, col in schema.items()))
+
+
+def column_indexes(header, columns):
+    """Return list of positions of the given columns in the header
+
+    header -- list of column names, first row of the csv-file
+    columns -- schema or dictionary of column names, see make_schema()
+    """
+
+    indexes = []
+    for key, col in make_schema(columns).items():
+        name = col.name
+        if name not in header:
+            print("Column %s (for %s) not found in csv file!" % (name, key))
+            raise RuntimeError("Stopping script because of missing column.")
+        indexes.append(header.index(name))
+
+    return indexes
+
+
+def iter_daiquiri_chunks(filename, columns=RAVE_SCHEMA, chunksize=CHUNKSIZE):
+    """Read a Daiquiri csv-file in chunks of rows,
+    yield each chunk as dictionary of float arrays,
+    with the keys of columns. Blank fields get the default
+    of their column (NaN), all other columns of the file are skipped.
+
+    filename -- name of the csv-file
+    columns -- schema or dictionary of column names, see make_schema()
+               (default: RAVE_SCHEMA)
+    chunksize -- maximum number of rows per chunk
+    """
+
+    schema = make_schema(columns)
+
+    with open_daiquiri_csv(filename) as csvfile:
+        reader = csv.reader(csvfile, delimiter=',')
+        header = next(reader)
+        indexes = column_indexes(header, schema)
+
+        # Only keep the needed fields of each row
+        getfields = field_getter(indexes)
+
+        rows = []
+        for row in reader:
+            if not row:
+                continue
+            rows.append(getfields(row))
+
+            if len(rows) == chunksize:
+                yield rows_to_columns(rows, schema)
+                rows = []
+
+        if rows:
+            yield rows_to_columns(rows, schema)
+
+
+def field_getter(indexes):
+    """Return function, which returns the fields at the given
+    positions of a row as tuple
+    """
+
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda row: (row[index],)
+
+    return operator.itemgetter(*indexes)
+
+
+def rows_to_columns(rows, schema):
+    """Convert list of rows (tuples of strings, in the order of
+    the schema) into a dictionary of float arrays, with types,
+    defaults and unit factors as given by the schema
+    """
+
+    chunk = {}
+    for (key, col), values in zip(schema.items(), zip(*rows)):
+        chunk[key] = apply_column(parse_column(values, dtype=col.dtype), col)
+
+    return chunk
+
+
+def apply_column(values, col):
+    """Apply type, default for missing values and unit factor
+    of the Column-tuple col to the array of values. The array is only
+    copied, if this is needed.
+    """
+
+    values = np.asarray(values)
+    if values.dtype != col.dtype:
+        values = values.astype(col.dtype)
+
+    if not np.isnan(col.default):
+        missing = np.isnan(values)
+        if missing.any():
+            values = np.where(missing, values.dtype.type(col.default), values)
+
+    if col.scale != 1:
+        values = values*values.dtype.type(col.scale)
+
+    return values
+
+
+def is_binary_catalog(filename):
+    """Return True, if the catalog is given as binary columns
+    (.npy, .npz or directory with columns.json), not as csv-file
+    """
+
+    return (os.path.isdir(filename)
+            or os.path.splitext(filename)[1].lower() in ('.npy', '.npz'))
+
+
+def npz_member_memmap(filename, member):
+    """Return memory-mapped array for one member of an uncompressed
+    .npz-file, or None if the member is compressed
+    """
+
+    with zipfile.ZipFile(filename) as zf:
+        info = zf.getinfo(member)
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    with open(filename, 'rb') as f:
+        # Skip the local file header of the zip member
+        f.seek(info.header_offset + 26)
+        namelen = int.from_bytes(f.read(2), 'little')
+        extralen = int.from_bytes(f.read(2), 'little')
+        f.seek(info.header_offset + 30 + namelen + extralen)
+
+        # Read the header of the .npy-data
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    if dtype.hasobject:
+        return None
+
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                     shape=shape, order='F' if fortran else 'C')
+
+
+def open_binary_catalog(filename):
+    """Open catalog given as binary columns (see top of this module),
+    return dictionary of column names and (memory-mapped) arrays
+    """
+
+    if not os.path.exists(filename):
+        print("File %s does not exist!" % filename)
+        raise RuntimeError("Stopping script because file was not found.")
+
+    arrays = {}
+    if os.path.isdir(filename):
+        with open(os.path.join(filename, 'columns.json')) as f:
+            meta = json.load(f)
+        for name, desc in meta['columns'].items():
+            arrays[name] = np.memmap(os.path.join(filename, desc['file']),
+                                     dtype=np.dtype(desc['dtype']), mode='r',
+                                     shape=(meta['nrows'],))
+
+    elif filename.lower().endswith('.npz'):
+        with np.load(filename) as npz:
+            names = list(npz.files)
+        for name in names:
+            values = npz_member_memmap(filename, name + '.npy')
+            if values is None:
+                # Compressed, needs to be read into memory
+                with np.load(filename) as npz:
+                    values = npz[name]
+            arrays[name] = values
+
+    else:
+        table = np.load(filename, mmap_mode='r')
+        if table.dtype.names is None:
+            raise RuntimeError("Need structured array with named columns "
+                               "in %s." % filename)
+        for name in table.dtype.names:
+            arrays[name] = table[name]
+
+    return arrays
+
+
+def iter_binary_chunks(filename, columns=RAVE_SCHEMA, chunksize=CHUNKSIZE):
+    """Read catalog given as binary columns in chunks of rows,
+    yield each chunk as dictionary of float arrays with the keys
+    of columns, like iter_daiquiri_chunks()
+    """
+
+    schema = make_schema(columns)
+    arrays = open_binary_catalog(filename)
+
+    for key, col in schema.items():
+        if col.name not in arrays:
+            print("Column %s (for %s) not found in %s!"
+                  % (col.name, key, filename))
+            raise RuntimeError("Stopping script because of missing column.")
+
+    nrows = len(arrays[schema[list(schema.keys())[0]].name])
+    for start in range(0, nrows, chunksize):
+        chunk = {}
+        for key, col in schema.items():
+            # Slicing memory-mapped arrays does not copy anything
+            values = arrays[col.name][start:start + chunksize]
+            chunk[key] = apply_column(values, col)
+        yield chunk
+
+
+def iter_catalog_chunks(filename, columns=RAVE_SCHEMA, chunksize=CHUNKSIZE):
+    """Read catalog (csv-file or binary columns) in chunks of rows,
+    see iter_daiquiri_chunks() and iter_binary_chunks()
+    """
+
+    if is_binary_catalog(filename):
+        return iter_binary_chunks(filename, columns=columns,
+                                  chunksize=chunksize)
+
+    return iter_daiquiri_chunks(filename, columns=columns,
+                                chunksize=chunksize)
+
+
+# Comparison operators for filter expressions
+FILTER_OPERATORS = {'<': operator.lt,
+                    '<=': operator.le,
+                    '>': operator.gt,
+                    '>=': operator.ge,
+                    '==': operator.eq,
+                    '!=': operator.ne}
+
+FILTER_NUMBER = r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+FILTER_OP = r'(<=|>=|==|!=|<|>)'
+FILTER_COMPARE = re.compile(r'^\s*(\w+)\s*' + FILTER_OP + r'\s*'
+                            + FILTER_NUMBER + r'\s*$')
+FILTER_RANGE = re.compile(r'^\s*' + FILTER_NUMBER + r'\s*(<=|<)\s*(\w+)\s*'
+                          + r'(<=|<)\s*' + FILTER_NUMBER + r'\s*$')
+FILTER_VALID = re.compile(r'^\s*(\w+)\s+(valid|missing)\s*$')
+
+
+def not_missing(values):
+    """Return boolean mask of the values, which are not missing (NaN)"""
+
+    values = np.asarray(values)
+    if values.dtype.kind != 'f':
+        return np.ones(len(values), dtype=bool)
+
+    return ~np.isnan(values)
+
+
+def make_filter(expression, columns=None):
+    """Return function, which returns a boolean mask of accepted rows
+    for a chunk of catalog columns (keys as in the schema).
+    Missing values (NaN) fail all comparisons, also '!='.
+
+    expression -- string, one of:
+                  'column < value' (or <=, >, >=, ==, !=),
+                  'value1 <= column < value2' (with < or <=),
+                  'column valid' (no missing value),
+                  'column missing'
+    columns -- schema or dictionary of column names (see make_schema())
+               for checking the column of the expression, or None
+    """
+
+    column = None
+    accept = None
+
+    match = FILTER_COMPARE.match(expression)
+    if match:
+        column, op, value = match.groups()
+        compare, value = FILTER_OPERATORS[op], float(value)
+
+        def accept_compare(chunk):
+            return compare(chunk[column], value) & not_missing(chunk[column])
+
+        accept = accept_compare
+
+    match = FILTER_RANGE.match(expression)
+    if match:
+        lo, op1, column, op2, hi = match.groups()
+        compare1, compare2 = FILTER_OPERATORS[op1], FILTER_OPERATORS[op2]
+        lo, hi = float(lo), float(hi)
+
+        def accept_range(chunk):
+            return (compare1(lo, chunk[column])
+                    & compare2(chunk[column], hi)
+                    & not_missing(chunk[column]))
+
+        accept = accept_range
+
+    match = FILTER_VALID.match(expression)
+    if match:
+        column, kind = match.groups()
+
+        def accept_valid(chunk):
+            return not_missing(chunk[column])
+
+        def accept_missing(chunk):
+            return ~not_missing(chunk[column])
+
+        accept = accept_valid if kind == 'valid' else accept_missing
+
+    if accept is None:
+        raise RuntimeError("Cannot understand filter expression '%s'."
+                           % expression)
+
+    if columns is not None and column not in columns:
+        print("Filter expression '%s': unknown column '%s', "
+              "available are: %s"
+              % (expression, column, ', '.join(sorted(columns))))
+        raise RuntimeError("Unknown column '%s' in filter expression '%s'."
+                           % (column, expression))
+
+    return accept
+
+
+def make_filters(expressions, columns=None):
+    """Return list of (expression, function)-tuples for the given
+    filter expressions, see make_filter(). If columns (schema or
+    dictionary of column names) are given, the column names of the
+    expressions are checked against its keys.
+    """
+
+    if not expressions:
+        return []
+
+    return [(expression, make_filter(expression, columns))
+            for expression in expressions]
+
+
+def filter_chunk(chunk, filters, dropped=None):
+    """Return chunk with only those rows, which pass all filters.
+    Each dropped row is counted for the first filter it fails.
+
+    chunk -- dictionary of catalog columns
+    filters -- list of (expression, function)-tuples, see make_filters()
+    dropped -- dictionary for counting the dropped rows per expression,
+               or None
+    """
+
+    if not filters:
+        return chunk
+
+    keep = None
+    for expression, accept in filters:
+        mask = np.asarray(accept(chunk), dtype=bool)
+        if keep is None:
+            ndropped = len(mask) - np.count_nonzero(mask)
+            keep = mask
+        else:
+            ndropped = np.count_nonzero(keep & ~mask)
+            keep &= mask
+
+        if dropped is not None:
+            dropped[expression] = dropped.get(expression, 0) + int(ndropped)
+
+    if keep.all():
+        return chunk
+
+    return dict((key, values[keep]) for key, values in chunk.items())
+
+
+def print_dropped(dropped):
+    """Print number of rows dropped by each filter expression"""
+
+    for expression, ndropped in dropped.items():
+        print("Filter '%s' dropped %d rows." % (expression, ndropped))
+
+
+def fill_missing(values, fill=0.):
+    """Return float array with NaN-values replaced by fill"""
+
+    values = np.asarray(values)
+    if values.dtype.kind != 'f':
+        values = values.astype(np.float64)
+
+    return np.where(np.isnan(values), values.dtype.type(fill), values)
+
+
+def galactic_to_cartesian(glon, glat, dist, hrv=None, teff=None):
+    """Convert galactic coordinates and distances of all stars
+    to cartesian coordinates, return dictionary of arrays with
+    keys x, y, z, hrv, teff.
+
+    glon -- galactic longitude in degrees, array
+    glat -- galactic latitude in degrees, array
+    dist -- distance, array; missing values (NaN) are set to 0
+    hrv  -- heliocentric radial velocity, array or None;
+            missing values are set to 0
+    teff -- effective temperature, array or None;
+            missing values are set to 0
+    """
+
+    glon = np.asarray(glon, dtype=np.float64)
+    glat = np.asarray(glat, dtype=np.float64)
+    r = fill_missing(dist)
+
+    # convert from galactic to cartesian
+    phi = np.radians(glon)
+    theta = np.radians(90. - glat)
+    sintheta = np.sin(theta)
+
+    stars = {}
+    stars['x'] = r*np.cos(phi)*sintheta
+    stars['y'] = r*np.sin(phi)*sintheta
+    stars['z'] = r*np.cos(theta)
+
+    if hrv is None:
+        stars['hrv'] = np.zeros(len(r))
+    else:
+        stars['hrv'] = fill_missing(hrv)
+
+    if teff is None:
+        stars['teff'] = np.zeros(len(r))
+    else:
+        stars['teff'] = fill_missing(teff)
+
+    return stars
+
+
+def hash_ids(values):
+    """Return star ids as unsigned 64 bit integers. Integer ids are
+    kept, text ids are hashed (FNV-1a over the characters, computed
+    for all ids at once, character by character).
+
+    values -- array of ids, integers or strings
+    """
+
+    values = np.asarray(values)
+    if values.dtype.kind == 'u':
+        return values.astype(np.uint64)
+    if values.dtype.kind in 'if':
+        return values.astype(np.int64).view(np.uint64)
+    if values.dtype.kind == 'S':
+        values = values.astype(str)
+
+    n = len(values)
+    keys = np.full(n, 0xcbf29ce484222325, dtype=np.uint64)
+    if n == 0:
+        return keys
+
+    # One row of character codes per id, padded with zeros
+    codes = np.ascontiguousarray(values).view(np.uint32).reshape(n, -1)
+    prime = np.uint64(0x100000001b3)
+    for i in range(codes.shape[1]):
+        c = codes[:, i].astype(np.uint64)
+        keys = np.where(c != 0, (keys ^ c)*prime, keys)
+
+    return keys
+
+
+def convert_chunk(chunk):
+    """Convert chunk of catalog columns (keys as in RAVE_SCHEMA)
+    to star columns (x, y, z, hrv, teff, and id if given)
+    """
+
+    stars = galactic_to_cartesian(chunk['glon'], chunk['glat'],
+                                  chunk['dist'],
+                                  hrv=chunk.get('hrv'),
+                                  teff=chunk.get('teff'))
+    if 'id' in chunk:
+        stars['id'] = hash_ids(chunk['id'])
+
+    return stars
+
+
+def iter_star_chunks(filename, columns=RAVE_SCHEMA, chunksize=CHUNKSIZE,
+                     filters=None, dropped=None):
+    """Read a catalog (csv-file or binary columns) chunk by chunk and
+    yield the converted star columns of each chunk,
+    see iter_daiquiri_chunks() for the arguments.
+    Rows are filtered before the conversion.
+
+    filters -- list of filter expressions, see make_filter()
+    dropped -- dictionary for counting the rows dropped by each filter
+    """
+
+    filters = make_filters(filters, columns)
+
+    chunks = profiling.iterate('read', iter_catalog_chunks(
+        filename, columns=columns, chunksize=chunksize), count=chunk_length)
+    for chunk in chunks:
+        with profiling.stage('filter', chunk_length(chunk)):
+            chunk = filter_chunk(chunk, filters, dropped)
+        with profiling.stage('convert', chunk_length(chunk)):
+            stars = convert_chunk(chunk)
+        yield stars
+
+
+def chunk_length(chunk):
+    """Return number of rows of a chunk (dictionary of columns)"""
+
+    for values in chunk.values():
+        return len(values)
+
+    return 0
+
+
+def concatenate_chunks(chunks, keys=STAR_COLUMNS):
+    """Join chunks (dictionaries of arrays) into one dictionary
+    of arrays with the given keys.
+    """
+
+    parts = dict((key, []) for key in keys)
+    for chunk in chunks:
+        for key in keys:
+            parts[key].append(chunk[key])
+
+    stars = {}
+    for key in keys:
+        if parts[key]:
+            stars[key] = np.concatenate(parts[key])
+        else:
+            stars[key] = np.empty(0)
+
+    return stars
+
+
+def split_byte_ranges(filename, start, nparts):
+    """Split file from byte position start to its end into about
+    nparts ranges, which begin and end at line boundaries,
+    return list of (start, end)-tuples.
+    Assumes that there are no line breaks inside of quoted fields,
+    which is the case for Daiquiri csv-files.
+    """
+
+    size = os.path.getsize(filename)
+    step = max(1, (size - start)//max(1, nparts))
+
+    bounds = [start]
+    with open(filename, 'rb') as f:
+        pos = start + step
+        while pos < size:
+            # Continue up to the end of the current line
+            f.seek(pos - 1)
+            f.readline()
+            end = f.tell()
+            if end >= size:
+                break
+            if end > bounds[-1]:
+                bounds.append(end)
+            pos = end + step
+
+    bounds.append(size)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def iter_range_lines(f, end):
+    """Yield the decoded lines of the binary file f from its current
+    position up to byte position end
+    """
+
+    pos = f.tell()
+    while pos < end:
+        line = f.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line.decode('utf-8')
+
+
+def parse_byte_range(task):
+    """Parse and convert rows in the given byte range of a csv-file,
+    return dictionary of star columns and dictionary of dropped rows
+    per filter. Used by the worker processes of read_stars_parallel().
+    The rows are parsed in chunks, so the memory needed for the text
+    of the rows depends on the chunk size, not on the size of the range.
+
+    task -- tuple (filename, start, end, indexes, schema, filters,
+            chunksize), with positions of the needed columns (indexes),
+            the schema, the filter expressions and the rows per chunk
+    """
+
+    filename, start, end, indexes, schema, filters, chunksize = task
+
+    getfields = field_getter(indexes)
+    filters = make_filters(filters, schema)
+    dropped = {}
+
+    def convert_rows(rows):
+        if rows:
+            chunk = rows_to_columns(rows, schema)
+        else:
+            chunk = dict((key, np.empty(0, dtype=col.dtype))
+                         for key, col in schema.items())
+        chunk = filter_chunk(chunk, filters, dropped)
+        return convert_chunk(chunk)
+
+    chunks = []
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        rows = []
+        for row in csv.reader(iter_range_lines(f, end), delimiter=','):
+            if not row:
+                continue
+            rows.append(getfields(row))
+
+            if len(rows) == chunksize:
+                chunks.append(convert_rows(rows))
+                rows = []
+
+        if rows or not chunks:
+            chunks.append(convert_rows(rows))
+
+    return concatenate_chunks(chunks, keys=star_columns(schema)), dropped
+
+
+def read_stars_parallel(filename, columns=RAVE_SCHEMA, workers=None,
+                        chunksize=CHUNKSIZE, minsize=PARALLEL_MINSIZE,
+                        filters=None, dropped=None):
+    """Read and convert a Daiquiri csv-file with several processes,
+    return star columns (x, y, z, hrv, teff) in the order of the file.
+    The header is checked only once, in this process.
+
+    filename -- name of the csv-file
+    columns -- schema or dictionary of column names, see make_schema()
+    workers -- number of processes (default: number of CPUs)
+    chunksize -- rows per chunk, also for parsing the byte ranges
+    minsize -- files smaller than this (in bytes) are read serially
+    filters -- list of filter expressions, see make_filter()
+    dropped -- dictionary for counting the rows dropped by each filter
+    """
+    # The workers only need this module (not bpy). With the 'spawn'
+    # start method (default on Windows and macOS), each worker imports
+    # the main module again, which within Blender is the calling script
+    # (and sys.executable is Blender itself before 2.91), so the file
+    # is read serially there.
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if (workers > 1 and 'bpy' in sys.modules
+            and multiprocessing.get_start_method() != 'fork'):
+        print("Reading %s serially, since worker processes would be "
+              "started with '%s' within Blender."
+              % (filename, multiprocessing.get_start_method()))
+        workers = 1
+
+    if workers <= 1 or os.path.getsize(filename) < minsize:
+        return concatenate_chunks(iter_star_chunks(filename, columns=columns,
+                                                   chunksize=chunksize,
+                                                   filters=filters,
+                                                   dropped=dropped),
+                                  keys=star_columns(columns))
+
+    # Check the filter expressions before starting any process
+    make_filters(filters, columns)
+
+    # Check header and find positions of the columns once
+    with open_daiquiri_csv(filename) as csvfile:
+        header = next(csv.reader(csvfile, delimiter=','))
+    schema = make_schema(columns)
+    indexes = column_indexes(header, schema)
+
+    with open(filename, 'rb') as f:
+        f.readline()
+        datastart = f.tell()
+
+    # Use more ranges than workers, for a better balance of the load
+    ranges = split_byte_ranges(filename, datastart, 4*workers)
+    tasks = [(filename, start, end, indexes, schema, filters, chunksize)
+             for start, end in ranges]
+
+    print("Reading %s with %d processes in %d parts."
+          % (filename, workers, len(tasks)))
+
+    def collect(results):
+        for stars, partdropped in results:
+            if dropped is not None:
+                for expression, ndropped in partdropped.items():
+                    dropped[expression] = (dropped.get(expression, 0)
+                                           + ndropped)
+            yield stars
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        # imap keeps the order of the tasks
+        stars = concatenate_chunks(collect(pool.imap(parse_byte_range,
+                                                     tasks)),
+                                   keys=star_columns(columns))
+    finally:
+        pool.close()
+        pool.join()
+
+    return stars
+
+
+def default_cachedir(filename):
+    """Return default cache directory for the given catalog file,
+    i.e. .starcache next to the file
+    """
+
+    return os.path.join(os.path.dirname(os.path.abspath(filename)),
+                        '.starcache')
+
+
+def cache_key(filename, columns=RAVE_SCHEMA, hashcontent=False,
+              filters=None):
+    """Return key (hex-string) for caching the converted stars
+    of the given file
+
+    filename -- name of the catalog file
+    columns -- schema or dictionary of column names used for reading
+    hashcontent -- if True, also hash the content of the file
+                   (safer, but needs to read the whole file)
+    filters -- list of filter expressions used for reading
+    """
+
+    stat = os.stat(filename)
+
+    h = hashlib.sha1()
+    h.update(repr((CACHE_VERSION,
+                   os.path.abspath(filename),
+                   stat.st_size,
+                   stat.st_mtime_ns,
+                   schema_key(columns),
+                   list(filters or []))).encode('utf-8'))
+
+    if hashcontent:
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+
+    return h.hexdigest()
+
+
+def load_cached_stars(filename, columns=RAVE_SCHEMA, cachedir=None,
+                      hashcontent=False, filters=None, dropped=None):
+    """Return dictionary of memory-mapped star columns from the cache,
+    or None if there is no valid cache for this file and columns.
+    See cache_key() for the arguments; dropped is filled with the
+    rows dropped by the filters, as stored in the cache.
+    """
+
+    if cachedir is None:
+        cachedir = default_cachedir(filename)
+
+    key = cache_key(filename, columns=columns, hashcontent=hashcontent,
+                    filters=filters)
+    path = os.path.join(cachedir, key)
+
+    # meta.json is written last, so its existence marks a complete cache
+    if not os.path.isfile(os.path.join(path, 'meta.json')):
+        return None
+
+    stars = {}
+    for name in star_columns(columns):
+        stars[name] = np.load(os.path.join(path, name + '.npy'),
+                              mmap_mode='r')
+
+    if dropped is not None:
+        with open(os.path.join(path, 'meta.json')) as f:
+            dropped.update(json.load(f).get('dropped', {}))
+
+    print("Read %d stars from cache %s." % (len(stars['x']), path))
+
+    return stars
+
+
+def save_cached_stars(filename, stars, columns=RAVE_SCHEMA, cachedir=None,
+                      hashcontent=False, filters=None, dropped=None):
+    """Write star columns into the cache for the given file
+    and remove older caches of the same file.
+    See cache_key() for the arguments; dropped are the rows dropped
+    by the filters, stored along with the stars.
+    """
+
+    if cachedir is None:
+        cachedir = default_cachedir(filename)
+
+    source = os.path.abspath(filename)
+    key = cache_key(filename, columns=columns, hashcontent=hashcontent,
+                    filters=filters)
+    path = os.path.join(cachedir, key)
+
+    # Write into a temporary directory first and rename it afterwards,
+    # so that an interrupted run does not leave an incomplete cache
+    tmppath = path + '.tmp%d' % os.getpid()
+    os.makedirs(tmppath, exist_ok=True)
+
+    for name in star_columns(columns):
+        np.save(os.path.join(tmppath, name + '.npy'),
+                np.ascontiguousarray(stars[name]))
+
+    meta = {'source': source,
+            'version': CACHE_VERSION,
+            'columns': schema_key(columns),
+            'filters': list(filters or []),
+            'dropped': dropped or {},
+            'nstars': len(stars['x'])}
+    with open(os.path.join(tmppath, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.isdir(path):
+        shutil.rmtree(tmppath)
+    else:
+        os.rename(tmppath, path)
+
+    # Remove outdated caches of the same file
+    for entry in os.listdir(cachedir):
+        if entry == key:
+            continue
+        metafile = os.path.join(cachedir, entry, 'meta.json')
+        try:
+            with open(metafile) as f:
+                oldsource = json.load(f)['source']
+        except (OSError, ValueError, KeyError):
+            continue
+
+        if oldsource == source:
+            shutil.rmtree(os.path.join(cachedir, entry), ignore_errors=True)
+
+    print("Wrote %d stars to cache %s." % (meta['nstars'], path))
+
+    return path
+
+
+def read_stars(filename, columns=RAVE_SCHEMA, chunksize=CHUNKSIZE,
+               usecache=True, cachedir=None, hashcontent=False, workers=1,
+               filters=None, dropped=None):
+    """Return converted star columns (x, y, z, hrv, teff) for the
+    given Daiquiri csv-file or binary catalog. If usecache is True,
+    they are taken from the cache if possible, otherwise the file is
+    read chunk by chunk and the result is written to the cache.
+    Binary catalogs are not cached, since they are memory-mapped anyway.
+
+    filename -- name of the csv-file, .npy-/.npz-file or directory
+                with binary columns
+    columns -- schema or dictionary of column names, see make_schema()
+    chunksize -- number of rows per chunk when reading the file
+    usecache -- use and update the cache (default: True)
+    cachedir -- directory for cached files (default: .starcache
+                next to the csv-file)
+    hashcontent -- also use the file content for the cache key
+    workers -- number of processes for reading the file,
+               see read_stars_parallel() (default: 1, None: all CPUs)
+    filters -- list of filter expressions, applied before the
+               conversion, e.g. ['dist < 2', 'hrv valid'],
+               see make_filter()
+    dropped -- dictionary, gets the number of rows dropped by each
+               filter expression
+    """
+
+    if dropped is None:
+        dropped = {}
+
+    # Check the filter expressions before reading anything
+    make_filters(filters, columns)
+
+    if is_binary_catalog(filename):
+        usecache = False
+        workers = 1
+
+    if usecache:
+        with profiling.stage('cache'):
+            stars = load_cached_stars(filename, columns=columns,
+                                      cachedir=cachedir,
+                                      hashcontent=hashcontent,
+                                      filters=filters, dropped=dropped)
+        if stars is not None:
+            print_dropped(dropped)
+            return stars
+
+    if workers == 1:
+        stars = concatenate_chunks(iter_star_chunks(filename, columns=columns,
+                                                    chunksize=chunksize,
+                                                    filters=filters,
+                                                    dropped=dropped),
+                                   keys=star_columns(columns))
+    else:
+        # Reading, filtering and converting are done by the workers
+        with profiling.stage('read_parallel') as st:
+            stars = read_stars_parallel(filename, columns=columns,
+                                        workers=workers, chunksize=chunksize,
+                                        filters=filters, dropped=dropped)
+            st.add(len(stars['x']))
+
+    print_dropped(dropped)
+
+    if usecache:
+        with profiling.stage('cache_write', len(stars['x'])):
+            save_cached_stars(filename, stars, columns=columns,
+                              cachedir=cachedir, hashcontent=hashcontent,
+                              filters=filters, dropped=dropped)
+
+    return stars
+
+
+def open_star_chunks(filename, columns=RAVE_SCHEMA, chunksize=CHUNKSIZE,
+                     usecache=True, cachedir=None, filters=None, dropped=None):
+    """Return total number of stars (or None, if not known yet) and
+    an iterator over chunks of converted star columns. Chunks are taken
+    from the cache, if there is one, otherwise the file is read chunk by
+    chunk (without writing the cache).
+    See read_stars() for the arguments.
+    """
+
+    stars = None
+    if usecache and not is_binary_catalog(filename):
+        stars = load_cached_stars(filename, columns=columns,
+                                  cachedir=cachedir, filters=filters,
+                                  dropped=dropped)
+
+    if stars is None:
+        return None, iter_star_chunks(filename, columns=columns,
+                                      chunksize=chunksize, filters=filters,
+                                      dropped=dropped)
+
+    def iter_cached():
+        for start in range(0, len(stars['x']), chunksize):
+            yield dict((key, values[start:start + chunksize])
+                       for key, values in stars.items())
+
+    return len(stars['x']), iter_cached()
+
+
+def column_values(stars, column):
+    """Return values of the given column of the stars.
+    'dist' is computed from x, y, z, if it is not a column itself.
+    """
+
+    if column == 'dist' and 'dist' not in stars:
+        return np.sqrt(stars['x']**2 + stars['y']**2 + stars['z']**2)
+
+    return np.asarray(stars[column])
+
+
+def colormap_colors(colormap, nbins):
+    """Return list of nbins RGB-tuples from the named colormap
+
+    colormap -- name of the colormap, see COLORMAPS
+    nbins -- number of needed colors
+    """
+
+    anchors = np.asarray(COLORMAPS[colormap], dtype=np.float64)
+    if nbins == 1:
+        return [tuple(anchors[0])]
+
+    pos = np.linspace(0, 1, len(anchors))
+    t = np.linspace(0, 1, nbins)
+    colors = np.column_stack([np.interp(t, pos, anchors[:, i])
+                              for i in range(3)])
+
+    return [tuple(c) for c in colors.tolist()]
+
+
+def assign_bins(values, edges):
+    """Return bin index for each value, for bins given by their
+    edges (sorted). Bin i contains edges[i-1] < value <= edges[i],
+    i.e. there are len(edges)+1 bins.
+    """
+
+    return np.searchsorted(np.asarray(edges), values, side='left')
+
+
+def partition_bins(bins, nbins, keys=None):
+    """Sort stars by bin (stable, i.e. keeping their order within
+    each bin), return the sorting indices and the offsets of the
+    bins in the sorted array (length nbins+1)
+
+    bins -- bin index for each star, see assign_bins()
+    nbins -- number of bins
+    keys -- if given, sort the stars within each bin by these keys,
+            e.g. from star_keys()
+    """
+
+    if keys is None:
+        order = np.argsort(bins, kind='stable')
+    else:
+        order = np.lexsort((keys, bins))
+    counts = np.bincount(bins, minlength=nbins)
+    offsets = np.zeros(nbins + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    return order, offsets
+
+
+def split_bins(values, bins, nbins):
+    """Split array (e.g. vertex coordinates) into one array per bin,
+    using one stable partition for all bins.
+
+    values -- array with one entry (row) per star
+    bins -- bin index for each star, see assign_bins()
+    nbins -- number of bins
+    """
+
+    order, offsets = partition_bins(bins, nbins)
+    values = values[order]
+
+    return [values[offsets[i]:offsets[i+1]] for i in range(nbins)]
+
+
+def star_keys(n=None, ids=None, seed=0):
+    """Return a stable pseudo-random key in [0, 1) for each star,
+    e.g. for choosing reproducible subsets of stars.
+    The key only depends on the star's index (or id) and the seed.
+
+    n -- number of stars, keys are computed from the indices 0..n-1
+    ids -- integer ids of the stars, used instead of the indices
+    seed -- integer seed, use another one for other subsets
+    """
+
+    if ids is None:
+        x = np.arange(n, dtype=np.uint64)
+    else:
+        x = np.asarray(ids).astype(np.uint64)
+
+    # splitmix64 hash, uint64 arithmetic wraps around as intended;
+    # the seed term is computed with Python integers, since numpy
+    # warns about the overflow of scalar products
+    x = x + np.uint64(((seed & 0xFFFFFFFF)*0x9E3779B97F4A7C15)
+                      & 0xFFFFFFFFFFFFFFFF)
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+    x = x ^ (x >> np.uint64(31))
+
+    return (x >> np.uint64(11)).astype(np.float64)*(1./(1 << 53))
+
+
+def quantize_positions(coords, cellsize, lo=0.):
+    """Return integer grid cell (i, j, k) of each position,
+    array of shape (n, 3)
+
+    coords -- positions, array of shape (n, 3)
+    cellsize -- edge length of the (cubic) grid cells
+    lo -- corner of the cell (0, 0, 0)
+    """
+
+    return np.floor((np.asarray(coords) - lo)/cellsize).astype(np.int64)
+
+
+def grid_cells(coords, cellsize):
+    """Return integer grid cell (i, j, k) of each position, array of
+    shape (n, 3), and one integer cell id per position
+
+    coords -- positions, array of shape (n, 3)
+    cellsize -- edge length of the (cubic) grid cells
+    """
+
+    cells = quantize_positions(coords, cellsize)
+    if len(cells) == 0:
+        return cells, np.empty(0, dtype=np.int64)
+
+    lo = cells.min(axis=0)
+    dims = cells.max(axis=0) - lo + 1
+    cellids = np.ravel_multi_index(tuple((cells - lo).T), tuple(dims))
+
+    return cells, cellids
+
+
+def preview_counts(counts, fraction=None, count=None):
+    """Return number of stars per bin for a preview with the given
+    fraction or total count of stars. Each non-empty bin keeps at least
+    one star. If neither fraction nor count is given, all stars are used.
+
+    counts -- number of stars in each bin
+    fraction -- fraction of stars to be used, 0 to 1
+    count -- total number of stars to be used (instead of fraction);
+             rounded up per bin, so the result may be slightly larger
+    """
+
+    counts = np.asarray(counts, dtype=np.int64)
+    if count is not None:
+        fraction = min(1., float(count)/max(1, counts.sum()))
+    if fraction is None:
+        return counts.copy()
+
+    n = np.ceil(fraction*counts).astype(np.int64)
+    n = np.maximum(n, np.minimum(counts, 1))
+
+    return np.minimum(n, counts)
+
+
+def save_import_state(statefile, stars, order, offsets, posfac, column,
+                      edges, objects):
+    """Write the state of an import of binned meshes into a .npz-file:
+    ids, positions and bins of the stars, in the order of the vertices
+    of the meshes, and the settings used for binning.
+
+    statefile -- name of the .npz-file
+    stars -- star columns with ids (x, y, z, id, ...)
+    order -- indices of the stars in the order of the vertices,
+             i.e. sorted by bin, see partition_bins()
+    offsets -- offsets of the bins in order (length nbins+1)
+    posfac, column, edges -- settings of the import,
+             see create_binned_meshes() in ravestars_mesh.py
+    objects -- names of the mesh-objects, one per bin
+    """
+
+    order = np.asarray(order)
+    bins = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    dirname = os.path.dirname(os.path.abspath(statefile))
+    os.makedirs(dirname, exist_ok=True)
+
+    # Write to a temporary file first, see save_cached_stars()
+    tmpfile = statefile + '.tmp%d.npz' % os.getpid()
+    np.savez(tmpfile,
+             ids=np.asarray(stars['id'])[order],
+             x=np.asarray(stars['x'])[order],
+             y=np.asarray(stars['y'])[order],
+             z=np.asarray(stars['z'])[order],
+             bins=bins,
+             offsets=np.asarray(offsets, dtype=np.int64),
+             posfac=np.float64(posfac),
+             column=np.str_(column),
+             edges=np.asarray(edges, dtype=np.float64),
+             objects=np.asarray(objects, dtype=str))
+    os.replace(tmpfile, statefile)
+
+    print("Wrote state of %d stars to %s." % (len(order), statefile))
+
+
+def load_import_state(statefile):
+    """Return state of an earlier import as dictionary,
+    see save_import_state()
+    """
+
+    if not os.path.isfile(statefile):
+        print("State file %s does not exist!" % statefile)
+        raise RuntimeError("Stopping script because there is no state "
+                           "of an earlier import.")
+
+    with np.load(statefile) as npz:
+        state = dict((key, npz[key]) for key in npz.files)
+
+    state['posfac'] = float(state['posfac'])
+    state['column'] = str(state['column'])
+    state['objects'] = [str(name) for name in state['objects']]
+
+    return state
+
+
+def match_ids(oldids, newids):
+    """Return for each new id the index of the same id in oldids,
+    or -1 for new ids. Both must be unique.
+    """
+
+    for ids, which in ((oldids, 'old'), (newids, 'new')):
+        if len(np.unique(ids)) != len(ids):
+            print("Star ids of the %s stars are not unique!" % which)
+            raise RuntimeError("Stopping script because of duplicate ids.")
+
+    sorter = np.argsort(oldids)
+    pos = np.searchsorted(oldids, newids, sorter=sorter)
+    pos = np.minimum(pos, max(len(oldids) - 1, 0))
+
+    index = np.full(len(newids), -1, dtype=np.int64)
+    if len(oldids):
+        found = oldids[sorter[pos]] == newids
+        index[found] = sorter[pos[found]]
+
+    return index
+
+
+def voxel_indices(coords, lo, voxelsize, shape):
+    """Return flat index of the voxel containing each position and a
+    mask of the positions inside of the grid
+
+    coords -- positions, array of shape (n, 3)
+    lo -- lower corner of the grid, (x, y, z)
+    voxelsize -- edge length of the (cubic) voxels
+    shape -- number of voxels in x, y, z
+    """
+
+    cells = quantize_positions(coords, voxelsize, lo)
+    inside = np.all((cells >= 0) & (cells < np.asarray(shape)), axis=1)
+    flat = np.ravel_multi_index(tuple(cells[inside].T), tuple(shape))
+
+    return flat, inside
+
+
+def grid_bounds(stars):
+    """Return lower and upper corner of the box around all stars"""
+
+    coords = np.column_stack([stars['x'], stars['y'], stars['z']])
+    if len(coords) == 0:
+        return np.zeros(3), np.zeros(3)
+
+    return coords.min(axis=0), coords.max(axis=0)
+
+
+class VoxelGrid(object):
+    """Regular 3D grid with fixed bounds, which counts the stars per
+    voxel and sums up some of their columns, chunk by chunk.
+
+    lo, hi -- lower and upper corner of the grid, (x, y, z),
+              in the units of the star columns (kpc), both included
+    voxelsize -- edge length of the (cubic) voxels
+    columns -- star columns to be averaged per voxel
+    """
+
+    def __init__(self, lo, hi, voxelsize, columns=('hrv', 'teff')):
+
+        self.lo = np.asarray(lo, dtype=np.float64)
+        self.voxelsize = float(voxelsize)
+        hi = np.asarray(hi, dtype=np.float64)
+        # Stars on hi belong to the grid as well (e.g. with the bounds
+        # from grid_bounds()), so hi must be inside of the last voxel,
+        # also if the extent is a multiple of the voxel size
+        self.shape = tuple(int(n) for n in
+                           np.maximum(np.floor((hi - self.lo)/voxelsize)
+                                      + 1, 1))
+        self.hi = self.lo + np.asarray(self.shape)*self.voxelsize
+
+        nvoxels = int(np.prod(self.shape))
+        self.counts = np.zeros(nvoxels, dtype=np.int64)
+        self.sums = dict((column, np.zeros(nvoxels, dtype=np.float64))
+                         for column in columns)
+        self.nstars = 0
+        self.outside = 0
+
+    def add(self, stars):
+        """Add chunk of star columns (x, y, z, hrv, ...) to the grid;
+        stars outside of the grid are only counted
+        """
+
+        coords = np.column_stack([stars['x'], stars['y'], stars['z']])
+        flat, inside = voxel_indices(coords, self.lo, self.voxelsize,
+                                     self.shape)
+
+        nvoxels = len(self.counts)
+        self.counts += np.bincount(flat, minlength=nvoxels)
+        for column, sums in self.sums.items():
+            values = column_values(stars, column)[inside]
+            sums += np.bincount(flat, weights=values, minlength=nvoxels)
+
+        self.nstars += len(coords)
+        self.outside += len(coords) - len(flat)
+
+    def occupied(self):
+        """Return dictionary of arrays for the voxels with stars:
+        x, y, z of their centers, count of stars and the mean
+        of each column
+        """
+
+        flat = np.nonzero(self.counts)[0]
+        cells = np.column_stack(np.unravel_index(flat, self.shape))
+        centers = self.lo + (cells + 0.5)*self.voxelsize
+
+        voxels = {'x': centers[:, 0], 'y': centers[:, 1],
+                  'z': centers[:, 2], 'count': self.counts[flat]}
+        for column, sums in self.sums.items():
+            voxels[column] = sums[flat]/self.counts[flat]
+
+        return voxels
+
+    def density(self):
+        """Return number of stars per voxel, normalized to 0..1,
+        as float32 array of shape self.shape (x, y, z)
+        """
+
+        density = self.counts.astype(np.float32)
+        if density.max() > 0:
+            density /= density.max()
+
+        return density.reshape(self.shape)
+
+
+def aggregate_stars(chunks, lo, hi, voxelsize, columns=('hrv', 'teff')):
+    """Return VoxelGrid with all stars of the given chunks,
+    see VoxelGrid for the arguments
+
+    chunks -- iterable of chunks of star columns, e.g. from
+              iter_star_chunks() or open_star_chunks(), or a list
+              with one dictionary of all stars
+    """
+
+    grid = VoxelGrid(lo, hi, voxelsize, columns=columns)
+    for chunk in chunks:
+        with profiling.stage('aggregate', chunk_length(chunk)):
+            grid.add(chunk)
+
+    print("%d stars aggregated into %d of %d voxels (%d outside)."
+          % (grid.nstars, np.count_nonzero(grid.counts), len(grid.counts),
+             grid.outside))
+
+    return grid
+
+
+def write_bvox(filename, density):
+    """Write 3D array (x, y, z) as Blender voxel data file (.bvox):
+    4 int32 values (nx, ny, nz, number of frames), then all values
+    as float32, with x running fastest
+    """
+
+    density = np.asarray(density, dtype=np.float32)
+    nx, ny, nz = density.shape
+
+    with open(filename, 'wb') as f:
+        np.array([nx, ny, nz, 1], dtype='<i4').tofile(f)
+        np.ascontiguousarray(density.transpose(2, 1, 0),
+                             dtype='<f4').tofile(f)
+
+
+# Reducers for combining the columns of merged stars
+DEDUP_REDUCERS = ('mean', 'max', 'min', 'first')
+
+# Cells are packed into one integer key with 21 bits per axis
+CELLKEY_BITS = 21
+
+# Differences of the keys of a cell and of the middle cells of the
+# 9 rows (along z) of its neighbours; the 3 cells of a row have
+# consecutive keys
+CELL_NEIGHBOURS = np.array([(dx << 2*CELLKEY_BITS) + (dy << CELLKEY_BITS)
+                            for dx in (-1, 0, 1) for dy in (-1, 0, 1)],
+                           dtype=np.int64)
+
+
+def cell_keys(coords, cellsize):
+    """Return one integer key per position for the grid cell containing
+    it; the keys don't depend on the other positions, so they can be
+    compared between chunks. Adding CELL_NEIGHBOURS (and -1, 0, 1) to a
+    key gives the keys of the neighbouring cells.
+
+    coords -- positions, array of shape (n, 3)
+    cellsize -- edge length of the (cubic) grid cells
+    """
+
+    offset = 1 << (CELLKEY_BITS - 1)
+    cells = quantize_positions(coords, cellsize) + offset
+    # Keep a free cell at both ends, for the neighbours
+    if len(cells) and (cells.min() < 1 or cells.max() >= 2*offset - 1):
+        raise RuntimeError("Positions span too many cells of size %g, "
+                           "use a larger tolerance." % cellsize)
+
+    return ((cells[:, 0] << 2*CELLKEY_BITS) | (cells[:, 1] << CELLKEY_BITS)
+            | cells[:, 2])
+
+
+def close_pairs(querykeys, querycoords, keys, coords, distance):
+    """Return indexes (i, j) of all pairs of a query position i and a
+    position j, which are at most distance apart. Only the cell of each
+    query position and its neighbours are searched.
+
+    querykeys, querycoords -- cell keys (see cell_keys()) and positions
+                              (array of shape (n, 3)) to be queried
+    keys, coords -- cell keys, sorted, and positions to be searched
+    distance -- largest distance, at most the edge length of the cells
+    """
+
+    # Searching is much faster with sorted query keys
+    queries = np.argsort(querykeys, kind='stable')
+    querykeys = querykeys[queries]
+
+    parts_i = []
+    parts_j = []
+    for delta in CELL_NEIGHBOURS:
+        lo = np.searchsorted(keys, querykeys + (delta - 1), side='left')
+        hi = np.searchsorted(keys, querykeys + (delta + 1), side='right')
+        counts = hi - lo
+        if not counts.any():
+            continue
+
+        # All positions of the neighbouring row for each query position
+        i = np.repeat(queries, counts)
+        j = (np.arange(counts.sum()) + np.repeat(lo - np.cumsum(counts)
+                                                 + counts, counts))
+        close = ((querycoords[i] - coords[j])**2).sum(axis=1) <= distance**2
+        parts_i.append(i[close])
+        parts_j.append(j[close])
+
+    if not parts_i:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    return np.concatenate(parts_i), np.concatenate(parts_j)
+
+
+def first_leaders(later, earlier, n):
+    """Return for each of n positions (in their order) the position it
+    is merged into: the first earlier leader within the distance, or
+    itself, if there is none (then it is a leader itself)
+
+    later, earlier -- indexes of all pairs of close positions,
+                      with earlier < later, see close_pairs()
+    n -- number of positions
+    """
+
+    leader = np.arange(n)
+    if len(later) == 0:
+        return leader
+
+    # Earlier close positions of each position in ascending order,
+    # the first one is the candidate
+    order = np.lexsort((earlier, later))
+    later = later[order]
+    earlier = earlier[order]
+    starts = np.searchsorted(later, np.arange(n + 1))
+    hasearlier = starts[1:] > starts[:-1]
+    candidate = np.where(hasearlier, earlier[np.minimum(starts[:-1],
+                                                        len(earlier) - 1)],
+                         -1)
+
+    # Positions without earlier close positions are leaders, and so the
+    # candidate of a position is its leader, if the candidate has none
+    known = hasearlier & ~hasearlier[np.maximum(candidate, 0)]
+    leader[known] = candidate[known]
+
+    # The others in one pass in their order, since whether a position
+    # is a leader depends on the earlier ones (e.g. chains of stars)
+    isleader = leader == np.arange(n)
+    rest = np.nonzero(hasearlier & ~known)[0]
+    if len(rest):
+        isleader = isleader.tolist()
+        starts = starts.tolist()
+        earlier = earlier.tolist()
+        found = []
+        for i in rest.tolist():
+            for k in range(starts[i], starts[i + 1]):
+                if isleader[earlier[k]]:
+                    isleader[i] = False
+                    found.append(earlier[k])
+                    break
+            else:
+                found.append(i)
+        leader[rest] = found
+
+    return leader
+
+
+def group_keys(keys):
+    """Return index of the group of equal keys for each key and the
+    index of the first key of each group. Groups are numbered in the
+    order of their first key.
+    """
+
+    unique, first, inverse = np.unique(keys, return_index=True,
+                                       return_inverse=True)
+    rank = np.argsort(first, kind='stable')
+    groups = np.empty(len(rank), dtype=np.int64)
+    groups[rank] = np.arange(len(rank))
+
+    return groups[inverse.reshape(-1)], first[rank]
+
+
+def reduce_groups(values, groups, first, how):
+    """Combine values of each group into one value
+
+    values -- array with one value per star
+    groups -- group index of each star, see group_keys()
+    first -- index of the first star of each group
+    how -- 'sum', 'max', 'min' or 'first'
+    """
+
+    values = np.asarray(values)
+    ngroups = len(first)
+
+    if how == 'first':
+        return values[first]
+    if how == 'sum':
+        return np.bincount(groups, weights=values, minlength=ngroups)
+
+    # Sort by group, then reduce each run of equal groups
+    order = np.argsort(groups, kind='stable')
+    starts = np.searchsorted(groups[order], np.arange(ngroups))
+    ufunc = np.maximum if how == 'max' else np.minimum
+
+    return ufunc.reduceat(values[order], starts)
+
+
+class StarDeduplicator(object):
+    """Merge stars at (nearly) the same position, chunk by chunk.
+    In the order of the stars, each star is merged into the first
+    earlier star within the tolerance, which was not merged itself
+    (its leader), or it becomes a leader. So all merged stars are at
+    most the tolerance away from the first star of their group.
+    Leaders are found with a spatial hash: their positions are hashed
+    to cells with an edge length of the tolerance, and only the cell of
+    a star and its neighbours are searched.
+
+    tolerance -- largest distance of merged stars, in scene units
+                 (Blender), i.e. after scaling the positions with posfac
+    posfac -- scaling factor for positions used for the scene
+    reducer -- how to combine the columns of merged stars, one of
+               DEDUP_REDUCERS; positions are averaged, except for
+               'first', ids are always taken from the first star
+    """
+
+    def __init__(self, tolerance, posfac=1., reducer='mean'):
+
+        if reducer not in DEDUP_REDUCERS:
+            raise RuntimeError("Unknown reducer '%s', use one of %s."
+                               % (reducer, ', '.join(DEDUP_REDUCERS)))
+
+        self.tolerance = float(tolerance)
+        self.cellsize = self.tolerance/posfac
+        self.reducer = reducer
+        self.parts = []
+        self.nstars = 0
+
+        # Positions, cell keys and groups of the leaders so far,
+        # sorted by cell key
+        self.leadercoords = np.empty((0, 3))
+        self.leaderkeys = np.empty(0, dtype=np.int64)
+        self.leadergroups = np.empty(0, dtype=np.int64)
+
+    def combine(self, column):
+        """Return how the sums/values of column are combined"""
+
+        if column in ('count', 'key', 'id') or self.reducer == 'first':
+            return 'sum' if column == 'count' else 'first'
+        if column in ('x', 'y', 'z') or self.reducer == 'mean':
+            return 'sum'
+
+        return self.reducer
+
+    def merge(self, part):
+        """Merge stars/partial results of the same group (key) in part"""
+
+        groups, first = group_keys(part['key'])
+
+        return dict((column, reduce_groups(values, groups, first,
+                                           self.combine(column)))
+                    for column, values in part.items())
+
+    def assign_groups(self, coords):
+        """Return group of each position (in the order of the first
+        star of each group), new groups for new leaders
+        """
+
+        n = len(coords)
+        keys = cell_keys(coords, self.cellsize)
+        groups = np.full(n, -1, dtype=np.int64)
+
+        # Leaders of earlier chunks
+        i, j = close_pairs(keys, coords, self.leaderkeys, self.leadercoords,
+                           self.cellsize)
+        first = np.full(n, np.iinfo(np.int64).max)
+        np.minimum.at(first, i, self.leadergroups[j])
+        found = first < np.iinfo(np.int64).max
+        groups[found] = first[found]
+
+        # Leaders among the other stars of this chunk
+        rest = np.nonzero(~found)[0]
+        order = np.argsort(keys[rest], kind='stable')
+        i, j = close_pairs(keys[rest], coords[rest], keys[rest][order],
+                           coords[rest][order], self.cellsize)
+        j = order[j]
+        earlier = j < i
+        leader = first_leaders(i[earlier], j[earlier], len(rest))
+
+        isleader = leader == np.arange(len(rest))
+        newgroups = np.full(len(rest), -1, dtype=np.int64)
+        ngroups = len(self.leadergroups)
+        newgroups[isleader] = ngroups + np.arange(np.count_nonzero(isleader))
+        groups[rest] = newgroups[leader]
+
+        # Add the new leaders, keeping them sorted by cell key
+        leaders = rest[isleader]
+        leaderkeys = np.concatenate([self.leaderkeys, keys[leaders]])
+        order = np.argsort(leaderkeys, kind='stable')
+        self.leaderkeys = leaderkeys[order]
+        self.leadercoords = np.concatenate([self.leadercoords,
+                                            coords[leaders]])[order]
+        self.leadergroups = np.concatenate([self.leadergroups,
+                                            groups[leaders]])[order]
+
+        return groups
+
+    def add(self, stars):
+        """Add a chunk of star columns (x, y, z, hrv, ...)"""
+
+        coords = np.column_stack([stars['x'], stars['y'],
+                                  stars['z']]).astype(np.float64)
+
+        part = dict((column, np.asarray(values))
+                    for column, values in stars.items())
+        part['key'] = self.assign_groups(coords)
+        part['count'] = np.ones(len(coords), dtype=np.int64)
+
+        # Reduce each chunk right away, merged stars don't need memory
+        self.parts.append(self.merge(part))
+        self.nstars += len(coords)
+
+    def result(self):
+        """Return star columns of the merged stars, in the order
+        of their first occurrence
+        """
+
+        if not self.parts:
+            return concatenate_chunks([])
+
+        part = self.merge(concatenate_chunks(self.parts,
+                                             keys=self.parts[0].keys()))
+        counts = part.pop('count')
+        del part['key']
+
+        stars = {}
+        for column, values in part.items():
+            if self.combine(column) == 'sum':
+                values = values/counts
+            stars[column] = values
+
+        print("%d stars merged into %d (tolerance %g, %s)."
+              % (self.nstars, len(counts), self.tolerance, self.reducer))
+
+        return stars
+
+
+def dedup_stars(chunks, tolerance, posfac=1., reducer='mean'):
+    """Return star columns with stars at (nearly) the same position
+    merged, see StarDeduplicator for the arguments
+
+    chunks -- iterable of chunks of star columns, e.g. from
+              open_star_chunks(), or a list with one dictionary
+              of all stars
+    """
+
+    dedup = StarDeduplicator(tolerance, posfac=posfac, reducer=reducer)
+    for chunk in chunks:
+        with profiling.stage('dedup', chunk_length(chunk)):
+            dedup.add(chunk)
+
+    with profiling.stage('dedup'):
+        stars = dedup.result()
+
+    return stars
@@ -0,0 +1,41 @@
+"""
+Setup of the tests: the scripts run with the stand-ins for bpy and
+mathutils in benchmarks/standin instead of Blender, and the synthetic
+data of the benchmarks is used.
+"""
+
+
+import os
+import sys
+import pytest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+REPODIR = os.path.dirname(TESTDIR)
+
+# The stand-in must come first, before any script imports bpy
+sys.path.insert(0, os.path.join(REPODIR, 'benchmarks', 'standin'))
+sys.path.insert(1, os.path.join(REPODIR, 'benchmarks'))
+sys.path.insert(2, REPODIR)
+
+
+@pytest.fixture
+def bpy():
+    """The bpy stand-in, without any datablocks"""
+
+    import bpy
+    bpy.reset()
+    yield bpy
+    bpy.reset()
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    """Return name of a csv-file with 1000 synthetic stars"""
+
+    import run_benchmarks
+
+    filename = str(tmp_path / 'stars.csv')
+    run_benchmarks.write_csv_catalog(filename,
+                                     run_benchmarks.synthetic_columns(1000))
+
+    return filename
@@ -0,0 +1,44 @@
+import numpy as np
+
+import compact_keyframes
+import shift_keyframes
+from run_benchmarks import add_stepped_keyframes
+
+
+def evaluate(fcurve, frames):
+    return np.array([fcurve.evaluate(frame) for frame in frames])
+
+
+def test_compact_flat_runs(bpy):
+    # Step curves and flat runs joined by ramps, 200 keyframes each
+    objects = add_stepped_keyframes(bpy, 400, nfcurves=2)
+    frames = np.arange(0., 200., 0.25)
+    before = dict((obj.name, [evaluate(fcurve, frames) for fcurve in
+                              obj.animation_data.action.fcurves])
+                  for obj in objects)
+
+    actions = shift_keyframes.get_actions_for_objects('compact-*')
+    report = compact_keyframes.compact_actions(actions)
+
+    # Flat runs next to value changes are removed
+    for name, (nkeys, nremoved) in report.items():
+        assert nkeys == 400
+        assert nremoved >= nkeys//2, name
+
+    # The curves stay within the tolerance
+    for obj in objects:
+        for fcurve, values in zip(obj.animation_data.action.fcurves,
+                                  before[obj.name]):
+            assert np.allclose(evaluate(fcurve, frames), values, atol=1.e-4)
+
+
+def test_compact_keeps_changes(bpy):
+    action = bpy.data.actions.new('Action')
+    fcurve = action.fcurves.new('location')
+    fcurve.keyframe_points.add(4)
+    fcurve.keyframe_points.foreach_set('co', [0., 0., 10., 1., 20., 0.,
+                                              30., 1.])
+    fcurve.update()
+
+    assert compact_keyframes.compact_fcurve(fcurve) == 0
+    assert len(fcurve.keyframe_points) == 4
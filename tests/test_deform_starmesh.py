@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+import starcatalog
+import ravestars_mesh
+import deform_starmesh
+from deform_starmesh import INTERPOLATIONS
+
+
+@pytest.fixture
+def objects(bpy, catalog):
+    """Star meshes with basis, sphere and map shapekeys"""
+
+    stars = starcatalog.read_stars(catalog, usecache=False)
+    objects = ravestars_mesh.create_hrv_meshes(stars, (0, 0, 0), 0.015, 1.8)
+    deform_starmesh.make_basis_shapekeys(objects, 'Basis')
+    deform_starmesh.make_form_shapekeys(
+        objects, [('KeySphere', 'SPHERE', {'rsphere': 2.}),
+                  ('KeyMap', 'MAP', {'mapw': 7.5, 'maph': 4.5})])
+
+    return objects
+
+
+def interpolations(fcurve):
+    return [point.interpolation for point in fcurve.keyframe_points]
+
+
+def test_timeline_interpolations(objects):
+    # Enum values written with foreach_set must read back by name,
+    # add_shape_timeline() raises RuntimeError otherwise
+    action = deform_starmesh.add_shape_timeline(
+        objects, [('KeyMap', 30, 30),
+                  ('KeySphere', 30, 100, 'BEZIER'),
+                  ('Basis', 170, 230, ('SINE', 'EASE_IN_OUT'))])
+
+    fcurve = action.fcurves.find(deform_starmesh.shapekey_data_path(
+        'KeySphere'))
+    assert list(fcurve.keyframe_points[-2].co) == [170., 1.]
+    assert fcurve.keyframe_points[-2].interpolation == 'SINE'
+    assert fcurve.keyframe_points[-2].easing == 'EASE_IN_OUT'
+    for obj in objects:
+        assert obj.data.shape_keys.animation_data.action is action
+
+
+def test_shape_animation_keeps_interpolations(objects):
+    deform_starmesh.add_shape_animation(objects, 'Basis', 10, 'KeySphere',
+                                        50)
+    key = objects[0].data.shape_keys
+    fcurve = deform_starmesh.shapekey_fcurve(key, 'KeySphere')
+    fcurve.keyframe_points[1].interpolation = 'LINEAR'
+
+    # Existing keyframe at frame 50 is changed, one at 90 is added
+    deform_starmesh.add_shape_animation(objects, 'KeySphere', 50, 'KeyMap',
+                                        90)
+
+    assert interpolations(fcurve) == ['BEZIER', 'LINEAR', 'BEZIER']
+    co = np.array([point.co for point in fcurve.keyframe_points])
+    assert co.tolist() == [[10., 0.], [50., 1.], [90., 0.]]
+
+
+def test_write_keyframes(bpy):
+    action = bpy.data.actions.new('Action')
+    fcurve = action.fcurves.new('location')
+    deform_starmesh.write_keyframes(fcurve, [0., 10.], [1., 2.])
+
+    deform_starmesh.write_keyframes(
+        fcurve, [10., 5.], [3., 4.],
+        interpolations=[INTERPOLATIONS['CONSTANT'], INTERPOLATIONS['SINE']])
+
+    co = np.array([point.co for point in fcurve.keyframe_points])
+    assert co.tolist() == [[0., 1.], [5., 4.], [10., 3.]]
+    assert interpolations(fcurve) == ['BEZIER', 'SINE', 'CONSTANT']
@@ -0,0 +1,66 @@
+import numpy as np
+
+import starcatalog
+import ravestars_mesh
+
+
+def sorted_vertices(obj):
+    coords = ravestars_mesh.get_vertex_coordinates(obj.data)
+
+    return coords[np.lexsort(coords.T)]
+
+
+def test_chunked_import(bpy, catalog):
+    stars = starcatalog.read_stars(catalog, usecache=False)
+    expected = ravestars_mesh.create_binned_meshes(
+        stars, (0, 0, 0), 0.015, 1.8, colors=starcatalog.HRV_COLORS,
+        names=starcatalog.HRV_NAMES, prefix='binned-')
+
+    # Chunks much smaller than the meshes, so vertices are collected
+    # and appended in batches
+    job = ravestars_mesh.ChunkedImport(catalog, (0, 0, 0), 0.015, 1.8,
+                                       chunksize=37)
+    job.run()
+
+    assert job.done and job.nstars == 1000
+    for obj, binned in zip(job.objects, expected):
+        assert np.array_equal(sorted_vertices(obj), sorted_vertices(binned))
+
+
+def test_chunked_import_cancel(bpy, catalog):
+    job = ravestars_mesh.ChunkedImport(catalog, (0, 0, 0), 0.015, 1.8,
+                                       chunksize=100)
+    for i in range(4):
+        job.step()
+    job.cancel()
+
+    # The stars read so far are kept
+    assert not job.step()
+    assert job.nstars == 300
+    assert sum(len(obj.data.vertices) for obj in job.objects) == 300
+
+
+def test_preview_refinement(bpy, catalog):
+    stars = starcatalog.read_stars(catalog, usecache=False)
+    objects = ravestars_mesh.create_preview_meshes(stars, (0, 0, 0), 0.015,
+                                                   1.8, fraction=0.1, seed=3)
+    ravestars_mesh.refine_preview_meshes(objects, stars, 1.8, fraction=0.5)
+
+    # Same stars as a preview of this fraction in the first place
+    expected = ravestars_mesh.create_preview_meshes(
+        stars, (0, 0, 0), 0.015, 1.8, fraction=0.5, seed=3,
+        prefix='expected-')
+    for obj, other in zip(objects, expected):
+        assert np.array_equal(sorted_vertices(obj), sorted_vertices(other))
+
+
+def test_lod_render_handlers(bpy):
+    ravestars_mesh.use_full_detail_for_render()
+    ravestars_mesh.use_full_detail_for_render()
+
+    handlers = bpy.app.handlers
+    for handlerlist in (handlers.render_pre, handlers.render_post,
+                        handlers.render_cancel):
+        assert len(handlerlist) == 1
+        assert hasattr(handlerlist[0], '_bpy_persistent')
+        del handlerlist[:]
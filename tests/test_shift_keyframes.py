@@ -0,0 +1,63 @@
+import numpy as np
+
+import shift_keyframes
+
+
+def animated_object(bpy, name):
+    """Return object with an action for its shapekeys"""
+
+    obj = bpy.data.objects.new(name, bpy.data.meshes.new(name))
+    obj.shape_key_add('Basis')
+    action = bpy.data.actions.new(name + 'Action')
+    obj.data.shape_keys.animation_data_create().action = action
+
+    return obj
+
+
+def test_index_mark_changed(bpy):
+    first = animated_object(bpy, 'stars-first')
+    second = animated_object(bpy, 'stars-second')
+    index = shift_keyframes.AnimationIndex()
+
+    # Found by the datablock itself, also after renaming it
+    key = first.data.shape_keys
+    key.name = 'Renamed'
+    index.mark_changed(key)
+    assert index.changed == set(['stars-first'])
+
+    index.mark_changed(second.data.shape_keys.animation_data.action)
+    assert index.changed == set(['stars-first', 'stars-second'])
+
+    assert index.refresh() == 2
+    assert index.changed == set()
+
+
+def test_index_remove(bpy):
+    obj = animated_object(bpy, 'stars-first')
+    index = shift_keyframes.AnimationIndex()
+    action = obj.data.shape_keys.animation_data.action
+
+    bpy.data.objects.remove(obj)
+    index.refresh()
+
+    assert index.match() == []
+    assert action not in index.users
+    index.mark_changed(action)
+    assert index.changed == set()
+    assert index.users_of_pointer == {}
+
+
+def test_shift_keyframes(bpy):
+    obj = animated_object(bpy, 'stars-first')
+    action = obj.data.shape_keys.animation_data.action
+    fcurve = action.fcurves.new('key_blocks["Basis"].value')
+    fcurve.keyframe_points.add(3)
+    fcurve.keyframe_points.foreach_set('co', [10., 0., 20., 1., 30., 0.])
+
+    actions = shift_keyframes.get_actions_for_objects('stars-*')
+    shift_keyframes.shift_keyframes(actions, factor=2, frameshift=10)
+
+    co = np.empty(6, dtype=np.float32)
+    fcurve.keyframe_points.foreach_get('co', co)
+    assert co[0::2].tolist() == [30., 50., 70.]
+    assert co[1::2].tolist() == [0., 1., 0.]
@@ -0,0 +1,73 @@
+import warnings
+import numpy as np
+import pytest
+
+import starcatalog
+from run_benchmarks import chained_stars
+
+
+def test_star_keys_seeds():
+    # Seeds go through uint64 arithmetic, which must not warn about
+    # overflows (printed to Blender's console)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        keys = [starcatalog.star_keys(5, seed=seed) for seed in range(8)]
+
+    assert len(set(tuple(k) for k in keys)) == len(keys)
+    for k in keys:
+        assert np.all((k >= 0.) & (k < 1.))
+
+
+def test_star_keys_reproducible():
+    ids = np.array([7, 3, 11])
+    keys = starcatalog.star_keys(ids=ids, seed=3)
+
+    assert np.array_equal(keys, starcatalog.star_keys(ids=ids, seed=3))
+    assert np.array_equal(keys[1:], starcatalog.star_keys(ids=ids[1:],
+                                                          seed=3))
+
+
+@pytest.mark.parametrize('n', [1, 2, 7, 1000])
+def test_dedup_chain(n):
+    # Every star is within the tolerance of its neighbours, but only
+    # pairs are merged
+    merged = starcatalog.dedup_stars([chained_stars(n)], 1.)
+
+    assert len(merged['x']) == (n + 1)//2
+
+
+def test_voxel_grid_upper_bound():
+    zeros = np.zeros(3)
+    stars = {'x': np.array([0., 1., 2.]), 'y': zeros, 'z': zeros,
+             'hrv': zeros, 'teff': zeros}
+    lo, hi = starcatalog.grid_bounds(stars)
+
+    grid = starcatalog.aggregate_stars([stars], lo, hi, 1.)
+
+    assert grid.shape == (3, 1, 1)
+    assert grid.outside == 0
+    assert list(grid.counts) == [1, 1, 1]
+
+
+def test_filter_missing_values():
+    chunk = {'teff': np.array([4000., np.nan, 6000.])}
+
+    accept = starcatalog.make_filter('teff != 4000')
+    assert list(accept(chunk)) == [False, False, True]
+
+    accept = starcatalog.make_filter('3000 <= teff < 5000')
+    assert list(accept(chunk)) == [True, False, False]
+
+    accept = starcatalog.make_filter('teff valid')
+    assert list(accept(chunk)) == [True, False, True]
+
+    accept = starcatalog.make_filter('teff missing')
+    assert list(accept(chunk)) == [False, True, False]
+
+
+def test_filter_errors():
+    with pytest.raises(RuntimeError):
+        starcatalog.make_filter('teff ~ 4000')
+
+    with pytest.raises(RuntimeError):
+        starcatalog.make_filter('tef < 4000', columns=starcatalog.RAVE_SCHEMA)